@@ -0,0 +1,244 @@
+"""
+Micro-benchmarks for the request & response codecs.
+
+Generates sendmessages requests and newmessages / sentmessages responses
+with a range of <sms> counts and reports the throughput, the latency per
+record and the peak memory used by every encoding & decoding path.
+
+::
+
+    $ python -m benchmarks.codec --save baseline.json
+    $ python -m benchmarks.codec --compare baseline.json
+
+Every case runs in a forked process so the peak memory of one case
+doesn't hide that of the next, and the function under test runs in a
+further fork once the payload is built so building it doesn't hide the
+peak of the function. Comparing against a baseline flags
+cases that got slower or use more memory than the threshold allows and
+exits with a non-zero status.
+"""
+import os, sys, gc, json, time, resource, traceback
+from optparse import OptionParser
+
+from foneworx.client import Client
+from foneworx.utils import dict_to_xml, xml_to_dict, api_response_to_dict, \
+                            serialize_request, tostring, fromstring, Element, \
+                            ResponseParser, XML_DECLARATION
+
+DEFAULT_SIZES = [1, 10, 100, 1000, 10000, 100000]
+
+def sendmessages_request(size):
+    return {
+        'api_action': 'sendmessages',
+        'api_sessionid': 'benchmark_session_id',
+        'action_content': {
+            'sms': [{
+                'msisdn': '+2782%07d' % i,
+                'message': 'Benchmark message number %s & counting' % i,
+                'rule': 'benchmark',
+            } for i in range(size)]
+        }
+    }
+
+def response(records):
+    return "".join(['<?xml version="1.0"?><sms_api><error_type></error_type>']
+                    + records + ['</sms_api>'])
+
+def newmessages_response(size):
+    return response(['<sms><sms_id>%s</sms_id><msisdn>+2782%07d</msisdn>'
+        '<message>Benchmark message number %s</message>'
+        '<destination>+27123456789</destination>'
+        '<timereceived>20100714121511</timereceived>'
+        '<parent_sms_id>%s</parent_sms_id></sms>' % (i, i, i, i)
+        for i in range(size)])
+
+def sentmessages_response(size):
+    return response(['<sms><sms_id>%s</sms_id><status_id>3</status_id>'
+        '<status_text>Delivered</status_text>'
+        '<time_submitted>20100720110000</time_submitted>'
+        '<time_processed>20100720120000</time_processed><rule></rule>'
+        '<short_message>Benchmark message number %s</short_message>'
+        '<destination_addr>+2782%07d</destination_addr></sms>' % (i, i, i)
+        for i in range(size)])
+
+
+def encode_tree(request):
+    return XML_DECLARATION + tostring(dict_to_xml(request, Element("sms_api")))
+
+def encode_serializer(request):
+    return serialize_request(request)
+
+def decode_tree(data):
+    return xml_to_dict(fromstring(data))
+
+def decode_parser(data):
+    return api_response_to_dict(data)
+
+def convert(action):
+    client = Client('username', 'password')
+    def convert_records(records):
+        decode = client.decoders[action].decode
+        return [decode(record) for record in records]
+    return convert_records
+
+def stream(action):
+    decode = Client('username', 'password').decoders[action].decode
+    def parse_and_convert(data):
+        records = []
+        parser = ResponseParser(on_record=lambda r: records.append(decode(r)))
+        parser.feed(data)
+        parser.close()
+        return records
+    return parse_and_convert
+
+def records(generate):
+    def generate_records(size):
+        return api_response_to_dict(generate(size)).get('sms', [])
+    return generate_records
+
+# name: (payload generator, function under test)
+CASES = [
+    ('encode.sendmessages.tree', sendmessages_request, encode_tree),
+    ('encode.sendmessages.serializer', sendmessages_request, encode_serializer),
+    ('decode.newmessages.tree', newmessages_response, decode_tree),
+    ('decode.newmessages.parser', newmessages_response, decode_parser),
+    ('decode.sentmessages.tree', sentmessages_response, decode_tree),
+    ('decode.sentmessages.parser', sentmessages_response, decode_parser),
+    ('convert.newmessages', records(newmessages_response),
+        convert('newmessages')),
+    ('convert.sentmessages', records(sentmessages_response),
+        convert('sentmessages')),
+    ('stream.newmessages', newmessages_response, stream('newmessages')),
+    ('stream.sentmessages', sentmessages_response, stream('sentmessages')),
+]
+
+
+def current_rss():
+    """Resident set size in kilobytes"""
+    pages = int(open('/proc/self/statm').read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+def in_child(function, *args):
+    """
+    Call the function in a forked process and return its result, which
+    must serialize to JSON. An exception in the child is raised again in
+    the parent with the child's traceback.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        status = 0
+        try:
+            try:
+                output = {'result': function(*args)}
+            except BaseException:
+                output = {'error': traceback.format_exc()}
+                status = 1
+            pipe = os.fdopen(write_fd, 'w')
+            pipe.write(json.dumps(output))
+            pipe.close()
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    pipe = os.fdopen(read_fd)
+    data = pipe.read()
+    pipe.close()
+    pid, status = os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError("Benchmark process exited with status %s "
+                            "without a result" % status)
+    output = json.loads(data)
+    if 'error' in output:
+        raise RuntimeError("Benchmark process failed:\n%s" % output['error'])
+    return output['result']
+
+def measure(generate, function, size, repeat):
+    payload = generate(size)
+    gc.collect()
+    # ru_maxrss is a high-water mark that building the payload has already
+    # raised, a fresh process starts from the current size
+    return in_child(run_function, function, payload, size, repeat)
+
+def run_function(function, payload, size, repeat):
+    rss = current_rss()
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        function(payload)
+        timings.append(time.time() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    seconds = min(timings)
+    return {
+        'seconds': seconds,
+        'records_per_second': size / seconds if seconds else None,
+        'usec_per_record': seconds * 1e6 / size,
+        'peak_memory_kb': max(peak, 0),
+    }
+
+def measure_in_child(generate, function, size, repeat):
+    return in_child(measure, generate, function, size, repeat)
+
+def run(names, sizes, repeat):
+    results = {}
+    for name, generate, function in CASES:
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        for size in sizes:
+            result = measure_in_child(generate, function, size,
+                                        repeat if size < 10000 else 1)
+            results['%s.%s' % (name, size)] = result
+            print "%-45s %12.0f rec/s %10.2f us/rec %10d KB" % (
+                '%s [%s]' % (name, size), result['records_per_second'] or 0,
+                result['usec_per_record'], result['peak_memory_kb'])
+            sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Returns a list of regressions, slower throughput or higher peak
+    memory than the baseline by more than the threshold.
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        before = baseline[key]
+        if result['seconds'] > before['seconds'] * (1 + threshold):
+            regressions.append("%s: %.2f us/rec, was %.2f us/rec" % (key,
+                result['usec_per_record'], before['usec_per_record']))
+        # small allocations are below the resolution of the measurement
+        if result['peak_memory_kb'] > max(before['peak_memory_kb'], 1024) \
+                                                * (1 + threshold):
+            regressions.append("%s: %s KB peak memory, was %s KB" % (key,
+                result['peak_memory_kb'], before['peak_memory_kb']))
+    return regressions
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] [case prefix ...]")
+    parser.add_option('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma separated <sms> counts [%default]")
+    parser.add_option('--repeat', type='int', default=5,
+                        help="runs per case, the fastest counts [%default]")
+    parser.add_option('--save', metavar='FILE',
+                        help="save the results as a baseline")
+    parser.add_option('--compare', metavar='FILE',
+                        help="compare the results with a saved baseline")
+    parser.add_option('--threshold', type='float', default=0.2,
+                        help="allowed relative regression [%default]")
+    options, names = parser.parse_args(args)
+    sizes = [int(size) for size in options.sizes.split(',')]
+    results = run(names, sizes, options.repeat)
+    if options.save:
+        json.dump(results, open(options.save, 'w'), indent=2, sort_keys=True)
+    if options.compare:
+        regressions = compare(results, json.load(open(options.compare)),
+                                options.threshold)
+        for regression in regressions:
+            print "REGRESSION", regression
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
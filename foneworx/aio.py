@@ -0,0 +1,555 @@
+"""
+asyncio implementation of the connection to & client for the Foneworx
+gateway, next to the Twisted one in foneworx.client. Like the rest of the
+package it runs on Python 2, with trollius, the asyncio backport.
+
+Requests are serialized & responses parsed by foneworx.codec and records
+decoded by foneworx.schema, same as with Twisted. Connections are pooled
+and many requests can be made concurrently on one event loop.
+
+The code uses futures & callbacks rather than coroutines, as trollius
+has no `yield from`, every method returns a Future.
+
+::
+
+    loop = asyncio.get_event_loop()
+    connection = AsyncConnection('gateway.example.org', 50000, loop=loop)
+    client = AsyncClient('username', 'password', connection)
+    messages = loop.run_until_complete(client.new_messages())
+"""
+import trollius as asyncio
+
+from foneworx.codec import ResponseParser, serialize_request, chunk_messages
+from foneworx.batches import RETRY_ACTIONS, REPEATABLE_READS, SESSION_ERRORS, \
+                            is_session_error, can_repeat, \
+                            check_results, merge_chunks, merge_deletes, \
+                            DELETED, SENT_DELETED
+from foneworx.errors import FoneworxException, ApiException
+from foneworx.schema import response_decoders
+
+class ConnectionClosed(FoneworxException):
+    """The connection was closed before a response was received"""
+
+
+def create_future(loop):
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    return asyncio.Future(loop=loop)
+
+def resolve(future, source):
+    """Give `future` the outcome of the `source` future"""
+    if future.done():
+        return
+    if source.cancelled():
+        future.cancel()
+    elif source.exception() is not None:
+        future.set_exception(source.exception())
+    else:
+        future.set_result(source.result())
+
+def then(future, callback=None, errback=None):
+    """
+    Returns a Future for the result of `callback(result)`, or of
+    `errback(exception)` if `future` fails. Without a callback or errback
+    the outcome is passed on, if they return a Future it's waited for.
+    """
+    result = create_future(future._loop)
+    def done(future):
+        if future.cancelled():
+            result.cancel()
+            return
+        exception = future.exception()
+        try:
+            if exception is None:
+                if callback is None:
+                    value = future.result()
+                else:
+                    value = callback(future.result())
+            elif errback is None:
+                result.set_exception(exception)
+                return
+            else:
+                value = errback(exception)
+        except Exception as e:
+            result.set_exception(e)
+            return
+        if isinstance(value, asyncio.Future):
+            value.add_done_callback(lambda value: resolve(result, value))
+        else:
+            result.set_result(value)
+    future.add_done_callback(done)
+    return result
+
+def run_limited(functions, limit, loop):
+    """
+    Call the functions, which return Futures, at most `limit` at a time.
+    Returns a Future for a list of (success, result or exception) tuples
+    in the order of the functions.
+    """
+    result = create_future(loop)
+    outcomes = [None] * len(functions)
+    state = {'next': 0, 'done': 0}
+    if not functions:
+        result.set_result(outcomes)
+        return result
+    def start():
+        index = state['next']
+        state['next'] += 1
+        try:
+            future = functions[index]()
+        except Exception as e:
+            future = create_future(loop)
+            future.set_exception(e)
+        future.add_done_callback(lambda future: finished(index, future))
+    def finished(index, future):
+        if future.cancelled():
+            outcomes[index] = (False, asyncio.CancelledError())
+        elif future.exception() is not None:
+            outcomes[index] = (False, future.exception())
+        else:
+            outcomes[index] = (True, future.result())
+        state['done'] += 1
+        if state['done'] == len(functions):
+            result.set_result(outcomes)
+        elif state['next'] < len(functions):
+            start()
+    for i in range(min(limit, len(functions))):
+        start()
+    return result
+
+
+class FoneworxStreamProtocol(asyncio.Protocol):
+    """
+    The wire framing of FoneworxProtocol, requests & responses terminated
+    by the delimiter, one request at a time. If the server closes the
+    connection instead whatever has been received is the response.
+    """
+
+    delimiter = b'\0'
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.connected = False
+        self.pending = None
+        self.parser = None
+        self.received = 0 # bytes received for the current response
+        self.responses = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = True
+
+    def data_received(self, data):
+        try:
+            while data:
+                response, delimiter, data = data.partition(self.delimiter)
+                if response:
+                    self.parse(response)
+                if delimiter:
+                    self.response_received()
+        except Exception as e:
+            if self.pending is None:
+                raise
+            # the response is malformed, the connection can't be trusted
+            self.transport.close()
+            self.fail(e)
+
+    def parse(self, data):
+        if self.parser is None:
+            raise FoneworxException("Received data without a pending request")
+        self.received += len(data)
+        self.parser.feed(data)
+
+    def reset(self):
+        future, self.pending = self.pending, None
+        self.parser = None
+        self.received = 0
+        return future
+
+    def fail(self, exception):
+        future = self.reset()
+        if not future.done():
+            future.set_exception(exception)
+
+    def response_received(self):
+        if self.pending is None:
+            raise FoneworxException("Received a response without a request")
+        parser = self.parser
+        future = self.reset()
+        self.responses += 1
+        try:
+            response = parser.close()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(response)
+
+    def send_line(self, line, on_record=None):
+        """Send a request, returns a Future for the response dictionary"""
+        if self.pending is not None:
+            raise FoneworxException("A request is already pending")
+        self.pending = create_future(self.loop)
+        self.parser = ResponseParser(on_record)
+        self.transport.writelines([line, self.delimiter])
+        return self.pending
+
+    def connection_lost(self, exception):
+        self.connected = False
+        if self.received:
+            self.response_received()
+        elif self.pending is not None:
+            self.fail(exception or ConnectionClosed("Connection closed"))
+
+
+class AsyncConnectionPool(object):
+    """
+    The same pooling as foneworx.pool.ConnectionPool, at most `size`
+    connections and idle ones are closed after `idle_timeout` seconds.
+    """
+
+    def __init__(self, hostname, port, size=4, idle_timeout=60, loop=None):
+        self.hostname = hostname
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.loop = loop or asyncio.get_event_loop()
+        self.active = 0
+        self.idle = [] # (protocol, timer handle) tuples, most recent last
+        self.waiting = []
+        self.connections_made = 0
+
+    def acquire(self):
+        """Returns a Future for a connected protocol, release it after use"""
+        future = create_future(self.loop)
+        self.waiting.append(future)
+        self.process()
+        return future
+
+    def release(self, protocol):
+        self.active -= 1
+        if protocol.connected and protocol.pending is None:
+            handle = self.loop.call_later(self.idle_timeout, self.expire,
+                                            protocol)
+            self.idle.append((protocol, handle))
+        elif protocol.connected:
+            protocol.transport.close()
+        self.process()
+
+    def expire(self, protocol):
+        for entry in self.idle:
+            if entry[0] is protocol:
+                self.idle.remove(entry)
+                break
+        protocol.transport.close()
+
+    def close(self):
+        """Close all idle connections"""
+        while self.idle:
+            protocol, handle = self.idle.pop()
+            handle.cancel()
+            if protocol.connected:
+                protocol.transport.close()
+
+    def get_idle(self):
+        while self.idle:
+            protocol, handle = self.idle.pop()
+            handle.cancel()
+            if protocol.connected:
+                return protocol
+
+    def process(self):
+        while self.waiting:
+            if self.waiting[0].done(): # cancelled while waiting
+                self.waiting.pop(0)
+                continue
+            protocol = self.get_idle()
+            if protocol:
+                self.active += 1
+                self.waiting.pop(0).set_result(protocol)
+            elif self.active < self.size:
+                self.active += 1
+                self.connect(self.waiting.pop(0))
+            else:
+                break
+
+    def connect(self, future):
+        def connected(task):
+            if task.cancelled() or task.exception() is not None:
+                self.active -= 1
+                resolve(future, task)
+                self.process()
+                return
+            transport, protocol = task.result()
+            self.connections_made += 1
+            if future.done():
+                self.release(protocol)
+            else:
+                future.set_result(protocol)
+        task = asyncio.ensure_future(self.loop.create_connection(
+            lambda: FoneworxStreamProtocol(self.loop),
+            self.hostname, self.port), loop=self.loop)
+        task.add_done_callback(connected)
+
+
+class AsyncConnection(object):
+    """
+    Connection to the Foneworx gateway, any attribute is an API call
+    returning a Future for the response dictionary, the same as with
+    foneworx.client.Connection.
+    """
+
+    # actions sent again when a reused connection was closed before the
+    # response arrived, and the reads that are only with a smstime, see
+    # foneworx.batches
+    retry_actions = RETRY_ACTIONS
+    repeatable_reads = REPEATABLE_READS
+
+    def __init__(self, hostname, port, pool_size=4, idle_timeout=60,
+                    loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.pool = AsyncConnectionPool(hostname, port, size=pool_size,
+                                        idle_timeout=idle_timeout,
+                                        loop=self.loop)
+
+    def __getattr__(self, attname):
+        if attname.startswith('_'):
+            raise AttributeError(attname)
+        def sms_api_wrapper(**options):
+            on_record = options.pop('on_record', None)
+            options['api_action'] = attname
+            return self.send(options, on_record=on_record)
+        return sms_api_wrapper
+
+    def close(self):
+        """Close all idle pooled connections"""
+        self.pool.close()
+
+    def send(self, dictionary, on_record=None):
+        api_request = serialize_request(dictionary)
+        response = create_future(self.loop)
+        retry = can_repeat(dictionary, self.retry_actions,
+                            self.repeatable_reads)
+        self.send_request(retry, api_request, on_record, response)
+        return then(response, self.check_response)
+
+    def check_response(self, response):
+        if response.get('error_type'):
+            raise ApiException(response['error_type'], response)
+        return response
+
+    def send_request(self, retry, api_request, on_record, response):
+        def acquired(future):
+            if future.cancelled() or future.exception() is not None:
+                resolve(response, future)
+                return
+            protocol = future.result()
+            try:
+                sent = protocol.send_line(api_request, on_record)
+            except Exception as e:
+                self.pool.release(protocol)
+                response.set_exception(e)
+                return
+            sent.add_done_callback(lambda sent: received(protocol, sent))
+        def received(protocol, sent):
+            self.pool.release(protocol)
+            # a reused connection could have been closed by the server
+            # while idle, try again with the next one if that's safe
+            if not sent.cancelled() and protocol.responses and retry and \
+                    isinstance(sent.exception(), ConnectionClosed):
+                self.send_request(retry, api_request, on_record, response)
+            else:
+                resolve(response, sent)
+        self.pool.acquire().add_done_callback(acquired)
+
+
+class AsyncClient(object):
+    """
+    Client for the Foneworx SMS XML API on asyncio, with the same methods
+    & arguments as foneworx.client.Client, returning Futures.
+    """
+
+    # error_type substrings that indicate the session is no longer valid
+    session_errors = SESSION_ERRORS
+
+    def __init__(self, username, password, connection, chunk_size=500,
+                    chunk_bytes=256 * 1024, concurrency=4,
+                    session_timeout=570, session_retries=1,
+                    record_types=False, loop=None):
+        self.username = username
+        self.password = password
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        self.concurrency = concurrency
+        self.session_timeout = session_timeout
+        self.session_retries = session_retries
+        self.loop = loop or connection.loop
+        self.decoders = response_decoders(record_types)
+        self._session_id = None
+        self._session_used = None
+        self._login = None
+
+    def reset_session_id(self):
+        self._session_id = None
+        self._session_used = None
+
+    def get_session_id(self):
+        """
+        Returns a Future for the session id, concurrent callers share a
+        single login.
+        """
+        now = self.loop.time()
+        if self._session_id and (self.session_timeout is None or
+                now - self._session_used < self.session_timeout):
+            self._session_used = now
+            future = create_future(self.loop)
+            future.set_result(self._session_id)
+            return future
+        if self._login is None:
+            self._login = then(self.login(), self.session_started,
+                                self.session_failed)
+        return then(self._login)
+
+    def session_started(self, session_id):
+        self._login = None
+        self._session_id = session_id
+        self._session_used = self.loop.time()
+        return session_id
+
+    def session_failed(self, exception):
+        self._login = None
+        raise exception
+
+    def is_session_error(self, error_type):
+        return is_session_error(error_type, self.session_errors)
+
+    def invalidate_session(self, session_id):
+        if self._session_id == session_id:
+            self.reset_session_id()
+
+    def call(self, api_action, **options):
+        """
+        Make an API call with the current session, replayed with a new
+        session at most `session_retries` times if it's rejected.
+        """
+        return self.call_with_retries(api_action, options,
+                                        self.session_retries)
+
+    def call_with_retries(self, api_action, options, retries):
+        def send(session_id):
+            def rejected(exception):
+                if not (retries and isinstance(exception, ApiException) and
+                        self.is_session_error(exception.args[0])):
+                    raise exception
+                self.invalidate_session(session_id)
+                return self.call_with_retries(api_action, options,
+                                                retries - 1)
+            return then(getattr(self.connection, api_action)(
+                            api_sessionid=session_id, **options),
+                        errback=rejected)
+        return then(self.get_session_id(), send)
+
+    def login(self):
+        return then(self.connection.login(api_username=self.username,
+                                            api_password=self.password),
+                    lambda response: response.get('session_id'))
+
+    def logout(self):
+        def logged_out(response):
+            self.reset_session_id()
+            return response.get('status')
+        return then(self.then_call('logout'), logged_out)
+
+    def then_call(self, api_action, **options):
+        return then(self.get_session_id(),
+                    lambda session_id: getattr(self.connection, api_action)(
+                        api_sessionid=session_id, **options))
+
+    def records(self, api_action, no_records_error, action_content):
+        records = []
+        decode = self.decoders[api_action].decode
+        def no_records(exception):
+            if isinstance(exception, ApiException) and \
+                    exception.args[0] == no_records_error:
+                return records
+            raise exception
+        return then(self.call(api_action, action_content=action_content,
+                                on_record=lambda record: records.append(
+                                    decode(record))),
+                    lambda response: records, no_records)
+
+    def new_messages(self, since=None):
+        """Get New Messages, see foneworx.client.Client.new_messages"""
+        action_content = {}
+        if since:
+            action_content['smstime'] = since.strftime("%Y%m%d%H%M%S")
+        return self.records('newmessages', 'No New Messages', action_content)
+
+    def sent_messages(self, since=None, give_detail=False):
+        """Get Status Updates, see foneworx.client.Client.sent_messages"""
+        action_content = {'give_detail': '1' if give_detail else '0'}
+        if since:
+            action_content['smstime'] = since.strftime("%Y%m%d%H%M%S")
+        return self.records('sentmessages', 'No Updates', action_content)
+
+    def send_messages(self, messages):
+        """
+        Send Sms Messages in chunks, see foneworx.client.Client.send_messages
+        """
+        if not messages:
+            results = create_future(self.loop)
+            results.set_result([])
+            return results
+        chunks = list(chunk_messages(messages, self.chunk_size,
+                                        self.chunk_bytes))
+        if len(chunks) < 2:
+            return self.send_chunk(messages)
+        return then(run_limited([lambda chunk=chunk: self.send_chunk(chunk)
+                                    for offset, chunk in chunks],
+                                self.concurrency, self.loop),
+                    lambda outcomes: merge_chunks(chunks, outcomes))
+
+    def send_chunk(self, messages):
+        results = []
+        decode = self.decoders['sendmessages'].decode
+        return then(self.call('sendmessages',
+                                action_content={'sms': messages},
+                                on_record=lambda sms: results.append(
+                                    decode(sms))),
+                    lambda response: check_results(results, messages))
+
+    def delete_message(self, sms_id):
+        return then(self.call('deletenewmessages',
+                                action_content={'sms_id': sms_id}),
+                    lambda response: response.get('change'))
+
+    def delete_sent_message(self, sms_id):
+        return then(self.call('deletesentmessages',
+                                action_content={'sms_id': sms_id}),
+                    lambda response: response.get('change'))
+
+    def delete_messages(self, sms_ids):
+        """
+        Delete many New Messages, see foneworx.client.Client.delete_messages
+        """
+        return self.bulk_delete(self.delete_message, sms_ids, DELETED)
+
+    def delete_sent_messages(self, sms_ids):
+        """
+        Delete many Sent Messages, see
+        foneworx.client.Client.delete_sent_messages
+        """
+        return self.bulk_delete(self.delete_sent_message, sms_ids,
+                                SENT_DELETED)
+
+    def bulk_delete(self, delete, sms_ids, succeeded):
+        """One request per id, at most `concurrency` at a time"""
+        sms_ids = list(sms_ids)
+        return then(run_limited([lambda sms_id=sms_id: delete(sms_id)
+                                    for sms_id in sms_ids],
+                                self.concurrency, self.loop),
+                    lambda outcomes: merge_deletes(sms_ids, outcomes,
+                                                    succeeded))
@@ -0,0 +1,92 @@
+"""
+Splitting requests into batches & merging their outcomes, and the rules
+for retrying them.
+
+Shared by the Twisted client in foneworx.client and the asyncio one in
+foneworx.aio, this module doesn't depend on either. Outcomes are
+(success, result) tuples in the order of the batches, as given by a
+DeferredList or foneworx.aio.run_limited, the result of a failed batch is
+kept as it is, a Failure or an exception.
+"""
+from foneworx.errors import FoneworxException, PartialSendError, \
+                            PartialDeleteError
+
+# error_type substrings that indicate the session is no longer valid
+SESSION_ERRORS = ('session',)
+
+# actions that can safely be sent again when a reused connection was
+# closed before the response arrived, the gateway may already have
+# processed the request. Sending messages again would send them twice.
+RETRY_ACTIONS = ('login', 'logout', 'deletenewmessages', 'deletesentmessages')
+
+# reads that return the same records when repeated, only if they're given
+# a smstime as otherwise the gateway advances its read pointer and the
+# records returned the first time are lost
+REPEATABLE_READS = ('newmessages', 'sentmessages')
+
+# the changes a delete reports when it succeeded. The API takes a single
+# sms_id per delete, deletesentmessages reports no change at all.
+DELETED = ('Success',)
+SENT_DELETED = ('Success', None)
+
+def is_session_error(error_type, session_errors=SESSION_ERRORS):
+    """Whether an error_type says the session is no longer valid"""
+    error_type = (error_type or '').lower()
+    return any(error in error_type for error in session_errors)
+
+def can_repeat(dictionary, actions=RETRY_ACTIONS, reads=REPEATABLE_READS):
+    """Whether a request can safely be sent again"""
+    api_action = dictionary.get('api_action')
+    if api_action in reads:
+        return bool((dictionary.get('action_content') or {}).get('smstime'))
+    return api_action in actions
+
+def check_results(results, messages):
+    """
+    Fail if the gateway didn't return a submit result per message, the
+    results can't be matched to the messages then
+    """
+    if len(results) != len(messages):
+        raise FoneworxException("%s submit results returned for %s "
+                                "messages" % (len(results), len(messages)))
+    return results
+
+def merge_chunks(chunks, outcomes):
+    """
+    The submit results of (offset, chunk) tuples in the order of the
+    messages. If some chunks failed a PartialSendError is raised, with
+    None as their results.
+    """
+    results, failures = [], []
+    for (offset, chunk), (success, result) in zip(chunks, outcomes):
+        if success:
+            results.extend(result)
+        else:
+            results.extend([None] * len(chunk))
+            failures.append((offset, chunk, result))
+    if failures:
+        raise PartialSendError(results, failures)
+    return results
+
+def merge_deletes(sms_ids, outcomes, succeeded=DELETED,
+                    failed=lambda error: error):
+    """
+    The changes of deleted ids, one request each, as a dictionary of sms_id
+    to change. Ids whose request failed, their change is None, or reported
+    a change not in `succeeded` are failures of the PartialDeleteError
+    that's raised. `failed` turns the exception for the latter into a
+    failure result, eg. a Failure.
+    """
+    changes, failures = {}, {}
+    for sms_id, (success, result) in zip(sms_ids, outcomes):
+        if success:
+            changes[sms_id] = result
+            if result not in succeeded:
+                failures[sms_id] = failed(FoneworxException(
+                    "deleting %s reported %r" % (sms_id, result)))
+        else:
+            changes[sms_id] = None
+            failures[sms_id] = result
+    if failures:
+        raise PartialDeleteError(changes, failures)
+    return changes
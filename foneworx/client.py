@@ -1,14 +1,27 @@
-from foneworx.utils import dict_to_xml, xml_to_dict, Dispatcher, tostring, api_response_to_dict, Element
+from foneworx.utils import dict_to_xml, xml_to_dict, Dispatcher, tostring, Element, \
+                            chunk_messages, serialize_request
 
-from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, DeferredList, DeferredSemaphore, \
+                                    maybeDeferred, inlineCallbacks, returnValue, \
+                                    succeed, CancelledError
 from twisted.python import log
-from twisted.internet.protocol import ClientCreator
-from twisted.internet import reactor
+from twisted.python.failure import Failure
+from twisted.internet import reactor, error
 
 from xml.etree.ElementTree import Element, tostring, fromstring
 from datetime import datetime, timedelta
-from foneworx.errors import ApiException
-from foneworx.protocol import FoneworxProtocol
+from time import time
+from foneworx.errors import ApiException, PartialSendError, RequestTimeout, \
+                            ConnectTimeout, PoolTimeout, EndpointUnavailable
+from foneworx.trace import tracer
+from foneworx.metrics import Samples
+from foneworx.pool import ConnectionPool
+from foneworx.health import CircuitBreaker, Endpoint, HALF_OPEN
+from foneworx.schema import Status, response_decoders
+from foneworx.batches import RETRY_ACTIONS, REPEATABLE_READS, SESSION_ERRORS, \
+                            is_session_error, can_repeat, \
+                            check_results, merge_chunks, merge_deletes, \
+                            DELETED, SENT_DELETED
 
 class Connection(object): 
     """Dummy implementation of a connection to the Foneworx SMS XML API"""
@@ -21,76 +34,390 @@ class Connection(object):
         over the wire to Foneworx as an API call.
         """
         def sms_api_wrapper(*args, **options):
+            # records are passed to the `on_record` callback as they are
+            # received instead of being collected in the response
+            on_record = options.pop('on_record', None)
             options.update({'api_action': attname})
+            if on_record:
+                return self.send(options, on_record=on_record)
             return self.send(options)
         return sms_api_wrapper
 
 class TwistedConnection(Connection):
+    """
+    Connection to the Foneworx gateway over TCP. Connections are pooled and
+    reused for consecutive API calls, `pool_size` limits the number of
+    concurrently open connections and idle connections are closed after
+    `idle_timeout` seconds.
+    
+    `hostname` can be a list of (hostname, port) tuples of gateway endpoints
+    instead, each with its own pool. Requests go to the endpoint with the
+    lowest expected wait and endpoints that fail or slow down are taken out
+    of rotation by a foneworx.health.CircuitBreaker, configured with the
+    `breaker_options`. Requests that fail to connect are sent to the next
+    endpoint, requests that may have reached the gateway aren't. If every
+    circuit is open requests fail with an EndpointUnavailable.
+    
+    Every request is reported to the `observer`, a foneworx.metrics.Observer, 
+    if one is given.
+    
+    Arguments:
+    
+    connect_timeout --  seconds to wait for a pooled connection, including
+                        connecting, before failing with a ConnectTimeout,
+                        a PoolTimeout if every connection stayed busy,
+                        which isn't held against the endpoint
+    timeout --          seconds to wait for the response once the request
+                        is sent before failing with a RequestTimeout, the
+                        connection is aborted
+    hedge_percentile -- if given, reads that can safely be repeated are
+                        sent again on another connection once they've
+                        taken longer than this percentile of the recent
+                        requests, the first response wins
+    hedge_samples --    the number of recent requests the percentile is
+                        taken over, no requests are hedged until there
+                        are this many
+    
+    The timeouts are either seconds or a dictionary of api_action to 
+    seconds, with the None key as the default. None means no deadline.
+    """
+    
+    # reads that return the same records when repeated, only if they're
+    # given a smstime as otherwise the gateway advances its read pointer
+    hedge_actions = REPEATABLE_READS
+    
+    # failures that happen before the request is sent
+    connect_errors = (ConnectTimeout, error.ConnectError, error.TimeoutError)
+    
+    # actions that can safely be sent again when a reused connection was
+    # closed before the response arrived, see foneworx.batches
+    retry_actions = RETRY_ACTIONS
+    
+    def __init__(self, hostname, port=None, pool_size=4, idle_timeout=60,
+                    observer=None, connect_timeout=None, timeout=None,
+                    hedge_percentile=None, hedge_samples=100,
+                    breaker_options=None, clock=reactor):
+        if port is None:
+            addresses = hostname
+        else:
+            addresses = [(hostname, port)]
+        self.endpoints = [Endpoint(host, port,
+                                    ConnectionPool(host, port, size=pool_size,
+                                                    idle_timeout=idle_timeout,
+                                                    clock=clock),
+                                    CircuitBreaker(name='%s:%s' % (host, port),
+                                                    clock=clock,
+                                                    **(breaker_options or {})))
+                            for host, port in addresses]
+        # the first endpoint, for a connection with a single one
+        self.hostname, self.port = addresses[0]
+        self.pool = self.endpoints[0].pool
+        self.observer = observer
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_samples = hedge_samples
+        self.clock = clock
+        self.latencies = {} # api_action: Samples of the recent requests
+        self.hedged = 0
+    
+    def deadline(self, timeout, api_action):
+        if isinstance(timeout, dict):
+            return timeout.get(api_action, timeout.get(None))
+        return timeout
+    
+    def with_deadline(self, deferred, timeout, exception, api_action, 
+                        pending):
+        """
+        Cancel `deferred` if it hasn't fired within `timeout` seconds and
+        fail with `exception` instead, called with the message when the
+        deadline passes. It's kept in `pending` to be cancelled along with
+        the request.
+        """
+        pending[:] = [deferred]
+        if timeout is None:
+            return deferred
+        expired = []
+        def expire():
+            expired.append(exception("%s timed out after %ss" % (api_action,
+                                                                timeout)))
+            deferred.cancel()
+        timer = self.clock.callLater(timeout, expire)
+        def done(result):
+            if timer.active():
+                timer.cancel()
+            elif isinstance(result, Failure) and result.check(CancelledError):
+                raise expired[0]
+            return result
+        return deferred.addBoth(done)
+    
+    def send_request(self, api_request, on_record=None, timings=None,
+                        api_action=None, retry=False):
+        """
+        Send a request on a pooled connection, returns a Deferred for the
+        response. Cancelling it cancels the request, aborting the 
+        connection if the request was already sent. With `retry` it's sent
+        again if a reused connection turns out to be closed.
+        """
+        pending = []
+        def cancel(deferred):
+            if pending:
+                pending[0].cancel()
+        deferred = Deferred(cancel)
+        d = self.attempt_request(api_request, on_record, timings, api_action,
+                                    pending, retry)
+        d.chainDeferred(deferred)
+        return deferred
+    
+    def choose_endpoint(self, tried):
+        """
+        The endpoint with the lowest expected wait that hasn't been tried,
+        None if there isn't one.
+        
+        An endpoint whose circuit is half open gets the request as a probe
+        whatever its score, reserving it with `allow` so no other request
+        is sent there until the probe's outcome closes or reopens the
+        circuit. Requests made meanwhile go to the other endpoints, and if
+        there are none they fail with an EndpointUnavailable rather than
+        wait for the probe.
+        """
+        candidates = []
+        for endpoint in self.endpoints:
+            if endpoint in tried or not endpoint.breaker.available():
+                continue
+            if endpoint.breaker.state == HALF_OPEN:
+                candidates = [endpoint]
+                break
+            candidates.append(endpoint)
+        if not candidates:
+            return None
+        endpoint = min(candidates, key=lambda endpoint: endpoint.score())
+        endpoint.breaker.allow()
+        return endpoint
     
-    def __init__(self, hostname, port):
-        self.hostname = hostname
-        self.port = port
-        self.creator = ClientCreator(reactor, FoneworxProtocol)
+    @inlineCallbacks
+    def attempt_request(self, api_request, on_record, timings, api_action,
+                            pending, retry):
+        tried = []
+        while True:
+            endpoint = self.choose_endpoint(tried)
+            if endpoint is None:
+                retry_at = min(endpoint.breaker.retry_at()
+                                for endpoint in self.endpoints)
+                raise EndpointUnavailable("No endpoint available for %s, "
+                    "retry in %.1fs" % (api_action,
+                                        retry_at - self.clock.seconds()))
+            tried.append(endpoint)
+            try:
+                api_response, latency = yield self.send_to_endpoint(endpoint,
+                    api_request, on_record, timings, api_action, pending,
+                    retry)
+            except CancelledError:
+                endpoint.breaker.cancelled()
+                raise
+            except self.connect_errors, e:
+                if isinstance(e, PoolTimeout):
+                    # waiting for a busy pool, the endpoint wasn't tried
+                    endpoint.breaker.cancelled()
+                else:
+                    endpoint.breaker.failure()
+                if len(tried) == len(self.endpoints):
+                    raise
+                log.msg("Connecting to %s:%s failed, trying the next "
+                        "endpoint: %s" % (endpoint.hostname, endpoint.port, e))
+            except Exception:
+                endpoint.breaker.failure()
+                raise
+            else:
+                endpoint.breaker.success(latency)
+                returnValue(api_response)
     
     @inlineCallbacks
-    def send(self, dictionary):
+    def send_to_endpoint(self, endpoint, api_request, on_record, timings,
+                            api_action, pending, retry):
+        """
+        Returns a Deferred for the response & the seconds it took once a
+        connection was acquired, waiting for the pool isn't the endpoint's
+        latency
+        """
+        pool = endpoint.pool
+        while True:
+            if timings is not None:
+                timings['acquire'] = time()
+            acquiring = pool.acquire()
+            def acquire_timeout(message, acquiring=acquiring):
+                if acquiring in pool.waiting:
+                    return PoolTimeout(message)
+                return ConnectTimeout(message)
+            protocol = yield self.with_deadline(acquiring,
+                self.deadline(self.connect_timeout, api_action),
+                acquire_timeout, api_action, pending)
+            if timings is not None:
+                timings['acquired'] = time()
+            start = self.clock.seconds()
+            try:
+                api_response = yield self.with_deadline(
+                    protocol.sendLine(api_request, on_record, timings),
+                    self.deadline(self.timeout, api_action),
+                    RequestTimeout, api_action, pending)
+                returnValue((api_response, self.clock.seconds() - start))
+            except (error.ConnectionDone, error.ConnectionLost), e:
+                # a reused connection could have been closed by the server
+                # while idle, try again with the next one if that's safe.
+                # Fresh connections that fail are reported to the caller.
+                if not protocol.responses or not retry:
+                    raise
+                log.msg("Connection closed by server, retrying: %s" % e)
+            finally:
+                pool.release(protocol)
+    
+    def hedge_delay(self, dictionary):
+        """
+        Seconds after which the request is sent again, None if it isn't
+        """
+        api_action = dictionary.get('api_action')
+        if self.hedge_percentile is None or \
+                api_action not in self.hedge_actions or \
+                not (dictionary.get('action_content') or {}).get('smstime'):
+            return None
+        window = self.latencies.get(api_action)
+        if window is None or len(window) < self.hedge_samples:
+            return None
+        return window.percentile(self.hedge_percentile)
+    
+    def record_latency(self, api_action, seconds):
+        try:
+            window = self.latencies[api_action]
+        except KeyError:
+            window = self.latencies[api_action] = Samples(self.hedge_samples)
+        window.add(seconds)
+    
+    def send_hedged(self, api_request, on_record, timings, api_action, delay):
+        """
+        Send the request and, if it hasn't completed after `delay` seconds,
+        again on another connection. The first to deliver a record or to
+        complete wins, the other is cancelled.
+        """
+        attempts = []
+        state = {'winner': None, 'failed': 0, 'timer': None}
+        def cancel(deferred):
+            if state['timer'].active():
+                state['timer'].cancel()
+            for attempt in attempts:
+                attempt.cancel()
+        deferred = Deferred(cancel)
+        def start():
+            if len(attempts) == 1:
+                self.hedged += 1
+                tracer.debug("Hedging %s after %ss", api_action, delay)
+            index = len(attempts)
+            attempt_timings = None if timings is None else dict(timings)
+            def won():
+                if state['winner'] is None:
+                    state['winner'] = index
+                    if state['timer'].active():
+                        state['timer'].cancel()
+                    for other, attempt in enumerate(attempts):
+                        if other != index:
+                            attempt.cancel()
+                    if timings is not None:
+                        timings.update(attempt_timings)
+                return state['winner'] == index
+            def record(record):
+                if won():
+                    return on_record(record)
+            def done(response):
+                if won():
+                    deferred.callback(response)
+            def failed(failure):
+                state['failed'] += 1
+                if state['winner'] is None and \
+                        state['failed'] == len(attempts):
+                    if state['timer'].active():
+                        state['timer'].cancel()
+                    deferred.errback(failure)
+            # only reads with a smstime are hedged, they can be repeated
+            attempt = self.send_request(api_request, on_record and record,
+                                        attempt_timings, api_action,
+                                        retry=True)
+            attempts.append(attempt)
+            attempt.addCallbacks(done, failed)
+        state['timer'] = self.clock.callLater(delay, start)
+        start()
+        return deferred
+    
+    def close(self):
+        """Close all idle pooled connections"""
+        for endpoint in self.endpoints:
+            endpoint.pool.close()
+    
+    @inlineCallbacks
+    def send(self, dictionary, on_record=None):
+        timings = None
+        if self.observer is not None:
+            timings = {'start': time()}
         # reroute the remote calls to local calls for testing
-        api_request = dict_to_xml(dictionary, root=Element("sms_api"))
-        log.msg("Sending XML: %s" % tostring(api_request))
+        api_request = serialize_request(dictionary)
+        if timings is not None:
+            timings['serialized'] = time()
+        tracer.debug("Sending XML: %s", api_request)
         
-        protocol = yield self.creator.connectTCP(self.hostname, self.port)
-        api_response = yield protocol.send_xml(api_request)
-        response = api_response_to_dict(api_response)
-        log.msg("Received Dict: %s" % response)
+        api_action = dictionary.get('api_action')
+        hedge_delay = self.hedge_delay(dictionary)
+        start = self.clock.seconds()
+        try:
+            if hedge_delay is None:
+                response = yield self.send_request(api_request, on_record,
+                                    timings, api_action,
+                                    can_repeat(dictionary, self.retry_actions,
+                                                self.hedge_actions))
+            else:
+                response = yield self.send_hedged(api_request, on_record,
+                                                    timings, api_action,
+                                                    hedge_delay)
+        except Exception, e:
+            # failures, timeouts especially, are as slow as they took,
+            # leaving them out would make the percentile too optimistic
+            if self.hedge_percentile is not None and \
+                    not isinstance(e, CancelledError):
+                self.record_latency(api_action, self.clock.seconds() - start)
+            if timings is not None:
+                self.observe(dictionary.get('api_action'), api_request,
+                                timings, e.__class__.__name__)
+            raise
+        tracer.debug("Received Dict: %s", response)
+        if self.hedge_percentile is not None:
+            self.record_latency(api_action, self.clock.seconds() - start)
+        if timings is not None:
+            self.observe(dictionary.get('api_action'), api_request, timings,
+                            response.get('error_type'))
         if response.get('error_type'):
-            raise ApiException(response['error_type'], api_response)
-        log.msg('Returning: %s' % response)
+            raise ApiException(response['error_type'], response)
+        tracer.debug('Returning: %s', response)
         returnValue(response)
-
-class Status(object):
-    """
-    Not being used currently
-    """
-    values = {
-        0: "To Be Sent",
-        1: "Submitted To Network",
-        2: "At Network",
-        3: "Delivered",
-        4: "Rejected",
-        5: "Undelivered",
-        6: "Expired",
-        9: "Submit Failed",
-        10: "Cancelled",
-        11: "Scheduled",
-        91: "Message Length is Invalid",
-        911: "Desitnation Addr Is Invalid",
-        988: "Throttling Error",
-    }
-    
-    def __init__(self, status_id):
-        self.status_id = status_id
-    
-    def __eq__(self, other):
-        if isinstance(other, Status):
-            return other.id == self.id
-        return False
-    
-    @property
-    def id(self):
-        return self.status_id
-    
-    @property
-    def text(self):
-        return self.values.get(int(self.id), 'Unknown status')
-    
-    def __repr__(self):
-        return "<Status id: %s, msg: %s>" % (self.id, self.text)
-
+    
+    def observe(self, api_action, api_request, timings, error_type):
+        end = time()
+        phases = {
+            'send': timings['serialized'] - timings['start'],
+            'total': end - timings['start'],
+        }
+        if 'acquired' in timings:
+            phases['connect'] = timings['acquired'] - timings['acquire']
+        if 'sent' in timings:
+            phases['send'] += timings['sent'] - timings['acquired']
+            phases['wait'] = timings.get('first_byte', end) - timings['sent']
+            phases['parse'] = timings['parse']
+        self.observer.request(api_action, phases, len(api_request) + 1,
+                                timings.get('bytes_in', 0),
+                                timings.get('records', 0), error_type)
 
 class Convertor(Dispatcher):
     """
     Convert a key, value pair to a python object. For now it's primarily
     used for timestamp strings -> datetime objects
+    
+    Superseded by foneworx.schema.Decoder which the Client uses.
     """
     def do_datetime(self, string):
         return datetime.strptime(string, '%Y%m%d%H%M%S')
@@ -113,23 +440,171 @@ class Convertor(Dispatcher):
         return key, value
     
 
+class Batcher(object):
+    """
+    Collects converted records in batches of `batch_size` and hands each
+    full batch to the callback. Results of the callback, which may be
+    Deferreds, are tracked until `close` is called.
+    
+    Once `max_pending` batches are waiting on their Deferreds a record 
+    returns a Deferred that fires when one of them completes, the 
+    protocol stops reading the response until then so a slow callback
+    doesn't pile up batches in memory.
+    """
+    
+    def __init__(self, callback, batch_size, convert, max_pending=2):
+        self.callback = callback
+        self.batch_size = batch_size
+        self.convert = convert
+        self.max_pending = max_pending
+        self.batch = []
+        self.pending = []
+        self.ready = None
+        self.failure = None
+        self.count = 0
+    
+    def __call__(self, record):
+        self.batch.append(self.convert(record))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+            if len(self.pending) >= self.max_pending:
+                if self.ready is None:
+                    self.ready = Deferred()
+                return self.ready
+    
+    def flush(self):
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        self.count += len(batch)
+        deferred = maybeDeferred(self.callback, batch)
+        # a fired Deferred can still be waiting on one returned by its
+        # callbacks, so every Deferred is tracked until it has a result
+        self.pending.append(deferred)
+        deferred.addBoth(self.completed, deferred)
+    
+    def completed(self, result, deferred):
+        self.pending.remove(deferred)
+        if isinstance(result, Failure):
+            if self.failure is None:
+                self.failure = result
+            else:
+                log.err(result)
+            result = None
+        if self.ready is not None and len(self.pending) < self.max_pending:
+            ready, self.ready = self.ready, None
+            ready.callback(None)
+        return result
+    
+    def close(self):
+        """
+        Flush the remaining records, returns a Deferred that fires with the
+        number of records once all callbacks have completed, or with the
+        first failure of the callback
+        """
+        self.flush()
+        def done(_):
+            if self.failure is not None:
+                return self.failure
+            return self.count
+        return DeferredList(list(self.pending)).addCallback(done)
+    
+
+class TimedConvert(object):
+    """
+    Wraps a convert function and adds up the time spent in it
+    """
+    
+    def __init__(self, convert):
+        self.convert = convert
+        self.seconds = 0
+        self.count = 0
+    
+    def __call__(self, record):
+        start = time()
+        try:
+            return self.convert(record)
+        finally:
+            self.seconds += time() - start
+            self.count += 1
+    
+
 class Client(object):
+    """
+    Client for the Foneworx SMS XML API.
+    
+    Batches passed to `send_messages` are split into chunks of at most
+    `chunk_size` messages and roughly `chunk_bytes` bytes, at most 
+    `concurrency` chunks are sent in parallel.
+    
+    The gateway resets sessions after 10 minutes of inactivity, sessions
+    idle for longer than `session_timeout` seconds are replaced by a new 
+    login. If `keepalive` is set the client logs in again by itself that
+    many seconds before an idle session would time out. It keeps doing so
+    for as long as the client exists, unless `keepalive_idle` is set: once
+    no calls have been made for that many seconds the session is left to
+    expire and the next call logs in again.
+    
+    API calls rejected because of an expired or invalid session are 
+    replayed with a new session, at most `session_retries` times.
+    
+    Records are converted by the Decoder in `decoders` for the API action,
+    replace them to decode fields lazily. With `record_types` set records
+    are returned as compact InboundMessage, SentStatus and SubmitResult 
+    instances instead of dictionaries.
     
-    def __init__(self, username, password, connection=Connection()):
+    Logins and the time spent converting records are reported to the 
+    `observer`, a foneworx.metrics.Observer, if one is given.
+    
+    If a `planner`, a foneworx.planner.Planner, is given messages are
+    checked & normalised before they're sent, the ones the gateway would 
+    reject get a failed submit result without being sent.
+    """
+    
+    # error_type substrings that indicate the session is no longer valid
+    session_errors = SESSION_ERRORS
+    
+    def __init__(self, username, password, connection=Connection(),
+                    chunk_size=500, chunk_bytes=256 * 1024, concurrency=4,
+                    session_timeout=570, keepalive=None, keepalive_idle=None,
+                    session_retries=1, record_types=False, observer=None,
+                    planner=None, clock=reactor):
+        if keepalive and (session_timeout is None or
+                            keepalive >= session_timeout):
+            raise ValueError("keepalive needs a session_timeout longer "
+                                "than it")
         self.username = username
         self.password = password
         self.connection = connection
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        self.concurrency = concurrency
+        self.session_timeout = session_timeout
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.session_retries = session_retries
+        self.observer = observer
+        self.planner = planner
+        self.clock = clock
+        self.decoders = response_decoders(record_types)
         self._session_id = None
+        self._session_used = None
+        self._session_waiters = None
+        self._keepalive = None
+        self._last_call = None
     
     def to_python_values(self, dictionary):
         """
         Convert a dictionary to more pythonic values
         """
-        convertor = Convertor()
-        return dict(convertor.convert(*kv) for kv in dictionary.items())
+        return self.decoders[None].decode(dictionary)
     
     def reset_session_id(self):
         self._session_id = None
+        self._session_used = None
+        if self._keepalive and self._keepalive.active():
+            self._keepalive.cancel()
+        self._keepalive = None
     
     @inlineCallbacks
     def get_new_session_id(self):
@@ -137,14 +612,104 @@ class Client(object):
         session_id = yield self.login()
         returnValue(session_id)
     
-    @inlineCallbacks
     def get_session_id(self):
         """
-        Session ids time out after 10 minutes of inactivity. Stored locally.
+        Session ids time out after 10 minutes of inactivity. Stored locally,
+        concurrent callers share a single login.
+        """
+        self._last_call = self.clock.seconds()
+        if self._session_id and not self.session_expired():
+            self._session_used = self.clock.seconds()
+            return succeed(self._session_id)
+        return self.refresh_session()
+    
+    def session_expired(self):
+        idle = self.clock.seconds() - self._session_used
+        return self.session_timeout is not None and idle >= self.session_timeout
+    
+    def refresh_session(self):
+        """
+        Log in for a new session id, if a login is already in progress
+        its result is shared.
+        """
+        deferred = Deferred()
+        if self._session_waiters is None:
+            self._session_waiters = [deferred]
+            d = maybeDeferred(self.get_new_session_id)
+            d.addCallbacks(self.session_started, self.session_failed)
+        else:
+            self._session_waiters.append(deferred)
+        return deferred
+    
+    def session_started(self, session_id):
+        waiters, self._session_waiters = self._session_waiters, None
+        self._session_id = session_id
+        self._session_used = self.clock.seconds()
+        if self.keepalive:
+            self.schedule_keepalive(self.session_timeout - self.keepalive)
+        for deferred in waiters:
+            deferred.callback(session_id)
+    
+    def session_failed(self, failure):
+        waiters, self._session_waiters = self._session_waiters, None
+        for deferred in waiters:
+            deferred.errback(failure)
+    
+    def schedule_keepalive(self, delay):
+        if self._keepalive and self._keepalive.active():
+            self._keepalive.cancel()
+        self._keepalive = self.clock.callLater(delay, self.check_keepalive)
+    
+    def check_keepalive(self):
+        """
+        Log in again ahead of time if the session has been idle for long
+        enough to be close to expiring, so callers never have to wait
+        for a login.
         """
-        if not self._session_id:
-            self._session_id = yield self.get_new_session_id()
-        returnValue(self._session_id)
+        self._keepalive = None
+        now = self.clock.seconds()
+        idle = now - self._session_used
+        remaining = self.session_timeout - self.keepalive - idle
+        if remaining > 0:
+            self.schedule_keepalive(remaining)
+        elif self.keepalive_idle is not None and \
+                now - self._last_call >= self.keepalive_idle:
+            log.msg("No calls for %ss, letting the session expire" % (
+                        now - self._last_call))
+        else:
+            log.msg("Session idle for %ss, refreshing" % idle)
+            self.refresh_session().addErrback(log.err)
+    
+    def is_session_error(self, error_type):
+        return is_session_error(error_type, self.session_errors)
+    
+    def invalidate_session(self, session_id):
+        """
+        Forget the session id unless it has already been replaced
+        """
+        if self._session_id == session_id:
+            self.reset_session_id()
+    
+    @inlineCallbacks
+    def call(self, api_action, **options):
+        """
+        Make an API call with the current session. If the gateway rejects
+        the session it is invalidated and the call is replayed with a new
+        session, at most `session_retries` times.
+        """
+        retries = self.session_retries
+        while True:
+            session_id = yield self.get_session_id()
+            try:
+                response = yield getattr(self.connection, api_action)(
+                    api_sessionid=session_id, **options)
+                returnValue(response)
+            except ApiException, e:
+                if not (retries and self.is_session_error(e.args[0])):
+                    raise
+                log.msg("Session rejected (%s), logging in again" % e.args[0])
+                retries -= 1
+                self.invalidate_session(session_id)
     
     @inlineCallbacks
     def login(self):
@@ -153,6 +718,8 @@ class Client(object):
         """
         response = yield self.connection.login(api_username=self.username, 
                                             api_password=self.password)
+        if self.observer is not None:
+            self.observer.login()
         returnValue(response.get('session_id'))
 
     @inlineCallbacks
@@ -177,26 +744,65 @@ class Client(object):
                     (datetime object) is filled in, it will return all message 
                     since that time
         
+        """
+        messages = []
+        yield self.stream_new_messages(messages.extend, since=since)
+        returnValue(messages)
+    
+    def stream_new_messages(self, callback, since=None, batch_size=100):
+        """
+        Get New Messages for a user, the messages are passed to the
+        callback in lists of `batch_size` as they are received. Returns
+        a Deferred that fires with the number of messages received once
+        the callback has been called for all of them.
+        
+        Arguments:
+        
+        callback -- called with a list of messages, if it returns a 
+                    Deferred it is waited on before completing. While two
+                    batches are waiting the rest of the response isn't read.
+        
+        since --    see new_messages
+        
+        batch_size -- the maximum number of messages per callback
+        
         """
         action_content = {}
         if since:
             action_content.update({
                 "smstime": since.strftime("%Y%m%d%H%M%S")
             })
-        session_id = yield self.get_session_id()
+        # this API is insane, why not an empty SMS element?
+        return self.stream_records('newmessages', 'No New Messages',
+                                    action_content, callback, batch_size)
+    
+    def converter(self, api_action):
+        """The function converting records of the given api_action"""
+        convert = self.decoders[api_action].decode
+        if self.observer is not None:
+            return TimedConvert(convert)
+        return convert
+    
+    def converted(self, api_action, convert):
+        if self.observer is not None:
+            self.observer.convert(api_action, convert.seconds, convert.count)
+    
+    @inlineCallbacks
+    def stream_records(self, api_action, no_records_error, action_content, 
+                        callback, batch_size):
+        convert = self.converter(api_action)
+        batcher = Batcher(callback, batch_size, convert)
         try:
-            response = yield self.connection.newmessages(
-                api_sessionid=session_id,
-                action_content=action_content
-            )
-            returnValue([self.to_python_values(sms) for sms in response.get('sms')])
+            yield self.call(api_action, action_content=action_content,
+                            on_record=batcher)
         except ApiException, e:
-            # this API is insane, why not an empty SMS element?
-            if e.args[0] == 'No New Messages':
-                returnValue([])
-            else:
+            if e.args[0] != no_records_error:
                 raise
-        
+        finally:
+            self.converted(api_action, convert)
+        count = yield batcher.close()
+        returnValue(count)
+    
     @inlineCallbacks
     def delete_message(self, sms_id):
         """
@@ -207,14 +813,38 @@ class Client(object):
         sms_id --   the id of the sms to be deleted
         
         """
-        session_id = yield self.get_session_id()
-        response = yield self.connection.deletenewmessages(
-            api_sessionid=session_id,
+        response = yield self.call('deletenewmessages',
             action_content={
                 'sms_id': sms_id
             }
         )
         returnValue(response.get('change'))
+    
+    def delete_messages(self, sms_ids):
+        """
+        Delete many New Messages, returns a Deferred that fires with a 
+        dictionary of sms_id to change.
+        
+        Arguments:
+        
+        sms_ids --      the ids of the smses to be deleted
+        
+        The API deletes one message per request, these are sent in
+        parallel. If some fail or report a change other than 'Success' a
+        PartialDeleteError is raised.
+        """
+        return self.bulk_delete(self.delete_message, sms_ids, DELETED)
+    
+    @inlineCallbacks
+    def bulk_delete(self, delete, sms_ids, succeeded):
+        """
+        Run `delete` for every id, at most `concurrency` at a time
+        """
+        semaphore = DeferredSemaphore(self.concurrency)
+        outcomes = yield DeferredList([semaphore.run(delete, sms_id)
+                                        for sms_id in sms_ids],
+                                        consumeErrors=True)
+        returnValue(merge_deletes(sms_ids, outcomes, succeeded, Failure))
 
     @inlineCallbacks
     def send_messages(self, messages):
@@ -240,15 +870,63 @@ class Client(object):
             <sentby> - the bind/account to use to send the message 
             <smstype> - 0 for normal text sms, 64 for encoded sms, and then message has to contain the hex string
         
+        Large batches are sent in chunks, the results are returned in the
+        order of the messages. If some chunks fail a PartialSendError is 
+        raised listing the chunks that can be retried.
+        
+        With a planner the messages rejected by it are in the results with
+        `submit` 'fail' and the `status_id` the gateway would have given.
+        
         """
-        session_id = yield self.get_session_id()
-        response = yield self.connection.sendmessages(
-            api_sessionid=session_id,
-            action_content={
-                "sms": messages
-            }
-        )
-        returnValue(response.get('sms'))
+        if self.planner is None:
+            results = yield self.send_batch(messages)
+            returnValue(results)
+        plan = self.planner.plan(messages)
+        decode = self.decoders['sendmessages'].decode
+        try:
+            results = yield self.send_batch(plan.messages)
+        except PartialSendError, e:
+            raise PartialSendError(plan.merge(e.results, decode),
+                                    plan.map_failures(e.failures))
+        returnValue(plan.merge(results, decode))
+    
+    @inlineCallbacks
+    def send_batch(self, messages):
+        """
+        Send messages in chunks, at most `concurrency` at a time
+        """
+        if not messages:
+            returnValue([])
+        chunks = list(chunk_messages(messages, self.chunk_size, 
+                                        self.chunk_bytes))
+        if len(chunks) < 2:
+            results = yield self.send_chunk(messages)
+            returnValue(results)
+        
+        semaphore = DeferredSemaphore(self.concurrency)
+        outcomes = yield DeferredList([semaphore.run(self.send_chunk, chunk)
+                                        for offset, chunk in chunks], 
+                                        consumeErrors=True)
+        returnValue(merge_chunks(chunks, outcomes))
+    
+    @inlineCallbacks
+    def send_chunk(self, messages):
+        """
+        Send a list of messages in a single request, see send_messages. 
+        Fails if the gateway doesn't return a submit result per message.
+        """
+        results = []
+        convert = self.converter('sendmessages')
+        try:
+            yield self.call('sendmessages',
+                action_content={
+                    "sms": messages
+                },
+                on_record=lambda sms: results.append(convert(sms))
+            )
+        finally:
+            self.converted('sendmessages', convert)
+        returnValue(check_results(results, messages))
     
     @inlineCallbacks
     def sent_messages(self, since=None, give_detail=False):
@@ -265,6 +943,30 @@ class Client(object):
         give_detail --  if you want the message and the destination numbers 
                         returned for each sms, boolean True / False
         
+        """
+        messages = []
+        yield self.stream_sent_messages(messages.extend, since=since,
+                                        give_detail=give_detail)
+        returnValue(messages)
+    
+    def stream_sent_messages(self, callback, since=None, give_detail=False,
+                                batch_size=100):
+        """
+        Get Status Updates For Sent Messages, the updates are passed to the
+        callback in lists of `batch_size` as they are received. Returns
+        a Deferred that fires with the number of updates received once
+        the callback has been called for all of them.
+        
+        Keyword arguments:
+        
+        callback -- called with a list of updates, if it returns a 
+                    Deferred it is waited on before completing. While two
+                    batches are waiting the rest of the response isn't read.
+        
+        since, give_detail -- see sent_messages
+        
+        batch_size -- the maximum number of updates per callback
+        
         """
         
         options = {
@@ -276,18 +978,8 @@ class Client(object):
                 'smstime': since.strftime("%Y%m%d%H%M%S")
             })
         
-        session_id = yield self.get_session_id()
-        try:
-            response = yield self.connection.sentmessages(
-                api_sessionid=session_id,
-                action_content=options
-            )
-            returnValue([self.to_python_values(sms) for sms in response.get('sms')])
-        except ApiException, e:
-            if e.args[0] == 'No Updates':
-                returnValue([])
-            else:
-                raise
+        return self.stream_records('sentmessages', 'No Updates', options,
+                                    callback, batch_size)
     
     @inlineCallbacks
     def delete_sent_message(self, sms_id):
@@ -299,11 +991,26 @@ class Client(object):
         sms_id -- the id of the sms
         
         """
-        session_id = yield self.get_session_id()
-        response = yield self.connection.deletesentmessages(
-            api_sessionid=session_id,
+        response = yield self.call('deletesentmessages',
             action_content={
                 'sms_id': sms_id
             }
         )
         returnValue(response.get('change'))
+    
+    def delete_sent_messages(self, sms_ids):
+        """
+        Delete many Sent Messages, returns a Deferred that fires with a
+        dictionary of sms_id to change.
+        
+        Arguments:
+        
+        sms_ids -- the ids of the smses
+        
+        The API deletes one sent message per request, these are sent in 
+        parallel. The gateway reports no change for a deleted sent message,
+        if some fail or report a change other than that or 'Success' a
+        PartialDeleteError is raised.
+        """
+        return self.bulk_delete(self.delete_sent_message, sms_ids,
+                                SENT_DELETED)
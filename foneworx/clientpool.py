@@ -0,0 +1,370 @@
+"""
+Spreads traffic over several gateway accounts.
+
+A Client sends everything through one account and its throttling. A
+ClientPool holds a Client per account, or per bind of an account, each
+with its own session and connections. Batches of messages are routed to
+the account with the fewest outstanding requests, or by weight, and an
+account that's throttled is taken out of rotation for `eject_interval`
+seconds while its batches are sent through the others.
+
+::
+
+    pool = ClientPool([
+        Account(Client('user1', 'pass1', TwistedConnection(host, port))),
+        Account(Client('user2', 'pass2', TwistedConnection(host, port)),
+                weight=2, defaults={'sentby': 'bind2', 'source_addr': '123'}),
+    ])
+    results = yield pool.send_messages(messages)
+
+New messages & status updates are fetched from all accounts and merged.
+The pool remembers which account a new message came from so
+delete_messages deletes it through the same account, which makes the pool
+usable as the client of a Poller.
+"""
+from twisted.internet.defer import DeferredList, DeferredSemaphore, \
+                                    inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+from twisted.internet import reactor
+from twisted.python.failure import Failure
+from twisted.python import log
+
+from foneworx.codec import chunk_messages
+from foneworx.errors import FoneworxException, ApiException, \
+                            PartialSendError, PartialDeleteError, \
+                            PartialFetchError
+
+class Account(object):
+    """
+    Arguments:
+
+    client --   the Client for the account
+    name --     identifies the account in logs, the username by default
+    weight --   share of the traffic relative to the other accounts
+    defaults -- values added to every message sent through the account
+                that doesn't have them, `sentby` & `source_addr` for a bind
+    """
+
+    def __init__(self, client, name=None, weight=1, defaults=None):
+        self.client = client
+        self.name = name or client.username
+        self.weight = weight
+        self.defaults = defaults or {}
+        self.outstanding = 0
+        self.ejected_until = None
+        self.sent = 0
+        self.throttled = 0
+        self.current_weight = 0 # for the weighted policy
+
+    def available(self, now):
+        return self.ejected_until is None or now >= self.ejected_until
+
+    def prepare(self, messages):
+        """The messages with the account's defaults added"""
+        if not self.defaults:
+            return messages
+        prepared = []
+        for message in messages:
+            message = message.copy()
+            for key, value in self.defaults.items():
+                message.setdefault(key, value)
+            prepared.append(message)
+        return prepared
+
+    def __repr__(self):
+        return '<Account %s>' % self.name
+
+
+class ClientPool(object):
+    """
+    Arguments:
+
+    accounts --         Accounts or Clients, Clients get an Account with
+                        the default weight
+    policy --           'least_outstanding' or 'weighted'
+    batch_size --       the maximum number of messages routed as a batch,
+                        no more than the chunk_size of the clients
+    eject_interval --   seconds a throttled account is out of rotation
+    throttle_retries -- times a throttled batch is sent again through
+                        another account
+    """
+
+    # error_type substrings that indicate the account is throttled
+    throttle_errors = ('throttl',)
+
+    def __init__(self, accounts, policy='least_outstanding', batch_size=500,
+                    chunk_bytes=256 * 1024, eject_interval=30,
+                    throttle_retries=3, clock=reactor):
+        if not accounts:
+            raise FoneworxException("A ClientPool needs at least one account")
+        self.accounts = [account if isinstance(account, Account)
+                            else Account(account) for account in accounts]
+        self.choose = getattr(self, 'choose_%s' % policy)
+        self.batch_size = batch_size
+        self.chunk_bytes = chunk_bytes
+        self.eject_interval = eject_interval
+        self.throttle_retries = throttle_retries
+        self.clock = clock
+        self.semaphore = DeferredSemaphore(sum(account.client.concurrency
+                                                for account in self.accounts))
+        self.inbound = {} # sms_id: account it was received on
+
+    def available(self):
+        now = self.clock.seconds()
+        return [account for account in self.accounts if account.available(now)]
+
+    def choose_least_outstanding(self, accounts):
+        return min(accounts, key=lambda account:
+                    float(account.outstanding) / account.weight)
+
+    def choose_weighted(self, accounts):
+        """Smooth weighted round robin"""
+        total = 0
+        for account in accounts:
+            account.current_weight += account.weight
+            total += account.weight
+        account = max(accounts, key=lambda account: account.current_weight)
+        account.current_weight -= total
+        return account
+
+    def is_throttle_error(self, error_type):
+        error_type = (error_type or '').lower()
+        return any(error in error_type for error in self.throttle_errors)
+
+    def is_throttled(self, failure):
+        return failure.check(ApiException) is not None and \
+                self.is_throttle_error(failure.value.args[0])
+
+    def eject(self, account):
+        """Take a throttled account out of rotation"""
+        account.throttled += 1
+        account.ejected_until = self.clock.seconds() + self.eject_interval
+        log.msg("Account %s throttled, out of rotation for %ss" % (
+                    account.name, self.eject_interval))
+
+    @inlineCallbacks
+    def next_account(self):
+        """
+        The account to send the next batch through, if all accounts are
+        throttled waits until the first is back in rotation
+        """
+        accounts = self.available()
+        if not accounts:
+            delay = min(account.ejected_until for account in self.accounts) - \
+                        self.clock.seconds()
+            yield deferLater(self.clock, max(delay, 0), lambda: None)
+            accounts = self.available()
+        returnValue(self.choose(accounts))
+
+    @inlineCallbacks
+    def send_messages(self, messages):
+        """
+        Send messages in batches spread over the accounts, returns the
+        submit results in the order of the messages. If some batches fail
+        a PartialSendError is raised, see Client.send_messages.
+        """
+        batches = list(chunk_messages(messages, self.batch_size,
+                                        self.chunk_bytes))
+        outcomes = yield DeferredList([self.semaphore.run(self.send_batch,
+                                                            batch)
+                                        for offset, batch in batches],
+                                        consumeErrors=True)
+        if len(batches) == 1 and not outcomes[0][0]:
+            outcomes[0][1].raiseException()
+        results, failures = [], []
+        for (offset, batch), (success, result) in zip(batches, outcomes):
+            self.splice(results, failures, offset, batch, success, result)
+        if failures:
+            raise PartialSendError(results, failures)
+        returnValue(results)
+
+    def splice(self, results, failures, offset, batch, success, result):
+        """
+        Add the outcome of sending the `batch` at `offset` to the results &
+        failures, the chunks of a PartialSendError at their offsets
+        """
+        if success:
+            results.extend(result)
+        elif result.check(PartialSendError):
+            results.extend(result.value.results)
+            failures.extend([(offset + chunk_offset, chunk, failure)
+                                for chunk_offset, chunk, failure
+                                in result.value.failures])
+        else:
+            results.extend([None] * len(batch))
+            failures.append((offset, batch, result))
+
+    @inlineCallbacks
+    def send_batch(self, messages, retries=None):
+        """
+        Send a batch through the chosen account, through another one if
+        it's throttled. If only some of its chunks were throttled those are
+        sent again, the others aren't.
+        """
+        if retries is None:
+            retries = self.throttle_retries
+        while True:
+            account = yield self.next_account()
+            account.outstanding += 1
+            try:
+                results = yield account.client.send_messages(
+                    account.prepare(messages))
+            except ApiException, e:
+                if not self.is_throttle_error(e.args[0]):
+                    raise
+                self.eject(account)
+                if not retries:
+                    raise
+                retries -= 1
+            except PartialSendError, e:
+                throttled = [failure for offset, chunk, failure
+                                in e.failures if self.is_throttled(failure)]
+                account.sent += len(messages) - sum(len(chunk) for offset,
+                                                    chunk, failure in e.failures)
+                if not throttled:
+                    raise
+                self.eject(account)
+                if not retries:
+                    raise
+                partial = e
+                break
+            else:
+                account.sent += len(messages)
+                returnValue(results)
+            finally:
+                account.outstanding -= 1
+        results = yield self.resend_throttled(messages, partial, retries - 1)
+        returnValue(results)
+
+    @inlineCallbacks
+    def resend_throttled(self, messages, error, retries):
+        """
+        Send the throttled chunks of a PartialSendError for `messages` again,
+        returns the results of all the messages
+        """
+        resend = [(offset, messages[offset:offset + len(chunk)])
+                    for offset, chunk, failure in error.failures
+                    if self.is_throttled(failure)]
+        outcomes = yield DeferredList([self.send_batch(batch, retries)
+                                        for offset, batch in resend],
+                                        consumeErrors=True)
+        results = list(error.results)
+        failures = [(offset, chunk, failure)
+                    for offset, chunk, failure in error.failures
+                    if not self.is_throttled(failure)]
+        for (offset, batch), (success, result) in zip(resend, outcomes):
+            spliced = []
+            self.splice(spliced, failures, offset, batch, success, result)
+            results[offset:offset + len(batch)] = spliced
+        if failures:
+            failures.sort(key=lambda failure: failure[0])
+            raise PartialSendError(results, failures)
+        returnValue(results)
+
+    @inlineCallbacks
+    def merge(self, stream, callback, accounts=None):
+        """
+        Call `stream(account, callback)` for every account in rotation.
+        Returns a Deferred that fires with the total count. If some
+        accounts fail a PartialFetchError is raised once the others are
+        done, records older than the ones received may still be waiting
+        on the failed accounts.
+        """
+        accounts = accounts or self.available()
+        outcomes = yield DeferredList([stream(account, callback)
+                                        for account in accounts],
+                                        consumeErrors=True)
+        total, failures = 0, {}
+        for account, (success, result) in zip(accounts, outcomes):
+            if success:
+                total += result
+            else:
+                failures[account.name] = result
+        if failures:
+            raise PartialFetchError(total, failures)
+        returnValue(total)
+
+    @inlineCallbacks
+    def collect(self, stream, **kwargs):
+        """
+        The records `stream` passes on as a list, the PartialFetchError
+        of a failed account has the records of the others
+        """
+        records = []
+        try:
+            yield stream(records.extend, **kwargs)
+        except PartialFetchError, e:
+            raise PartialFetchError(records, e.failures)
+        returnValue(records)
+
+    def stream_new_messages(self, callback, since=None, batch_size=100):
+        """
+        Get New Messages from all accounts, see Client.stream_new_messages
+        """
+        def stream(account, callback):
+            def received(messages):
+                for message in messages:
+                    self.inbound[message['sms_id']] = account
+                return callback(messages)
+            return account.client.stream_new_messages(received, since=since,
+                                                        batch_size=batch_size)
+        return self.merge(stream, callback)
+
+    def new_messages(self, since=None):
+        """Get New Messages from all accounts, see Client.new_messages"""
+        return self.collect(self.stream_new_messages, since=since)
+
+    def stream_sent_messages(self, callback, since=None, give_detail=False,
+                                batch_size=100):
+        """
+        Get Status Updates from all accounts, see
+        Client.stream_sent_messages
+        """
+        def stream(account, callback):
+            return account.client.stream_sent_messages(callback, since=since,
+                                                        give_detail=give_detail,
+                                                        batch_size=batch_size)
+        # updates of throttled accounts are still wanted
+        return self.merge(stream, callback, self.accounts)
+
+    def sent_messages(self, since=None, give_detail=False):
+        """Get Status Updates from all accounts, see Client.sent_messages"""
+        return self.collect(self.stream_sent_messages, since=since,
+                            give_detail=give_detail)
+
+    @inlineCallbacks
+    def delete_messages(self, sms_ids):
+        """
+        Delete New Messages through the accounts they were received on, see
+        Client.delete_messages. Ids the pool didn't receive fail.
+        """
+        by_account, changes, failures = {}, {}, {}
+        for sms_id in sms_ids:
+            account = self.inbound.get(sms_id)
+            if account is None:
+                changes[sms_id] = None
+                failures[sms_id] = Failure(FoneworxException(
+                                    "sms_id %s wasn't received" % sms_id))
+            else:
+                by_account.setdefault(account, []).append(sms_id)
+        accounts = by_account.keys()
+        outcomes = yield DeferredList([account.client.delete_messages(
+                                            by_account[account])
+                                        for account in accounts],
+                                        consumeErrors=True)
+        for account, (success, result) in zip(accounts, outcomes):
+            if success:
+                changes.update(result)
+            elif result.check(PartialDeleteError):
+                changes.update(result.value.changes)
+                failures.update(result.value.failures)
+            else:
+                for sms_id in by_account[account]:
+                    changes[sms_id] = None
+                    failures[sms_id] = result
+        for sms_id, change in changes.items():
+            if sms_id not in failures:
+                self.inbound.pop(sms_id, None)
+        if failures:
+            raise PartialDeleteError(changes, failures)
+        returnValue(changes)
@@ -0,0 +1,77 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet import reactor
+from foneworx.errors import FoneworxException, PartialSendError
+
+class SendCoalescer(object):
+    """
+    Coalesces single message sends from concurrent callers into batched
+    `Client.send_messages` calls.
+
+    Messages are held for at most `window` seconds, or until `max_batch`
+    messages are waiting, and are then sent as a single request. Each
+    caller's Deferred fires with the submit result for its own message.
+    """
+
+    def __init__(self, client, window=0.05, max_batch=100, clock=reactor):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self.clock = clock
+        self.pending = []
+        self.timer = None
+
+    def send_message(self, message):
+        """
+        Queue a message for sending, returns a Deferred that fires with
+        the message's <sms> submit result.
+        """
+        deferred = Deferred()
+        self.pending.append((message, deferred))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif not self.timer:
+            self.timer = self.clock.callLater(self.window, self.flush)
+        return deferred
+
+    def flush(self):
+        """
+        Send all waiting messages now, returns a Deferred that fires once
+        all their callers have been given a result.
+        """
+        if self.timer and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if not self.pending:
+            return succeed(None)
+        batch, self.pending = self.pending, []
+        d = self.client.send_messages([message for message, _ in batch])
+        d.addCallbacks(self.sent, self.failed, callbackArgs=(batch,),
+                        errbackArgs=(batch,))
+        return d
+
+    def sent(self, results, batch):
+        results = results or []
+        if len(results) != len(batch):
+            # the results can't be matched to the callers
+            error = FoneworxException("%s submit results returned for %s "
+                                        "messages" % (len(results), len(batch)))
+            for message, deferred in batch:
+                deferred.errback(error)
+            return
+        for (message, deferred), result in zip(batch, results):
+            deferred.callback(result)
+
+    def failed(self, failure, batch):
+        if not failure.check(PartialSendError):
+            for message, deferred in batch:
+                deferred.errback(failure)
+            return
+        failures = {}
+        for offset, messages, chunk_failure in failure.value.failures:
+            for index in range(offset, offset + len(messages)):
+                failures[index] = chunk_failure
+        for index, (message, deferred) in enumerate(batch):
+            if index in failures:
+                deferred.errback(failures[index])
+            else:
+                deferred.callback(failure.value.results[index])
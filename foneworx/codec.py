@@ -0,0 +1,235 @@
+"""
+Serializing requests to & parsing responses from the Foneworx XML API.
+
+Shared by the Twisted and asyncio connections, this module doesn't depend
+on either.
+"""
+from xml.etree.ElementTree import Element, fromstring, tostring, \
+                                    XMLParser, TreeBuilder
+
+def dict_to_xml(dictionary, root=Element("root")):
+    for key, value in dictionary.items():
+        if isinstance(value, dict):
+            root.append(dict_to_xml(value, Element(key)))
+        elif isinstance(value, list):
+            # repeated elements, eg. <sms> records or several <sms_id>s
+            for item in value:
+                if isinstance(item, dict):
+                    root.append(dict_to_xml(item, Element(key)))
+                else:
+                    element = Element(key)
+                    element.text = item
+                    root.append(element)
+        else:
+            element = Element(key)
+            element.text = value
+            root.append(element)
+    return root
+
+def estimate_size(dictionary):
+    """
+    Estimate the number of bytes a flat dictionary takes up when 
+    serialized with dict_to_xml
+    """
+    size = 0
+    for key, value in dictionary.iteritems():
+        size += 2 * len(key) + 5
+        if isinstance(value, unicode):
+            size += len(value.encode('utf-8'))
+        elif value:
+            size += len(value)
+    return size
+
+def chunk_messages(messages, max_count, max_bytes):
+    """
+    Split a list of messages into chunks of at most `max_count` messages
+    and, unless a single message exceeds it, at most `max_bytes` bytes.
+    Yields (offset, chunk) tuples where offset is the index of the first
+    message of the chunk in the list of messages.
+    """
+    offset, chunk, chunk_bytes = 0, [], 0
+    for index, message in enumerate(messages):
+        size = estimate_size(message)
+        if chunk and (len(chunk) >= max_count or 
+                        chunk_bytes + size > max_bytes):
+            yield offset, chunk
+            offset, chunk, chunk_bytes = index, [], 0
+        chunk.append(message)
+        chunk_bytes += size
+    if chunk:
+        yield offset, chunk
+
+def xml_to_dict(xml, dictionary=None):
+    # if I don't do this, dictionary for some reason will be the 
+    # value of the last test run with nosetests. Nightmare
+    dictionary = dictionary or {}
+    if xml.getchildren():
+        for child in xml.getchildren():
+            if child.getchildren():
+                child_tag, child_dict = xml_to_dict(child, {})
+                dictionary.setdefault(child_tag, []).append(child_dict)
+            else:
+                dictionary[child.tag] = child.text
+    else:
+        dictionary[xml.tag] = xml.text
+    return xml.tag, dictionary
+
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>'
+
+def escape_text(text):
+    """
+    Escape character data the same way ElementTree.tostring does
+    """
+    try:
+        if "&" in text:
+            text = text.replace("&", "&amp;")
+        if "<" in text:
+            text = text.replace("<", "&lt;")
+        if ">" in text:
+            text = text.replace(">", "&gt;")
+        return text.encode("us-ascii", "xmlcharrefreplace")
+    except (TypeError, AttributeError):
+        raise TypeError("cannot serialize %r (type %s)" % 
+                        (text, type(text).__name__))
+
+class RequestSerializer(object):
+    """
+    Serializes API requests straight to bytes, without building an element
+    tree first. The output is identical to serializing the tree built by
+    dict_to_xml with tostring and prefixing the XML declaration.
+    
+    The open, close & empty element strings are compiled once per tag and
+    reused for every request.
+    """
+    
+    def __init__(self, root="sms_api"):
+        self.root = root
+        self.templates = {}
+    
+    def template(self, tag):
+        try:
+            return self.templates[tag]
+        except KeyError:
+            name = tag.encode("us-ascii")
+            template = ("<%s>" % name, "</%s>" % name, "<%s />" % name)
+            self.templates[tag] = template
+            return template
+    
+    def serialize(self, dictionary):
+        parts = [XML_DECLARATION]
+        self.write(parts, self.root, dictionary)
+        return "".join(parts)
+    
+    def write(self, parts, tag, dictionary):
+        open_tag, close_tag, empty_tag = self.template(tag)
+        start = len(parts)
+        parts.append(open_tag)
+        for key, value in dictionary.iteritems():
+            if isinstance(value, list):
+                for item in value:
+                    self.write_value(parts, key, item)
+            else:
+                self.write_value(parts, key, value)
+        if len(parts) == start + 1:
+            parts[start] = empty_tag
+        else:
+            parts.append(close_tag)
+    
+    def write_value(self, parts, key, value):
+        if isinstance(value, dict):
+            self.write(parts, key, value)
+        elif value:
+            template = self.template(key)
+            parts.append(template[0])
+            parts.append(escape_text(value))
+            parts.append(template[1])
+        else:
+            parts.append(self.template(key)[2])
+
+serialize_request = RequestSerializer().serialize
+
+
+def dict_to_api_command(dictionary, root="sms_api"):
+    xml = dict_to_xml(dictionary, Element(root))
+    return tostring(xml)
+
+
+class ResponseBuilder(TreeBuilder):
+    """
+    Tree builder that converts elements directly below the root to
+    dictionaries as soon as they are complete and then discards them.
+    """
+    
+    def __init__(self, on_record=None, record_tag='sms'):
+        TreeBuilder.__init__(self)
+        self.on_record = on_record
+        self.record_tag = record_tag
+        self.response = {}
+        self.root = None
+        self.depth = 0
+        self.children = 0
+        self.records = 0
+    
+    def start(self, tag, attrib):
+        element = TreeBuilder.start(self, tag, attrib)
+        self.depth += 1
+        if self.depth == 1:
+            self.root = element
+        return element
+    
+    def end(self, tag):
+        element = TreeBuilder.end(self, tag)
+        self.depth -= 1
+        if self.depth == 1:
+            self.children += 1
+            self.root.remove(element)
+            if len(element):
+                self.records += 1
+                child_tag, child_dict = xml_to_dict(element, {})
+                if self.on_record and child_tag == self.record_tag:
+                    self.on_record(child_dict)
+                else:
+                    self.response.setdefault(child_tag, []).append(child_dict)
+            else:
+                self.response[element.tag] = element.text
+        return element
+    
+    def close(self):
+        TreeBuilder.close(self)
+        if not self.children:
+            self.response[self.root.tag] = self.root.text
+        return self.response
+
+
+class ResponseParser(object):
+    """
+    Incrementally parse an API response as it arrives over the wire.
+    
+    The resulting dictionary is the same as what xml_to_dict returns for the
+    complete document. If `on_record` is given then every `record_tag` 
+    element is passed to it as a dictionary as soon as it has been parsed,
+    instead of being collected in the response.
+    """
+    
+    def __init__(self, on_record=None, record_tag='sms'):
+        self.builder = ResponseBuilder(on_record, record_tag)
+        self.parser = XMLParser(target=self.builder)
+    
+    @property
+    def records(self):
+        """The number of records parsed so far"""
+        return self.builder.records
+    
+    def feed(self, data):
+        self.parser.feed(data)
+    
+    def close(self):
+        """Finish parsing and return the response dictionary"""
+        return self.parser.close()
+
+
+def api_response_to_dict(response, on_record=None):
+    parser = ResponseParser(on_record)
+    parser.feed(response)
+    return parser.close()
\ No newline at end of file
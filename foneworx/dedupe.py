@@ -0,0 +1,154 @@
+"""
+Suppresses inbound messages that have already been handled.
+
+The gateway returns a message again when it's polled with an overlapping
+`since` or when deleting it failed. A Deduplicator remembers the keys of
+handled messages, the sms_id together with the parent_sms_id, for
+`window` seconds and at most `max_size` of them, the least recently seen
+are forgotten first.
+
+::
+
+    dedupe = Deduplicator(state_file='dedupe.json')
+    for message in dedupe.filter(messages):
+        handle(message)
+    dedupe.save()
+
+Messages handled asynchronously go through `handle`, so a duplicate that
+arrives while the first copy is still being handled, as in a single
+batch, isn't handled twice.
+"""
+import os, json
+from collections import OrderedDict
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.internet import reactor
+from twisted.python.failure import Failure
+
+class Deduplicator(object):
+    """
+    Arguments:
+
+    max_size --     the maximum number of keys remembered
+    window --       seconds a key is remembered for after it was last seen,
+                    None to only limit the size
+    state_file --   file the keys are kept in across restarts
+    """
+
+    def __init__(self, max_size=100000, window=3600, state_file=None,
+                    clock=reactor):
+        self.max_size = max_size
+        self.window = window
+        self.state_file = state_file
+        self.clock = clock
+        self.keys = OrderedDict() # key: last seen, least recent first
+        self.handling = {} # key: Deferreds of duplicates waiting for it
+        self.duplicates = 0
+        self.load()
+
+    def key(self, message):
+        return (message.get('sms_id') or '', message.get('parent_sms_id') or '')
+
+    def seen(self, message):
+        """Whether the message has been added before"""
+        key = self.key(message)
+        if key not in self.keys:
+            return False
+        if self.window is not None and \
+                self.clock.seconds() - self.keys[key] > self.window:
+            del self.keys[key]
+            return False
+        return True
+
+    def handle(self, message, handler):
+        """
+        Call `handler` with the message unless it has been seen, and
+        remember it once the Deferred `handler` returns fires. Returns a
+        Deferred firing with True if the message was handled, False for a
+        duplicate. Duplicates of a message that's still being handled wait
+        for it, & fail if it fails.
+        """
+        key = self.key(message)
+        if key in self.handling:
+            self.duplicates += 1
+            d = Deferred()
+            self.handling[key].append(d)
+            return d
+        if self.seen(message):
+            self.duplicates += 1
+            return succeed(False)
+        waiting = self.handling[key] = []
+        def handled(result):
+            del self.handling[key]
+            if isinstance(result, Failure):
+                for d in waiting:
+                    d.errback(result)
+                return result
+            self.add(message)
+            for d in waiting:
+                d.callback(False)
+            return True
+        return maybeDeferred(handler, message).addBoth(handled)
+
+    def add(self, message):
+        """Remember a handled message"""
+        keys = self.keys
+        key = self.key(message)
+        keys.pop(key, None)
+        keys[key] = self.clock.seconds()
+        if len(keys) > self.max_size:
+            keys.popitem(last=False)
+
+    def expire(self):
+        """Forget keys last seen longer than `window` seconds ago"""
+        if self.window is None:
+            return
+        keys = self.keys
+        cutoff = self.clock.seconds() - self.window
+        while keys:
+            key = next(iter(keys))
+            if keys[key] >= cutoff:
+                break
+            del keys[key]
+
+    def filter(self, messages):
+        """
+        Returns the messages that haven't been seen and remembers them
+        """
+        self.expire()
+        keys, key = self.keys, self.key
+        now = self.clock.seconds()
+        fresh = []
+        for message in messages:
+            message_key = key(message)
+            if message_key in keys:
+                self.duplicates += 1
+                del keys[message_key]
+            else:
+                fresh.append(message)
+            keys[message_key] = now
+        while len(keys) > self.max_size:
+            keys.popitem(last=False)
+        return fresh
+
+    def __len__(self):
+        return len(self.keys)
+
+    def load(self):
+        if self.state_file and os.path.exists(self.state_file):
+            for sms_id, parent_sms_id, seen in json.load(open(self.state_file)):
+                self.keys[(sms_id, parent_sms_id)] = seen
+            self.expire()
+
+    def save(self):
+        if not self.state_file:
+            return
+        self.expire()
+        # write & rename so a crash never leaves a truncated file behind
+        temporary = '%s.tmp' % self.state_file
+        state = open(temporary, 'w')
+        json.dump([[sms_id, parent_sms_id, seen] for
+                    (sms_id, parent_sms_id), seen in self.keys.iteritems()],
+                    state)
+        state.close()
+        os.rename(temporary, self.state_file)
@@ -1,2 +1,65 @@
 class FoneworxException(Exception): pass
-class ApiException(FoneworxException): pass
\ No newline at end of file
+class ApiException(FoneworxException): pass
+
+class RequestTimeout(FoneworxException):
+    """No response was received within the deadline of the request"""
+
+class ConnectTimeout(RequestTimeout):
+    """No connection was available within the connect deadline"""
+
+class PoolTimeout(ConnectTimeout):
+    """
+    Every pooled connection stayed busy for the connect deadline, no new
+    connection was tried
+    """
+
+class EndpointUnavailable(FoneworxException):
+    """The circuits of all gateway endpoints are open"""
+
+class PartialSendError(FoneworxException):
+    """
+    Raised when some of the chunks of a batch of messages failed to send.
+    
+    `results` has the submit results in the order of the original messages,
+    with None for messages in failed chunks. `failures` is a list of 
+    (offset, messages, failure) tuples for every failed chunk, the messages
+    can be retried as is.
+    """
+    def __init__(self, results, failures):
+        FoneworxException.__init__(self, 
+            "%s of %s messages failed to send" % (
+                sum(len(messages) for offset, messages, failure in failures),
+                len(results)))
+        self.results = results
+        self.failures = failures
+
+class PartialFetchError(FoneworxException):
+    """
+    Raised when fetching records from some of the accounts of a ClientPool
+    failed, the records of the others were received.
+    
+    `results` is what the accounts that succeeded returned, the number of
+    records passed to the callback when streaming, the records otherwise.
+    `failures` maps the names of the failed accounts to their failures.
+    """
+    def __init__(self, results, failures):
+        FoneworxException.__init__(self,
+            "Fetching from %s failed" % ', '.join(sorted(failures)))
+        self.results = results
+        self.failures = failures
+
+class PartialDeleteError(FoneworxException):
+    """
+    Raised when some of the requests of a bulk delete failed.
+    
+    `changes` maps every sms_id to the change reported by the gateway, 
+    None for ids whose request failed. `failures` maps the ids that may
+    not have been deleted, those & the ids whose request reported a failed
+    change, to the failure of their request.
+    """
+    def __init__(self, changes, failures):
+        FoneworxException.__init__(self,
+            "%s of %s messages failed to delete" % (len(failures), 
+                                                        len(changes)))
+        self.changes = changes
+        self.failures = failures
@@ -0,0 +1,382 @@
+"""
+A local stand-in for the Foneworx gateway, for load testing the client
+end to end without a Foneworx account.
+
+It speaks the same wire protocol as the gateway, null terminated XML
+requests answered by null terminated XML responses (or by closing the
+connection) and implements the login, logout, newmessages,
+deletenewmessages, sendmessages, sentmessages & deletesentmessages actions.
+Latency, throttling, session expiry, dropped connections and slowly
+dripped responses can be configured to see how the client copes.
+
+::
+
+    $ python -m foneworx.fakegateway --port 50000 --latency 0.05
+"""
+import sys, random, itertools
+from datetime import datetime
+from optparse import OptionParser
+from xml.etree.ElementTree import fromstring
+
+from twisted.internet.protocol import Protocol, ServerFactory
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet import reactor
+from twisted.python import log
+
+from foneworx.utils import Dispatcher, RequestSerializer
+
+class GatewayError(Exception):
+    """Results in an error_type response"""
+
+
+class FakeGateway(Dispatcher):
+    """
+    The state of the fake gateway, sessions, received and sent messages.
+    Requests are dispatched to the do_<api_action> methods, which return
+    the response dictionary.
+    """
+
+    def __init__(self, session_timeout=600, max_rate=None, clock=reactor):
+        Dispatcher.__init__(self)
+        self.session_timeout = session_timeout
+        self.max_rate = max_rate
+        self.clock = clock
+        self.ids = itertools.count(1)
+        self.sessions = {}
+        self.inbox = []
+        self.inbox_read = 0
+        self.sent = {}
+        self.updates = []
+        self.updates_read = 0
+        self.rate_window = None
+        self.rate_count = 0
+        self.requests = 0
+
+    def next_id(self, prefix):
+        return '%s%s' % (prefix, self.ids.next())
+
+    def now(self):
+        """The current time of the clock as a gateway timestamp"""
+        return datetime.fromtimestamp(self.clock.seconds()).strftime(
+                                                            '%Y%m%d%H%M%S')
+
+    def receive(self, msisdn, message, destination='+27000000000',
+                    parent_sms_id=''):
+        """Add a message to the inbox as if it was sent to the gateway"""
+        sms = {
+            'sms_id': self.next_id('in'),
+            'msisdn': msisdn,
+            'message': message,
+            'destination': destination,
+            'timereceived': self.now(),
+            'parent_sms_id': parent_sms_id,
+        }
+        self.inbox.append(sms)
+        return sms
+
+    def expire_sessions(self):
+        """Reset all sessions, as the gateway does after a restart"""
+        self.sessions.clear()
+
+    def handle(self, request):
+        """
+        Handle a parsed request and return the response dictionary
+        """
+        self.requests += 1
+        try:
+            self.check_rate()
+            api_action = request.findtext('api_action')
+            if api_action != 'login':
+                self.check_session(request.findtext('api_sessionid'))
+            return self.dispatch(api_action or '', request)
+        except GatewayError, e:
+            return {'error_type': e.args[0]}
+
+    def check_rate(self):
+        if not self.max_rate:
+            return
+        window = int(self.clock.seconds())
+        if window != self.rate_window:
+            self.rate_window, self.rate_count = window, 0
+        self.rate_count += 1
+        if self.rate_count > self.max_rate:
+            raise GatewayError('Throttling Error')
+
+    def check_session(self, session_id):
+        last_used = self.sessions.get(session_id)
+        if last_used is None:
+            raise GatewayError('Invalid Session')
+        now = self.clock.seconds()
+        if self.session_timeout and now - last_used > self.session_timeout:
+            del self.sessions[session_id]
+            raise GatewayError('Session Expired')
+        self.sessions[session_id] = now
+
+    def dispatch(self, command, *args):
+        try:
+            return Dispatcher.dispatch(self, command, *args)
+        except Exception:
+            if hasattr(self, '%s%s' % (self.prefix, command.lower())):
+                raise
+            raise GatewayError('Unknown api_action %s' % command)
+
+    def do_login(self, request):
+        session_id = self.next_id('session')
+        self.sessions[session_id] = self.clock.seconds()
+        return {
+            'error_type': '',
+            'session_id': session_id,
+            'api_doc_version': '0.5',
+        }
+
+    def do_logout(self, request):
+        self.sessions.pop(request.findtext('api_sessionid'), None)
+        return {'error_type': '', 'status': 'Success'}
+
+    def since(self, request, records, read, timestamp_field):
+        smstime = request.findtext('action_content/smstime')
+        if smstime:
+            return [sms for sms in records if sms[timestamp_field] >= smstime]
+        return records[read:]
+
+    def do_newmessages(self, request):
+        messages = self.since(request, self.inbox, self.inbox_read,
+                                'timereceived')
+        self.inbox_read = len(self.inbox)
+        if not messages:
+            raise GatewayError('No New Messages')
+        return {'error_type': '', 'sms': messages}
+
+    def delete(self, request, store, change='Success'):
+        """
+        Delete the single sms_id of the request with `store`, reporting
+        `change` if it was found
+        """
+        sms_id = request.findtext('action_content/sms_id')
+        if not sms_id:
+            raise GatewayError('No sms_id given')
+        if not store(sms_id):
+            return {'error_type': '', 'change': 'fail'}
+        if change is None:
+            return {'error_type': ''}
+        return {'error_type': '', 'change': change}
+
+    def do_deletenewmessages(self, request):
+        def delete_message(sms_id):
+            for index, sms in enumerate(self.inbox):
+                if sms['sms_id'] == sms_id:
+                    del self.inbox[index]
+                    if index < self.inbox_read:
+                        self.inbox_read -= 1
+                    return True
+        return self.delete(request, delete_message)
+
+    def do_sendmessages(self, request):
+        results = []
+        for element in request.findall('action_content/sms'):
+            sms = dict((child.tag, child.text or '') for child in element)
+            if not sms.get('msisdn') or not sms.get('message'):
+                sms.update({'submit': 'fail', 'sms_id': ''})
+            else:
+                sms.update({'submit': 'success',
+                            'sms_id': self.next_id('out')})
+                self.deliver(sms)
+            results.append(sms)
+        return {'error_type': '', 'sms': results}
+
+    def deliver(self, sms):
+        timestamp = self.now()
+        update = {
+            'sms_id': sms['sms_id'],
+            'status_id': '3',
+            'status_text': 'Delivered',
+            'time_submitted': timestamp,
+            'time_processed': timestamp,
+            'rule': sms.get('rule', ''),
+            'short_message': sms['message'],
+            'destination_addr': sms['msisdn'],
+        }
+        self.sent[sms['sms_id']] = update
+        self.updates.append(update)
+
+    def do_sentmessages(self, request):
+        updates = self.since(request, self.updates, self.updates_read,
+                                'time_processed')
+        self.updates_read = len(self.updates)
+        if not updates:
+            raise GatewayError('No Updates')
+        if request.findtext('action_content/give_detail') != '1':
+            updates = [dict((key, value) for key, value in update.items()
+                            if key not in ('short_message', 'destination_addr'))
+                        for update in updates]
+        return {'error_type': '', 'sms': updates}
+
+    def do_deletesentmessages(self, request):
+        def delete_sent_message(sms_id):
+            update = self.sent.pop(sms_id, None)
+            if update:
+                index = self.updates.index(update)
+                del self.updates[index]
+                if index < self.updates_read:
+                    self.updates_read -= 1
+                return True
+        # like the gateway, no change is reported for a deleted sent message
+        return self.delete(request, delete_sent_message, change=None)
+
+
+class FakeGatewayProtocol(Protocol):
+    """
+    Handles one request at a time, like the gateway does. Responses are
+    delayed, dripped, dropped or followed by closing the connection
+    depending on the factory's settings.
+    """
+
+    def connectionMade(self):
+        self.factory.connections.append(self)
+        self.buffer = []
+        self.busy = False
+        self.closed = Deferred()
+
+    def dataReceived(self, data):
+        self.buffer.append(data)
+        if chr(0) in data:
+            self.process()
+
+    def process(self):
+        data = ''.join(self.buffer)
+        if self.busy or chr(0) not in data:
+            return
+        request, data = data.split(chr(0), 1)
+        self.buffer = [data]
+        self.busy = True
+        factory = self.factory
+        if factory.random.random() < factory.drop_rate:
+            log.msg("Dropping connection")
+            self.transport.loseConnection()
+            return
+        response = factory.respond(request)
+        if factory.latency:
+            factory.clock.callLater(factory.latency, self.write, response)
+        else:
+            self.write(response)
+
+    def write(self, response):
+        if not self.connected:
+            return
+        factory = self.factory
+        if not factory.close_after_response:
+            response += chr(0)
+        if factory.drip_bytes:
+            self.drip(response)
+        else:
+            self.transport.write(response)
+            self.written()
+
+    def drip(self, response):
+        if not self.connected:
+            return
+        chunk, response = (response[:self.factory.drip_bytes],
+                            response[self.factory.drip_bytes:])
+        self.transport.write(chunk)
+        if response:
+            self.factory.clock.callLater(self.factory.drip_interval,
+                                            self.drip, response)
+        else:
+            self.written()
+
+    def written(self):
+        self.busy = False
+        if self.factory.close_after_response:
+            self.transport.loseConnection()
+        else:
+            self.process()
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+        self.closed.callback(None)
+
+
+class FakeGatewayFactory(ServerFactory):
+    """
+    Arguments:
+
+    gateway --      the FakeGateway holding the state
+    latency --      seconds to wait before responding
+    drop_rate --    fraction of requests for which the connection is
+                    dropped instead of responding
+    drip_bytes --   send responses in chunks of this many bytes
+    drip_interval -- seconds between the dripped chunks
+    close_after_response -- end responses by closing the connection
+                    instead of with a null byte
+    seed --         seed for the random number generator
+    """
+    protocol = FakeGatewayProtocol
+
+    def __init__(self, gateway=None, latency=0, drop_rate=0, drip_bytes=0,
+                    drip_interval=0.01, close_after_response=False,
+                    seed=None, clock=reactor):
+        self.gateway = gateway or FakeGateway(clock=clock)
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.drip_bytes = drip_bytes
+        self.drip_interval = drip_interval
+        self.close_after_response = close_after_response
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.serializer = RequestSerializer()
+        self.connections = []
+
+    def respond(self, request):
+        try:
+            response = self.gateway.handle(fromstring(request))
+        except Exception:
+            log.err()
+            response = {'error_type': 'Invalid Request'}
+        return self.serializer.serialize(response)
+
+    def close(self):
+        """
+        Close all connections, returns a Deferred that fires when they're
+        all closed
+        """
+        closed = [protocol.closed for protocol in self.connections]
+        for protocol in list(self.connections):
+            protocol.transport.loseConnection()
+        return DeferredList(closed)
+
+
+def main(args):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--port', type='int', default=50000)
+    parser.add_option('--interface', default='127.0.0.1')
+    parser.add_option('--latency', type='float', default=0,
+                        help="seconds before each response [%default]")
+    parser.add_option('--max-rate', type='int', default=None,
+                        help="requests per second before answering with "
+                                "Throttling Error")
+    parser.add_option('--session-timeout', type='float', default=600,
+                        help="seconds of inactivity before sessions "
+                                "expire [%default]")
+    parser.add_option('--drop-rate', type='float', default=0,
+                        help="fraction of requests that are dropped [%default]")
+    parser.add_option('--drip-bytes', type='int', default=0,
+                        help="drip responses in chunks of this many bytes")
+    parser.add_option('--drip-interval', type='float', default=0.01,
+                        help="seconds between dripped chunks [%default]")
+    parser.add_option('--close-after-response', action='store_true',
+                        default=False, help="close the connection after "
+                                "each response instead of null terminating it")
+    parser.add_option('--seed', type='int', default=None)
+    options, args = parser.parse_args(args)
+    log.startLogging(sys.stdout)
+    gateway = FakeGateway(session_timeout=options.session_timeout,
+                            max_rate=options.max_rate)
+    factory = FakeGatewayFactory(gateway, latency=options.latency,
+        drop_rate=options.drop_rate, drip_bytes=options.drip_bytes,
+        drip_interval=options.drip_interval,
+        close_after_response=options.close_after_response, seed=options.seed)
+    reactor.listenTCP(options.port, factory, interface=options.interface)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
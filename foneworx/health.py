@@ -0,0 +1,184 @@
+"""
+Health of the gateway endpoints a TwistedConnection sends requests to.
+
+Every endpoint has a CircuitBreaker that keeps the outcomes of its recent
+requests. The circuit opens, taking the endpoint out of rotation, after
+`max_consecutive` failures in a row, when the error rate over the window
+exceeds `max_error_rate`, or when the average latency exceeds
+`max_latency`. After `reset_timeout` seconds the circuit is half open and
+a single request is let through as a probe, if it succeeds the circuit
+closes, if it fails the circuit opens again for twice as long, up to
+`max_reset_timeout`.
+
+Responses with an error_type count as successes, the endpoint answered.
+Failing to connect, losing the connection and timeouts count as failures.
+"""
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.python import log
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+class CircuitBreaker(object):
+    """
+    Arguments:
+
+    window --               the number of recent outcomes the error rate is
+                            taken over
+    min_requests --         outcomes needed in the window before the error
+                            rate or latency can open the circuit
+    max_error_rate --       the fraction of failures that opens the circuit
+    max_consecutive --      failures in a row that open the circuit
+    max_latency --          average seconds per request that opens the
+                            circuit, None to ignore latency
+    reset_timeout --        seconds the circuit is open before a probe
+    max_reset_timeout --    upper bound of the doubling reset_timeout
+    """
+
+    # weight of the latest request in the average latency
+    latency_weight = 0.2
+
+    def __init__(self, window=20, min_requests=5, max_error_rate=0.5,
+                    max_consecutive=3, max_latency=None, reset_timeout=5,
+                    max_reset_timeout=60, name=None, clock=reactor):
+        self.window = window
+        self.min_requests = min_requests
+        self.max_error_rate = max_error_rate
+        self.max_consecutive = max_consecutive
+        self.max_latency = max_latency
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.name = name
+        self.clock = clock
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=window) # True for failures
+        self.failures = 0 # in the window
+        self.consecutive = 0
+        self.latency = None
+        self.opened_at = None
+        self.open_timeout = reset_timeout
+        self.probing = False
+        self.trips = 0
+
+    def available(self):
+        """Whether the endpoint can take requests, without reserving one"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and \
+                self.clock.seconds() - self.opened_at >= self.open_timeout:
+            self.state = HALF_OPEN
+            self.probing = False
+            log.msg("Circuit for %s half open, probing" % self.name)
+        return self.state == HALF_OPEN and not self.probing
+
+    def allow(self):
+        """
+        Reserve a request, in the half open state only one probe at a time
+        """
+        if not self.available():
+            return False
+        if self.state == HALF_OPEN:
+            self.probing = True
+        return True
+
+    def retry_at(self):
+        """When an open circuit lets the next probe through"""
+        if self.state == OPEN:
+            return self.opened_at + self.open_timeout
+        return self.clock.seconds()
+
+    def record(self, failed):
+        if len(self.outcomes) == self.outcomes.maxlen and self.outcomes[0]:
+            self.failures -= 1
+        self.outcomes.append(failed)
+        if failed:
+            self.failures += 1
+
+    def success(self, seconds):
+        self.record(False)
+        self.consecutive = 0
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.latency_weight * (seconds - self.latency)
+        if self.state == HALF_OPEN:
+            self.close()
+        elif self.max_latency is not None and \
+                len(self.outcomes) >= self.min_requests and \
+                self.latency > self.max_latency:
+            self.open("average latency %.3fs" % self.latency)
+
+    def failure(self):
+        self.record(True)
+        self.consecutive += 1
+        if self.state == HALF_OPEN:
+            self.open_timeout = min(self.open_timeout * 2,
+                                    self.max_reset_timeout)
+            self.open("probe failed")
+        elif self.state == CLOSED:
+            if self.consecutive >= self.max_consecutive:
+                self.open("%s failures in a row" % self.consecutive)
+            elif len(self.outcomes) >= self.min_requests and \
+                    self.failures > self.max_error_rate * len(self.outcomes):
+                self.open("%s of the last %s requests failed" % (
+                            self.failures, len(self.outcomes)))
+
+    def cancelled(self):
+        """A request was cancelled before its outcome was known"""
+        self.probing = False
+
+    def open(self, reason):
+        self.state = OPEN
+        self.opened_at = self.clock.seconds()
+        self.probing = False
+        self.trips += 1
+        log.msg("Circuit for %s open for %ss: %s" % (self.name,
+                    self.open_timeout, reason))
+
+    def close(self):
+        log.msg("Circuit for %s closed" % self.name)
+        self.state = CLOSED
+        self.open_timeout = self.reset_timeout
+        self.probing = False
+        self.outcomes.clear()
+        self.failures = 0
+        self.consecutive = 0
+
+
+class Endpoint(object):
+    """A gateway endpoint with its connection pool & circuit breaker"""
+
+    def __init__(self, hostname, port, pool, breaker):
+        self.hostname = hostname
+        self.port = port
+        self.pool = pool
+        self.breaker = breaker
+
+    # seconds assumed for an endpoint that hasn't answered a request yet,
+    # so it isn't preferred over one that has
+    unknown_latency = 1.0
+    
+    # how much the failure rate in the window raises the expected wait,
+    # a failed request has to be sent again
+    failure_penalty = 10
+    
+    def score(self):
+        """
+        Lower is better, the expected wait for a request: the average
+        latency for itself and every request in front of it, raised by the
+        fraction of recent requests that failed
+        """
+        breaker = self.breaker
+        latency = breaker.latency
+        if latency is None:
+            latency = self.unknown_latency
+        error_rate = 0
+        if breaker.outcomes:
+            error_rate = float(breaker.failures) / len(breaker.outcomes)
+        return (self.pool.active + 1) * (latency + 0.001) * \
+                (1 + self.failure_penalty * error_rate)
+
+    def __repr__(self):
+        return '<Endpoint %s:%s %s>' % (self.hostname, self.port,
+                                        self.breaker.state)
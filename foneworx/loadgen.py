@@ -0,0 +1,307 @@
+"""
+Load generator for sizing deployments and checking the effect of
+connection & session changes, usually against the fake gateway.
+
+Drives Client.send_messages, new_messages and sent_messages through a
+TwistedConnection, either open loop at a target rate or closed loop
+with a fixed number of concurrent requests, and reports latency
+percentiles, throughput, errors and the number of connections opened.
+
+::
+
+    $ python -m foneworx.loadgen --port 50000 --rate 200 --duration 30 \\
+    >   --mix send:8,new:1,sent:1 --record run.json
+    $ python -m foneworx.loadgen --port 50000 --replay run.json
+
+A recorded run can be replayed with the same timing & mix of requests.
+"""
+import sys, json, random
+from optparse import OptionParser
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.task import LoopingCall
+from twisted.internet import reactor
+from twisted.python import log
+
+from foneworx.client import Client, TwistedConnection
+from foneworx.errors import ApiException
+from foneworx.metrics import Samples
+from foneworx import trace
+
+class Histogram(Samples):
+    """
+    Latency samples in seconds
+    """
+
+    def summary(self):
+        if not self.values:
+            return {'count': 0}
+        return {
+            'count': len(self.values),
+            'mean': sum(self.values) / len(self.values),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': max(self.values),
+        }
+
+
+class LoadGenerator(object):
+    """
+    Issues requests against a Client and records their outcome.
+
+    Arguments:
+
+    client --       the Client to drive
+    mix --          dictionary of action name to relative weight, the
+                    actions are 'send', 'new' & 'sent'
+    rate --         requests per second to issue, regardless of how many
+                    are outstanding (open loop)
+    concurrency --  if no rate is given, the number of requests kept
+                    in flight (closed loop)
+    duration --     seconds to generate load for
+    batch_size --   messages per send_messages call
+    """
+
+    def __init__(self, client, mix=None, rate=None, concurrency=1,
+                    duration=10, batch_size=1, msisdn='+27000000000',
+                    seed=None, clock=reactor):
+        self.client = client
+        self.mix = mix or {'send': 1}
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.batch_size = batch_size
+        self.msisdn = msisdn
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.choices = []
+        for action, weight in sorted(self.mix.items()):
+            self.choices.extend([action] * weight)
+        self.latencies = {}
+        self.errors = {}
+        self.schedule = []
+        self.issued = 0
+        self.outstanding = 0
+        self.started = None
+        self.stopped = False
+        self.finished = None
+        self.done = None
+
+    def do_send(self):
+        return self.client.send_messages([{
+            'msisdn': self.msisdn,
+            'message': 'load test message %s' % self.issued,
+        } for i in range(self.batch_size)])
+
+    def do_new(self):
+        return self.client.new_messages()
+
+    def do_sent(self):
+        return self.client.sent_messages()
+
+    def request(self, action=None):
+        """Issue a single request, returns a Deferred that always succeeds"""
+        action = action or self.random.choice(self.choices)
+        now = self.clock.seconds()
+        self.schedule.append((now - self.started, action))
+        self.issued += 1
+        self.outstanding += 1
+        d = maybeDeferred(getattr(self, 'do_%s' % action))
+        d.addCallbacks(self.succeeded, self.failed, callbackArgs=(action, now),
+                        errbackArgs=(action, now))
+        d.addBoth(self.completed)
+        return d
+
+    def succeeded(self, result, action, start):
+        self.latencies.setdefault(action, Histogram()).add(
+            self.clock.seconds() - start)
+
+    def failed(self, failure, action, start):
+        if failure.check(ApiException):
+            error = str(failure.value.args[0])
+        else:
+            error = failure.type.__name__
+        key = (action, error)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def completed(self, result):
+        self.outstanding -= 1
+        self.check_done()
+
+    def expired(self):
+        return self.clock.seconds() - self.started >= self.duration
+
+    def check_done(self):
+        if self.stopped and not self.outstanding and self.finished is None:
+            self.finished = self.clock.seconds()
+            self.done.callback(self)
+
+    def start(self):
+        self.started = self.clock.seconds()
+        self.stopped = False
+        self.done = Deferred()
+
+    def stop(self):
+        """Stop issuing requests, done fires once none are outstanding"""
+        self.stopped = True
+        self.check_done()
+
+    def run(self):
+        """
+        Generate load for `duration` seconds, returns a Deferred that fires
+        once all requests have completed
+        """
+        self.start()
+        if self.rate:
+            self.looping_call = LoopingCall(self.tick)
+            self.looping_call.clock = self.clock
+            self.looping_call.start(min(1.0 / self.rate, 0.01))
+        else:
+            for i in range(self.concurrency):
+                self.worker()
+        return self.done
+
+    def tick(self):
+        elapsed = self.clock.seconds() - self.started
+        if elapsed >= self.duration:
+            self.looping_call.stop()
+            self.stop()
+            return
+        due = int(elapsed * self.rate) + 1
+        while self.issued < due:
+            self.request()
+
+    def worker(self, result=None):
+        if self.expired():
+            self.stop()
+        else:
+            self.request().addCallback(self.worker)
+
+    def replay(self, schedule):
+        """
+        Issue the requests of a recorded schedule, a list of (offset, action)
+        tuples, at the same offsets
+        """
+        self.start()
+        remaining = [len(schedule)]
+        def issue(action):
+            self.request(action)
+            remaining[0] -= 1
+            if not remaining[0]:
+                self.stop()
+        for offset, action in schedule:
+            self.clock.callLater(offset, issue, action)
+        if not schedule:
+            self.stop()
+        return self.done
+
+    def report(self):
+        elapsed = (self.finished or self.clock.seconds()) - self.started
+        completed = sum(len(histogram) for histogram in self.latencies.values())
+        errors = sum(self.errors.values())
+        lines = ["%-8s %8s %10s %10s %10s %10s" % (
+                    'action', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+        for action, histogram in sorted(self.latencies.items()):
+            summary = histogram.summary()
+            lines.append("%-8s %8d %10.2f %10.2f %10.2f %10.2f" % (action,
+                summary['count'], summary['p50'] * 1000, summary['p95'] * 1000,
+                summary['p99'] * 1000, summary['max'] * 1000))
+        lines.append("requests: %s issued, %s succeeded, %s failed in %.2fs" % (
+                        self.issued, completed, errors, elapsed))
+        if elapsed:
+            lines.append("throughput: %.1f requests/s" % (completed / elapsed))
+        # other connections answer any attribute with an API call
+        connection = self.client.connection
+        if isinstance(connection, TwistedConnection):
+            lines.append("connections opened: %s" % sum(
+                endpoint.pool.connections_made
+                for endpoint in connection.endpoints))
+        for (action, error), count in sorted(self.errors.items()):
+            lines.append("error %s: %s x%s" % (action, error, count))
+        return "\n".join(lines)
+
+    def save(self, filename):
+        json.dump({
+            'mix': self.mix,
+            'batch_size': self.batch_size,
+            'schedule': self.schedule,
+        }, open(filename, 'w'))
+
+
+def parse_mix(string):
+    mix = {}
+    for item in string.split(','):
+        action, _, weight = item.partition(':')
+        mix[action.strip()] = int(weight or 1)
+    return mix
+
+def main(args):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=50000)
+    parser.add_option('--username', default='loadtest')
+    parser.add_option('--password', default='loadtest')
+    parser.add_option('--rate', type='float', default=None,
+                        help="requests per second, open loop")
+    parser.add_option('--concurrency', type='int', default=1,
+                        help="requests in flight if no rate is given [%default]")
+    parser.add_option('--duration', type='float', default=10,
+                        help="seconds to run for [%default]")
+    parser.add_option('--mix', default='send',
+                        help="weighted actions, eg. send:8,new:1,sent:1")
+    parser.add_option('--batch-size', type='int', default=1,
+                        help="messages per send request [%default]")
+    parser.add_option('--msisdn', default='+27000000000')
+    parser.add_option('--pool-size', type='int', default=4,
+                        help="maximum open connections [%default]")
+    parser.add_option('--record', metavar='FILE',
+                        help="save the requests issued for replaying")
+    parser.add_option('--replay', metavar='FILE',
+                        help="replay the requests of a recorded run")
+    parser.add_option('--seed', type='int', default=None)
+    parser.add_option('--verbose', action='store_true', default=False,
+                        help="log & trace requests")
+    parser.add_option('--capture', metavar='FILE',
+                        help="capture the data on the wire")
+    options, args = parser.parse_args(args)
+    if options.verbose:
+        log.startLogging(sys.stdout)
+    if options.verbose or options.capture:
+        trace.configure(level=options.verbose and trace.DEBUG or
+                            trace.DISABLED, capture_file=options.capture)
+
+    connection = TwistedConnection(options.host, options.port,
+                                    pool_size=options.pool_size)
+    client = Client(options.username, options.password,
+                    connection=connection)
+    mix, batch_size, schedule = parse_mix(options.mix), options.batch_size, None
+    if options.replay:
+        recording = json.load(open(options.replay))
+        mix, batch_size = recording['mix'], recording['batch_size']
+        schedule = recording['schedule']
+    generator = LoadGenerator(client, mix, rate=options.rate,
+                                concurrency=options.concurrency,
+                                duration=options.duration,
+                                batch_size=batch_size, msisdn=options.msisdn,
+                                seed=options.seed)
+
+    def finished(generator):
+        print generator.report()
+        if options.record:
+            generator.save(options.record)
+        connection.close()
+        reactor.stop()
+
+    def start():
+        if schedule is not None:
+            d = generator.replay(schedule)
+        else:
+            d = generator.run()
+        d.addCallback(finished)
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
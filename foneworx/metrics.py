@@ -0,0 +1,223 @@
+"""
+Measurements of the requests made to the gateway.
+
+The TwistedConnection and Client report to an Observer if one is given,
+without an observer nothing is measured. MetricsAggregator keeps counts
+and histograms per api_action in memory and `export_text` renders them in
+the Prometheus text format.
+
+::
+
+    metrics = MetricsAggregator()
+    connection = TwistedConnection(hostname, port, observer=metrics)
+    client = Client(username, password, connection=connection,
+                    observer=metrics)
+    ...
+    print export_text(metrics)
+
+Request latency is split into phases:
+
+connect --  waiting for a pooled connection, including connecting
+send --     serializing and writing the request
+wait --     from writing the request until the first byte of the response
+parse --    parsing the response, not counting the record callbacks
+convert --  converting records to Python values, reported by the Client
+total --    the whole request as seen by the connection
+
+Percentiles are nearest rank everywhere, the bucketed Histogram here, the
+exact Samples the load generator reports and the window hedged requests
+are timed against, so they can be compared.
+"""
+import math
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+class Observer(object):
+    """
+    Receives measurements, subclasses override the methods they need
+    """
+
+    def request(self, api_action, phases, bytes_out, bytes_in, records,
+                    error_type):
+        """
+        A request completed. `phases` maps phase names to seconds,
+        `error_type` is the error_type of an ApiException, the name of
+        the exception for other failures or None.
+        """
+
+    def convert(self, api_action, seconds, records):
+        """`records` records of a response were converted in `seconds`"""
+
+    def login(self):
+        """The client logged in for a new session"""
+
+
+def percentile_rank(percentile, count):
+    """The 1-based nearest rank of a percentile of `count` values"""
+    return max(int(math.ceil(percentile / 100.0 * count)), 1)
+
+
+class Samples(object):
+    """
+    Exact values, only the last `size` if one is given, for percentiles
+    that buckets would be too coarse for
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            self.values = array('d')
+        else:
+            self.values = deque(maxlen=size)
+
+    def add(self, value):
+        self.values.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def percentile(self, percentile):
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        return ordered[percentile_rank(percentile, len(ordered)) - 1]
+
+
+class Histogram(object):
+    """
+    Counts values in fixed buckets, memory use doesn't grow with the
+    number of values
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percentile):
+        """The upper bound of the bucket the percentile falls in"""
+        if not self.count:
+            return None
+        rank = percentile_rank(percentile, self.count)
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative(self):
+        """(upper bound, count of values <= bound) tuples"""
+        seen = 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            seen += count
+            yield bound, seen
+
+
+# seconds, 0.5ms to 60s
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+RECORD_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000]
+
+class ActionMetrics(object):
+    """The measurements for a single api_action"""
+
+    def __init__(self):
+        self.count = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.errors = {}
+        self.phases = {}
+        self.records = Histogram(RECORD_BUCKETS)
+        self.converted = 0
+
+    def phase(self, name):
+        try:
+            return self.phases[name]
+        except KeyError:
+            histogram = self.phases[name] = Histogram(LATENCY_BUCKETS)
+            return histogram
+
+
+class MetricsAggregator(Observer):
+    """
+    Aggregates the measurements in memory, per api_action
+    """
+
+    def __init__(self):
+        self.actions = {}
+        self.logins = 0
+
+    def action(self, api_action):
+        try:
+            return self.actions[api_action]
+        except KeyError:
+            metrics = self.actions[api_action] = ActionMetrics()
+            return metrics
+
+    def request(self, api_action, phases, bytes_out, bytes_in, records,
+                    error_type):
+        metrics = self.action(api_action)
+        metrics.count += 1
+        metrics.bytes_out += bytes_out
+        metrics.bytes_in += bytes_in
+        metrics.records.add(records)
+        for name, seconds in phases.iteritems():
+            metrics.phase(name).add(seconds)
+        if error_type:
+            metrics.errors[error_type] = metrics.errors.get(error_type, 0) + 1
+
+    def convert(self, api_action, seconds, records):
+        metrics = self.action(api_action)
+        metrics.phase('convert').add(seconds)
+        metrics.converted += records
+
+    def login(self):
+        self.logins += 1
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                        .replace('\n', '\\n')
+
+def format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(bound)
+
+def export_text(aggregator, prefix='foneworx'):
+    """
+    Render the aggregated measurements in the Prometheus text format
+    """
+    lines = []
+    def add(name, labels, value):
+        label_text = ','.join('%s="%s"' % (key, escape_label(label))
+                                for key, label in labels)
+        lines.append('%s_%s{%s} %s' % (prefix, name, label_text, value))
+    def add_histogram(name, labels, histogram):
+        for bound, count in histogram.cumulative():
+            add('%s_bucket' % name, labels + [('le', format_bound(bound))],
+                count)
+        add('%s_sum' % name, labels, histogram.sum)
+        add('%s_count' % name, labels, histogram.count)
+
+    lines.append('%s_logins_total %s' % (prefix, aggregator.logins))
+    for api_action, metrics in sorted(aggregator.actions.items()):
+        labels = [('action', api_action)]
+        add('requests_total', labels, metrics.count)
+        add('bytes_out_total', labels, metrics.bytes_out)
+        add('bytes_in_total', labels, metrics.bytes_in)
+        add('records_converted_total', labels, metrics.converted)
+        for error_type, count in sorted(metrics.errors.items()):
+            add('errors_total', labels + [('error_type', error_type)], count)
+        for phase, histogram in sorted(metrics.phases.items()):
+            add_histogram('request_seconds', labels + [('phase', phase)],
+                            histogram)
+        add_histogram('records', labels, metrics.records)
+    return '\n'.join(lines) + '\n'
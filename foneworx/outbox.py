@@ -0,0 +1,259 @@
+"""
+A durable queue in front of Client.send_messages.
+
+Messages are written to an SQLite database before they're sent and marked
+done once the gateway has returned a submit result for them, if the
+process dies only the messages that weren't confirmed are sent again
+after a restart.
+
+::
+
+    outbox = Outbox(client, 'outbox.db')
+    recovered = outbox.open()
+    yield outbox.enqueue([{'msisdn': '+27123456789', 'message': 'hi'}])
+
+Writes are committed in groups, every `commit_interval` seconds or once
+`batch_size` messages are waiting, so the cost of syncing to disk is
+shared by every message in the group. The Deferred returned by `enqueue`
+fires once the messages are on disk.
+
+Messages that were in flight when the process died can't be told apart
+from ones that weren't sent, these are sent again. Messages are looked
+up through an index on their state, so recovering takes time in
+proportion to the number of unconfirmed messages, not to the number of
+messages ever sent.
+
+Messages that fail to send `max_attempts` times are set aside as failed
+instead of being retried forever, `requeue_failed` queues them again.
+
+SQLite is used synchronously, commits block the reactor while they sync
+to disk. With `synchronous` 'FULL', the default, that's a disk flush per
+group commit, 'NORMAL' only syncs at WAL checkpoints and can lose the
+last commits if the machine, not the process, goes down.
+"""
+import json, sqlite3
+
+from twisted.internet.defer import Deferred
+from twisted.internet import reactor
+from twisted.python import log
+
+from foneworx.errors import PartialSendError
+
+QUEUED, IN_FLIGHT, DONE, FAILED = 0, 1, 2, 3
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message TEXT NOT NULL,
+        state INTEGER NOT NULL DEFAULT 0,
+        sms_id TEXT,
+        submit TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS state ON messages (state, id)",
+]
+
+class Outbox(object):
+    """
+    Arguments:
+
+    client --           the Client to send the messages with
+    path --             the SQLite database file
+    batch_size --       the maximum number of messages per send_messages call
+                        and per group commit
+    commit_interval --  seconds to wait for more writes before committing
+    retry_interval --   seconds to wait before sending messages again after
+                        a failure
+    max_attempts --     the number of times a message is sent before it's
+                        set aside as failed, None to retry forever
+    on_result --        called with the queue id, message & submit result of
+                        every message once it's confirmed
+    on_failed --        called with the queue id, message & failure of every
+                        message that's set aside as failed
+    synchronous --      the SQLite synchronous setting, 'FULL' or 'NORMAL'
+    """
+
+    def __init__(self, client, path, batch_size=500, commit_interval=0.01,
+                    retry_interval=5, max_attempts=5, on_result=None,
+                    on_failed=None, synchronous='FULL', clock=reactor):
+        if synchronous not in ('FULL', 'NORMAL'):
+            raise ValueError("synchronous should be 'FULL' or 'NORMAL', "
+                                "not %r" % (synchronous,))
+        self.client = client
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.on_result = on_result
+        self.on_failed = on_failed
+        self.synchronous = synchronous
+        self.clock = clock
+        self.db = None
+        self.waiting = [] # Deferreds waiting for the next commit
+        self.uncommitted = 0
+        self.commit_call = None
+        self.retry_call = None
+        self.sending = False
+
+    def open(self):
+        """
+        Open the database and resend the messages that weren't confirmed,
+        returns the number of them
+        """
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=%s" % self.synchronous)
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.execute("UPDATE messages SET state = ? WHERE state = ?",
+                        (QUEUED, IN_FLIGHT))
+        self.db.commit()
+        recovered = self.pending()
+        if recovered:
+            log.msg("Resending %s unconfirmed messages" % recovered)
+            self.process()
+        return recovered
+
+    def close(self):
+        """Commit outstanding writes and close the database"""
+        for call in (self.commit_call, self.retry_call):
+            if call and call.active():
+                call.cancel()
+        self.commit()
+        self.db.close()
+        self.db = None
+
+    def pending(self):
+        """The number of messages that haven't been confirmed"""
+        return self.db.execute("SELECT COUNT(*) FROM messages "
+                                "WHERE state < ?",
+                                (DONE,)).fetchone()[0]
+
+    def failed(self):
+        """The number of messages set aside as failed"""
+        return self.db.execute("SELECT COUNT(*) FROM messages "
+                                "WHERE state = ?",
+                                (FAILED,)).fetchone()[0]
+
+    def requeue_failed(self):
+        """
+        Queue the messages set aside as failed again, with their attempts
+        reset, returns the number of them
+        """
+        count = self.db.execute("UPDATE messages SET state = ?, attempts = 0 "
+                                "WHERE state = ?", (QUEUED, FAILED)).rowcount
+        self.commit()
+        self.process()
+        return count
+
+    def enqueue(self, messages):
+        """
+        Queue messages for sending, returns a Deferred that fires with
+        their queue ids once they're on disk
+        """
+        cursor = self.db.cursor()
+        ids = []
+        for message in messages:
+            cursor.execute("INSERT INTO messages (message) VALUES (?)",
+                            (json.dumps(message),))
+            ids.append(cursor.lastrowid)
+        deferred = Deferred()
+        self.waiting.append((deferred, ids))
+        self.uncommitted += len(ids)
+        if self.uncommitted >= self.batch_size:
+            self.commit()
+        elif not self.commit_call:
+            self.commit_call = self.clock.callLater(self.commit_interval,
+                                                    self.commit)
+        return deferred
+
+    def commit(self):
+        if self.commit_call and self.commit_call.active():
+            self.commit_call.cancel()
+        self.commit_call = None
+        self.db.commit()
+        waiting, self.waiting = self.waiting, []
+        self.uncommitted = 0
+        for deferred, ids in waiting:
+            deferred.callback(ids)
+        if waiting:
+            self.process()
+
+    def process(self):
+        """Send the next batch of queued messages unless one is in flight"""
+        if self.sending or self.db is None or \
+                (self.retry_call and self.retry_call.active()):
+            return
+        rows = self.db.execute("SELECT id, message FROM messages "
+                                "WHERE state = ? "
+                                "ORDER BY id LIMIT ?",
+                                (QUEUED, self.batch_size)).fetchall()
+        if not rows:
+            return
+        ids = [row[0] for row in rows]
+        self.sending = True
+        self.set_state(ids, IN_FLIGHT)
+        self.commit()
+        messages = [json.loads(row[1]) for row in rows]
+        d = self.client.send_messages(messages)
+        d.addCallbacks(self.sent, self.send_failed, callbackArgs=(ids, messages),
+                        errbackArgs=(ids, messages))
+        d.addErrback(log.err)
+
+    def set_state(self, ids, state):
+        self.db.executemany("UPDATE messages SET state = ? WHERE id = ?",
+                            [(state, id) for id in ids])
+
+    def sent(self, results, ids, messages):
+        self.sending = False
+        self.confirm(ids, messages, results)
+        self.commit()
+        self.process()
+
+    def send_failed(self, failure, ids, messages):
+        self.sending = False
+        unconfirmed = zip(ids, messages)
+        if failure.check(PartialSendError):
+            results = failure.value.results
+            self.confirm(ids, messages, results)
+            unconfirmed = [(id, message) for id, message, result
+                            in zip(ids, messages, results) if result is None]
+        ids = [id for id, message in unconfirmed]
+        self.db.executemany("UPDATE messages SET attempts = attempts + 1 "
+                            "WHERE id = ?", [(id,) for id in ids])
+        given_up = []
+        if self.max_attempts:
+            given_up = [(id, message) for id, message in unconfirmed
+                        if self.attempts(id) >= self.max_attempts]
+        log.err(failure, "Sending %s messages failed, %s given up, retrying "
+                            "the rest in %ss" % (len(ids), len(given_up),
+                                                    self.retry_interval))
+        self.set_state(ids, QUEUED)
+        self.set_state([id for id, message in given_up], FAILED)
+        self.commit()
+        if self.on_failed:
+            for id, message in given_up:
+                self.on_failed(id, message, failure)
+        self.retry_call = self.clock.callLater(self.retry_interval,
+                                                self.process)
+
+    def attempts(self, id):
+        return self.db.execute("SELECT attempts FROM messages WHERE id = ?",
+                                (id,)).fetchone()[0]
+
+    def confirm(self, ids, messages, results):
+        confirmed = [(id, message, result) for id, message, result
+                        in zip(ids, messages, results) if result is not None]
+        self.db.executemany("UPDATE messages SET state = ?, sms_id = ?, "
+                            "submit = ? WHERE id = ?",
+                            [(DONE, result.get('sms_id'), result.get('submit'),
+                                id) for id, message, result in confirmed])
+        if self.on_result:
+            for id, message, result in confirmed:
+                self.on_result(id, message, result)
+
+    def purge(self):
+        """Delete confirmed messages from the database"""
+        self.db.execute("DELETE FROM messages WHERE state = ?", (DONE,))
+        self.commit()
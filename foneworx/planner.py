@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Checks & prepares messages before they're sent.
+
+The gateway rejects messages that are too long with status 91 and
+invalid destination numbers with status 911, only after a round trip.
+A Planner given to the Client finds these locally: their submit results
+are made up without sending them, with `submit` 'fail' and the status
+the gateway would have given.
+
+For every message the planner
+
+-   normalises the msisdn to the international format, +27..., numbers
+    that still aren't valid are rejected with 911,
+-   works out if the message fits the basic GSM 7-bit alphabet or needs
+    UCS-2 and how many SMS segments it takes. The extension characters
+    {}[]~|€^\\ and form feed take an escape for plain smstype 0 text
+    that the gateway doesn't document, messages with them need UCS-2,
+-   hex encodes messages that need UCS-2 as smstype 64, as well as
+    smstype 64 messages that aren't hex yet, and rejects hex bodies that
+    aren't whole UCS-2 characters, 4 hex digits each, with 91,
+-   rejects empty messages and messages over `max_length` characters, or
+    over `max_segments` segments, with 91.
+
+Messages are only copied when they're changed. The checks use regular
+expressions and string methods so large batches don't spend long here.
+"""
+import re
+
+from foneworx.schema import Status
+
+GSM7, UCS2 = 'gsm7', 'ucs2'
+
+GSM_BASIC = (u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789'
+                u':;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvw'
+                u'xyzäöñüà')
+
+NOT_GSM = re.compile(u'[^%s]' % re.escape(GSM_BASIC))
+# ASCII text in the GSM alphabet is checked without decoding it
+NOT_GSM_ASCII = re.compile('[^%s]' % re.escape(''.join(
+                    chr(code) for code in range(128)
+                    if unichr(code) in GSM_BASIC)))
+HEX = re.compile(r'^(?:[0-9A-Fa-f]{2})+$')
+# separators people write numbers with
+SEPARATORS = re.compile(r'[\s\-.()/]')
+
+def decode_text(message):
+    if isinstance(message, unicode):
+        return message
+    try:
+        return message.decode('ascii')
+    except UnicodeDecodeError:
+        return message.decode('utf-8')
+
+def segments(text):
+    """
+    Returns the encoding & the number of segments of a text
+    """
+    text = decode_text(text)
+    if NOT_GSM.search(text) is None:
+        return GSM7, gsm7_segments(text)
+    return UCS2, ucs2_segments(len(text.encode('utf-16-be')) // 2)
+
+def gsm7_segments(text):
+    if len(text) <= 160:
+        return 1
+    return -(-len(text) // 153)
+
+def ucs2_segments(units):
+    if units <= 70:
+        return 1
+    return -(-units // 67)
+
+def hex_units(message):
+    """
+    The number of UCS-2 characters of a hex encoded message, None if it
+    isn't whole characters of 4 hex digits
+    """
+    if len(message) % 4:
+        return None
+    return len(message) // 4
+
+def hex_segments(message):
+    """The number of segments of a hex encoded UCS-2 message"""
+    units = hex_units(message)
+    if units is None:
+        raise ValueError("hex encoded UCS-2 takes 4 digits per character, "
+                            "not %s digits" % len(message))
+    return ucs2_segments(units)
+
+
+class Plan(object):
+    """
+    The outcome of planning a batch. `messages` are the ones to send, at
+    `indices` in the batch, `rejected` are (index, submit result) tuples.
+    `segments` is the total number of segments of the messages to send.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.messages = []
+        self.indices = []
+        self.rejected = []
+        self.segments = 0
+
+    def merge(self, results, decode):
+        """
+        The results of the sent messages & of the rejected ones, decoded
+        with `decode`, in the order of the batch
+        """
+        merged = [None] * self.total
+        for index, result in zip(self.indices, results):
+            merged[index] = result
+        for index, result in self.rejected:
+            merged[index] = decode(result)
+        return merged
+
+    def map_failures(self, failures):
+        """
+        The (offset, messages, failure) tuples of failed chunks of the sent
+        messages, with offsets in the batch. Rejected messages can sit
+        between the messages of a chunk, so it's split into runs that are
+        contiguous in the batch.
+        """
+        mapped = []
+        for offset, chunk, failure in failures:
+            indices = self.indices[offset:offset + len(chunk)]
+            start = 0
+            for end in range(1, len(chunk) + 1):
+                if end == len(chunk) or indices[end] != indices[end - 1] + 1:
+                    mapped.append((indices[start], chunk[start:end], failure))
+                    start = end
+        return mapped
+
+
+class Planner(object):
+    """
+    Arguments:
+
+    country_code -- the country national numbers (0...) are in
+    max_length --   the maximum number of characters of a message
+    max_segments -- the maximum number of segments of a message, None for
+                    no limit
+    auto_encode --  send messages outside of the GSM alphabet as hex
+                    encoded UCS-2 with smstype 64
+    """
+
+    # the number of digits after the country code, for the countries
+    # where it's fixed
+    national_lengths = {'27': 9}
+
+    def __init__(self, country_code='27', max_length=480, max_segments=None,
+                    auto_encode=True):
+        self.country_code = country_code
+        self.max_length = max_length
+        self.max_segments = max_segments
+        self.auto_encode = auto_encode
+        # numbers that are valid as they are, checked with a single match
+        national = ['%s[0-9]{%s}' % (code, length)
+                    for code, length in self.national_lengths.items()]
+        others = ''.join('(?!%s)' % code for code in self.national_lengths)
+        self.valid = re.compile(r'^\+(?:%s)$' % '|'.join(
+                                    national + [others + '[1-9][0-9]{7,14}']))
+
+    def normalise_msisdn(self, msisdn):
+        """
+        Returns the number in international format, None if it isn't a
+        valid number
+        """
+        if msisdn is None or self.valid.match(msisdn):
+            return msisdn
+        number = SEPARATORS.sub('', msisdn)
+        if number.startswith('+'):
+            pass
+        elif number.startswith('00'):
+            number = '+' + number[2:]
+        elif number.startswith('0'):
+            number = '+' + self.country_code + number[1:]
+        elif number.startswith(self.country_code):
+            number = '+' + number
+        else:
+            return None
+        if self.valid.match(number):
+            return number
+
+    def normalise_msisdns(self, msisdns):
+        """Normalise the ~ delimited numbers, None if any isn't valid"""
+        if msisdns is None:
+            return None
+        if '~' not in msisdns:
+            return self.normalise_msisdn(msisdns)
+        normalised = [self.normalise_msisdn(msisdn)
+                        for msisdn in msisdns.split('~')]
+        if None in normalised:
+            return None
+        return '~'.join(normalised)
+
+    def reject(self, message, status_id):
+        result = dict(message)
+        result.update({
+            'submit': 'fail',
+            'sms_id': '',
+            'status_id': str(status_id),
+            'status_text': Status.values[status_id],
+        })
+        return result
+
+    def check(self, message):
+        """
+        Returns the message ready to be sent & its number of segments, or
+        the submit result & None if it's rejected
+        """
+        changes = {}
+        msisdn = message.get('msisdn')
+        normalised = self.normalise_msisdns(msisdn)
+        if normalised is None:
+            return self.reject(message, 911), None
+        if normalised != msisdn:
+            changes['msisdn'] = normalised
+        body = message.get('message')
+        if not body:
+            return self.reject(message, 91), None
+        smstype = str(message.get('smstype') or '0')
+        if smstype == '64' and HEX.match(body):
+            length = hex_units(body)
+            if length is None:
+                return self.reject(message, 91), None
+            count = ucs2_segments(length)
+        else:
+            if isinstance(body, str) and NOT_GSM_ASCII.search(body) is None:
+                text, encoding, count = body, GSM7, gsm7_segments(body)
+            else:
+                text = decode_text(body)
+                encoding, count = segments(text)
+            length = len(text)
+            if smstype == '64' or (encoding == UCS2 and self.auto_encode):
+                hex_body = decode_text(text).encode('utf-16-be') \
+                                .encode('hex').upper()
+                changes.update({'message': hex_body, 'smstype': '64'})
+                count = hex_segments(hex_body)
+        if length > self.max_length or \
+                (self.max_segments and count > self.max_segments):
+            return self.reject(message, 91), None
+        if changes:
+            message = dict(message, **changes)
+        return message, count
+
+    def plan(self, messages):
+        """Check a batch of messages, returns a Plan"""
+        plan = Plan(len(messages))
+        check = self.check
+        for index, message in enumerate(messages):
+            message, count = check(message)
+            if count is None:
+                plan.rejected.append((index, message))
+            else:
+                plan.messages.append(message)
+                plan.indices.append(index)
+                plan.segments += count
+        return plan
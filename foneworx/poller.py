@@ -0,0 +1,231 @@
+"""
+Polls the gateway for new messages and hands them to a consumer.
+
+The interval adapts to the traffic, while messages keep arriving the
+gateway is polled again after `min_interval` seconds, when it answers
+"No New Messages" the interval doubles up to `max_interval`. Messages are
+deleted from the gateway in bulk once the consumer has handled them, and the
+time received of the oldest unhandled message is kept as a watermark so
+nothing is lost across restarts. With a ClientPool as the client the
+watermark only moves once every account has been read.
+
+::
+
+    def consume(message):
+        print message['msisdn'], message['message']
+
+    poller = Poller(client, consume, state_file='poller.state')
+    poller.startService()
+"""
+import os
+from datetime import datetime
+
+from twisted.application.service import Service
+from twisted.internet.defer import Deferred, DeferredList, DeferredSemaphore, \
+                                    maybeDeferred, inlineCallbacks, returnValue, \
+                                    succeed
+from twisted.internet import reactor
+from twisted.python import log
+
+from foneworx.errors import PartialDeleteError, PartialFetchError
+
+class Poller(Service):
+    """
+    Arguments:
+
+    client --       the Client to poll with
+    consumer --     called with every new message, if it returns a Deferred
+                    the message is acknowledged once it fires, failures
+                    leave the message on the gateway to be redelivered
+    min_interval -- seconds between polls while messages are arriving
+    max_interval -- upper bound of the interval when idle
+    backoff --      factor the interval grows by after an empty poll
+    concurrency --  maximum number of messages consumed in parallel
+    since --        datetime to start polling from, if there's no state
+    state_file --   file the watermark is kept in across restarts
+    dedupe --       a Deduplicator, messages it has seen are acknowledged
+                    without being consumed again
+    save_interval -- minimum seconds between saves of the Deduplicator's
+                    state, it's also saved when the service stops
+    """
+
+    timestamp_format = '%Y%m%d%H%M%S'
+
+    def __init__(self, client, consumer, min_interval=1, max_interval=60,
+                    backoff=2, concurrency=4, since=None, state_file=None,
+                    dedupe=None, save_interval=60, clock=reactor):
+        self.client = client
+        self.consumer = consumer
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.semaphore = DeferredSemaphore(concurrency)
+        self.state_file = state_file
+        self.dedupe = dedupe
+        self.save_interval = save_interval
+        self.clock = clock
+        self.dedupe_saved = clock.seconds()
+        self.since = self.load_watermark() or since
+        self.interval = min_interval
+        self.delayed_call = None
+        self.polling = None
+        self.polls = 0
+        self.consumed = 0
+        self.failed = 0
+        self.duplicates = 0
+
+    def load_watermark(self):
+        if self.state_file and os.path.exists(self.state_file):
+            value = open(self.state_file).read().strip()
+            if value:
+                return datetime.strptime(value, self.timestamp_format)
+
+    def save_watermark(self):
+        if not self.state_file or not self.since:
+            return
+        # write & rename so a crash never leaves a truncated file behind
+        temporary = '%s.tmp' % self.state_file
+        state = open(temporary, 'w')
+        state.write(self.since.strftime(self.timestamp_format))
+        state.close()
+        os.rename(temporary, self.state_file)
+
+    def save_dedupe(self, force=False):
+        """Save the Deduplicator's state if `save_interval` has passed"""
+        if self.dedupe is None:
+            return
+        now = self.clock.seconds()
+        if force or now - self.dedupe_saved >= self.save_interval:
+            self.dedupe.save()
+            self.dedupe_saved = now
+
+    def startService(self):
+        Service.startService(self)
+        self.schedule(0)
+
+    def stopService(self):
+        """
+        Stop polling, returns a Deferred that fires once the current poll
+        and its messages have been handled and the state is saved
+        """
+        Service.stopService(self)
+        if self.delayed_call and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+        if self.polling:
+            d = Deferred()
+            self.polling.addBoth(lambda _: d.callback(None))
+        else:
+            d = succeed(None)
+        return d.addCallback(lambda _: self.save_dedupe(force=True))
+
+    def schedule(self, delay):
+        if self.running:
+            self.delayed_call = self.clock.callLater(delay, self.poll)
+
+    def poll(self):
+        self.delayed_call = None
+        self.polling = self.poll_once()
+        self.polling.addCallbacks(self.polled, self.poll_failed)
+
+    def polled(self, handled):
+        self.polling = None
+        # messages that keep failing don't keep the interval down
+        if handled:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+        self.schedule(self.interval)
+
+    def poll_failed(self, failure):
+        log.err(failure, "Polling for new messages failed")
+        self.polling = None
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+        self.schedule(self.interval)
+
+    @inlineCallbacks
+    def poll_once(self):
+        """
+        Fetch new messages & consume them, returns a Deferred that fires
+        with the number of messages handled once all have been consumed
+        """
+        self.polls += 1
+        handled, unhandled = [], []
+        def consume_batch(messages):
+            d = DeferredList([self.semaphore.run(self.consume, message)
+                                for message in messages], consumeErrors=True)
+            d.addCallback(self.acknowledge, messages, handled, unhandled)
+            return d
+        try:
+            yield self.client.stream_new_messages(consume_batch,
+                                                    since=self.since)
+        except PartialFetchError, e:
+            # the failed accounts of a ClientPool can hold messages older
+            # than the ones handled, the watermark stays for them
+            log.msg("Not moving the watermark: %s" % e)
+        else:
+            self.advance(handled, unhandled)
+        self.save_watermark()
+        self.save_dedupe()
+        returnValue(len(handled))
+
+    def consume(self, message):
+        if self.dedupe is not None:
+            d = self.dedupe.handle(message, self.consumer)
+            d.addCallback(self.deduplicated)
+        else:
+            d = maybeDeferred(self.consumer, message)
+        d.addErrback(self.consume_failed, message)
+        return d
+
+    def deduplicated(self, handled):
+        if not handled:
+            self.duplicates += 1
+
+    def consume_failed(self, failure, message):
+        log.err(failure, "Consumer failed for %s" % message.get('sms_id'))
+        self.failed += 1
+        return failure
+
+    @inlineCallbacks
+    def acknowledge(self, results, messages, handled, unhandled):
+        """
+        Delete the consumed messages of a batch in bulk
+        """
+        consumed = []
+        for message, (success, result) in zip(messages, results):
+            if success:
+                consumed.append(message)
+            else:
+                unhandled.append(message)
+        if not consumed:
+            return
+        self.consumed += len(consumed)
+        try:
+            yield self.client.delete_messages(
+                [message['sms_id'] for message in consumed])
+        except PartialDeleteError, e:
+            # these are consumed again when they're redelivered
+            log.msg(str(e))
+            for message in consumed:
+                if message['sms_id'] in e.failures:
+                    unhandled.append(message)
+                else:
+                    handled.append(message)
+        else:
+            handled.extend(consumed)
+
+    def advance(self, handled, unhandled):
+        """
+        Move the watermark up to the oldest message that hasn't been
+        handled, or past all handled messages if there are none.
+        """
+        if unhandled:
+            since = min(message['timereceived'] for message in unhandled)
+        elif handled:
+            since = max(message['timereceived'] for message in handled)
+        else:
+            return
+        if not self.since or since > self.since:
+            self.since = since
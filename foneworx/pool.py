@@ -0,0 +1,110 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import ClientCreator
+from twisted.internet import reactor
+from twisted.python import log
+from foneworx.protocol import FoneworxProtocol
+
+class ConnectionPool(object):
+    """
+    A pool of FoneworxProtocol connections to a single gateway endpoint.
+
+    At most `size` connections are open at any given time, requests
+    beyond that wait until a connection is released. Released connections
+    are kept around for `idle_timeout` seconds for reuse before being closed.
+    Connections closed by the server are never handed out again, if the
+    server closes every connection after a response the pool degrades to
+    connect-per-request.
+    """
+
+    def __init__(self, hostname, port, size=4, idle_timeout=60,
+                    clock=reactor, protocol=FoneworxProtocol):
+        self.hostname = hostname
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.creator = ClientCreator(clock, protocol)
+        self.active = 0 # connections handed out or being connected
+        self.idle = [] # (protocol, delayed call) tuples, most recent last
+        self.waiting = []
+        self.connections_made = 0
+
+    def acquire(self):
+        """
+        Returns a Deferred that fires with a connected protocol once
+        one is available. Every acquired protocol must be released.
+        Cancelling the Deferred gives up the place in the queue, if a
+        connection is being made for it it's kept for reuse.
+        """
+        deferred = Deferred(self.cancel_waiting)
+        self.waiting.append(deferred)
+        self.process()
+        return deferred
+
+    def cancel_waiting(self, deferred):
+        if deferred in self.waiting:
+            self.waiting.remove(deferred)
+
+    def release(self, protocol):
+        """
+        Return a protocol to the pool, it is kept for reuse if it is still
+        connected and not waiting for a response.
+        """
+        self.active -= 1
+        if protocol.connected and not protocol.onXMLReceived:
+            timeout = self.clock.callLater(self.idle_timeout, self.expire,
+                                            protocol)
+            self.idle.append((protocol, timeout))
+        elif protocol.connected:
+            protocol.transport.loseConnection()
+        self.process()
+
+    def expire(self, protocol):
+        for entry in self.idle:
+            if entry[0] is protocol:
+                self.idle.remove(entry)
+                break
+        log.msg("Closing idle connection to %s:%s" % (self.hostname, self.port))
+        protocol.transport.loseConnection()
+
+    def close(self):
+        """Close all idle connections"""
+        while self.idle:
+            protocol, timeout = self.idle.pop()
+            timeout.cancel()
+            if protocol.connected:
+                protocol.transport.loseConnection()
+
+    def get_idle(self):
+        while self.idle:
+            protocol, timeout = self.idle.pop()
+            timeout.cancel()
+            if protocol.connected:
+                return protocol
+
+    def process(self):
+        while self.waiting:
+            protocol = self.get_idle()
+            if protocol:
+                self.active += 1
+                self.waiting.pop(0).callback(protocol)
+            elif self.active < self.size:
+                self.active += 1
+                self.connect(self.waiting.pop(0))
+            else:
+                break
+
+    def connect(self, deferred):
+        def connection_made(protocol):
+            self.connections_made += 1
+            if deferred.called: # cancelled while connecting
+                self.release(protocol)
+            else:
+                deferred.callback(protocol)
+        def connection_failed(failure):
+            self.active -= 1
+            if not deferred.called:
+                deferred.errback(failure)
+            self.process()
+        d = self.creator.connectTCP(self.hostname, self.port)
+        d.addCallbacks(connection_made, connection_failed)
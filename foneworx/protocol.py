@@ -1,71 +1,208 @@
+from time import time
+
 from twisted.python import log
-from twisted.python.log import logging
 from twisted.protocols.basic import LineReceiver
 from twisted.internet import error
 from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
-from foneworx.errors import FoneworxException
+from foneworx.errors import FoneworxException, ApiException
+from foneworx.trace import tracer
 from foneworx.utils import *
 
 class FoneworxProtocol(LineReceiver):
+    """
+    Each request & response is terminated by the delimiter, which allows
+    a single connection to carry many request / response exchanges. If the
+    server closes the connection instead then whatever has been received
+    up to that point is treated as the response.
+    
+    Responses are parsed incrementally as the data arrives, the Deferred
+    returned by `send_xml` fires with the response dictionary.
+    
+    Cancelling the Deferred of a pending request aborts the connection,
+    the rest of its response can't be told apart from the next one.
+    
+    If the `on_record` callback returns a Deferred reading from the 
+    connection is paused until it fires, records already received are
+    still passed on.
+    
+    If `sendLine` is given a `timings` dictionary the times the request
+    was written and the first byte of the response arrived are added to
+    it, along with the seconds spent parsing, the bytes received and the
+    number of records.
+    """
     
     delimiter = chr(0)
     
     def __init__(self):
         self.onXMLReceived = None
         self.setRawMode()
-        self.buffer = ''
+        self.parser = None
+        self.received = 0 # bytes received for the current response
+        self.responses = 0
+        self.timings = None
+        self.pauses = set() # Deferreds returned by on_record
     
     def rawDataReceived(self, data):
-        log.msg("Received raw data: %s" % data, logLevel=logging.DEBUG)
-        self.buffer += data
+        tracer.received(data)
+        tracer.trace("Received raw data: %s", data)
+        try:
+            while data:
+                response, delimiter, data = data.partition(self.delimiter)
+                if response:
+                    self.parse(response)
+                if delimiter:
+                    self.xml_received()
+        except Exception:
+            if not self.onXMLReceived:
+                raise
+            # the response is malformed, the connection can't be trusted
+            self.transport.loseConnection()
+            self.reset().errback()
+    
+    def parse(self, data):
+        if not self.parser:
+            raise FoneworxException, "Received data without a pending request"
+        self.received += len(data)
+        timings = self.timings
+        if timings is None:
+            self.parser.feed(data)
+            return
+        start = time()
+        if 'first_byte' not in timings:
+            timings['first_byte'] = start
+        self.parser.feed(data)
+        timings['parse'] += time() - start
+    
+    def reset(self):
+        deferred, self.onXMLReceived = self.onXMLReceived, None
+        self.parser = None
+        self.received = 0
+        self.timings = None
+        if self.pauses:
+            self.pauses.clear()
+            self.resume()
+        return deferred
     
-    def xml_received(self, data):
+    def xml_received(self):
         if not self.onXMLReceived:
             raise FoneworxException, "onXMLReceived not initialized for receiving"
-        self.onXMLReceived.callback(data)
-        self.onXMLReceived = None # reset
-        self.buffer = '' # reset
+        parser = self.parser
+        timings = self.timings
+        received = self.received
+        deferred = self.reset()
+        self.responses += 1
+        try:
+            if timings is not None:
+                start = time()
+                response = parser.close()
+                timings['parse'] += time() - start
+                timings['bytes_in'] = received
+                timings['records'] = parser.records
+            else:
+                response = parser.close()
+        except Exception:
+            deferred.errback()
+        else:
+            deferred.callback(response)
     
     def lineLengthExceeded(self, line):
         log.err("Line length exceeded!")
         log.err(line)
     
-    def send_xml(self, xml):
-        return self.sendLine("""<?xml version="1.0" encoding="utf-8"?>%s""" \
-                                % tostring(xml))
+    def send_xml(self, xml, on_record=None):
+        return self.sendLine(XML_DECLARATION + tostring(xml), on_record)
     
-    def sendLine(self, line):
+    def sendLine(self, line, on_record=None, timings=None):
         if self.onXMLReceived:
             raise FoneworxException, "onXMLReceived already initialized before sending"
-        self.onXMLReceived = Deferred()
-        log.msg("Sending line: %s" % line, logLevel=logging.DEBUG)
-        LineReceiver.sendLine(self, line)
+        self.onXMLReceived = Deferred(self.cancel_request)
+        if on_record:
+            on_record = self.paced(on_record)
+        if timings is not None:
+            timings['parse'] = 0
+            if on_record:
+                on_record = self.timed(on_record, timings)
+        self.timings = timings
+        self.parser = ResponseParser(on_record)
+        tracer.sent(line)
+        tracer.trace("Sending line: %s", line)
+        # avoid copying large requests just to append the delimiter
+        self.transport.writeSequence((line, self.delimiter))
+        if timings is not None:
+            timings['sent'] = time()
         return self.onXMLReceived
     
+    def cancel_request(self, deferred):
+        self.reset()
+        # the connection can't be reused, the pool checks `connected`
+        self.connected = 0
+        abort = getattr(self.transport, 'abortConnection',
+                        self.transport.loseConnection)
+        abort()
+    
+    def paced(self, on_record):
+        """
+        Wraps the record callback so reading is paused while a Deferred
+        it returns hasn't fired
+        """
+        def paced_on_record(record):
+            result = on_record(record)
+            if isinstance(result, Deferred) and not result.called and \
+                    result not in self.pauses:
+                if not self.pauses:
+                    self.transport.pauseProducing()
+                self.pauses.add(result)
+                result.addBoth(self.unpause, result)
+        return paced_on_record
+    
+    def unpause(self, result, deferred):
+        if deferred in self.pauses:
+            self.pauses.remove(deferred)
+            if not self.pauses:
+                self.resume()
+        return result
+    
+    def resume(self):
+        if self.connected and not self.transport.disconnecting:
+            self.transport.resumeProducing()
+    
+    def timed(self, on_record, timings):
+        """
+        Wraps the record callback so the time spent in it isn't counted
+        as parsing
+        """
+        def timed_on_record(record):
+            start = time()
+            try:
+                return on_record(record)
+            finally:
+                timings['parse'] -= time() - start
+        return timed_on_record
+    
     def connectionLost(self, reason):
+        self.connected = 0
         if reason.check(error.ConnectionDone):
             log.msg("Connection closed, processing received data")
+        elif reason.check(error.ConnectionAborted):
+            log.msg("Connection aborted")
         else:
             log.err("Connection lost, reason: %s" % reason)
-        if self.buffer:
-            log.msg('calling xml_received with %s' % self.buffer, logLevel=logging.DEBUG)
-            self.xml_received(self.buffer)
+        if self.received:
+            tracer.debug('calling xml_received with %s bytes', self.received)
+            self.xml_received()
+        elif self.onXMLReceived:
+            self.reset().errback(reason)
     
     def connectionMade(self):
         log.msg("Connection made")
     
     @inlineCallbacks
-    def send(self, dictionary):
+    def send(self, dictionary, on_record=None):
         # reroute the remote calls to local calls for testing
-        sent_xml = dict_to_xml(dictionary, Element("sms_api"))
-        log.msg("Sending XML: %s" % tostring(sent_xml), logLevel=logging.DEBUG)
-        received_xml = yield self.send_xml(sent_xml)
-        xml = fromstring(received_xml)
-        log.msg("Received XML: %s" % tostring(xml), logLevel=logging.DEBUG)
-        sms_api, response = xml_to_dict(xml)
-        log.msg("Received Dict: %s" % response, logLevel=logging.DEBUG)
+        request = serialize_request(dictionary)
+        response = yield self.sendLine(request, on_record)
+        tracer.debug("Received Dict: %s", response)
         # if at any point, we get this error something went wrong
         if response.get('error_type'):
-            raise ApiException(response['error_type'], tostring(xml))
+            raise ApiException(response['error_type'], response)
         returnValue(response)
-        
@@ -0,0 +1,401 @@
+from datetime import datetime
+
+class Status(object):
+    """
+    Delivery status of a sent message. Instances are interned, all
+    statuses with the same id are the same object.
+    """
+    values = {
+        0: "To Be Sent",
+        1: "Submitted To Network",
+        2: "At Network",
+        3: "Delivered",
+        4: "Rejected",
+        5: "Undelivered",
+        6: "Expired",
+        9: "Submit Failed",
+        10: "Cancelled",
+        11: "Scheduled",
+        91: "Message Length is Invalid",
+        911: "Desitnation Addr Is Invalid",
+        988: "Throttling Error",
+    }
+
+    _instances = {}
+
+    def __new__(cls, status_id):
+        try:
+            return cls._instances[status_id]
+        except KeyError:
+            return cls._instances.setdefault(status_id, 
+                                                object.__new__(cls))
+
+    def __init__(self, status_id):
+        self.status_id = status_id
+
+    def __reduce__(self):
+        return (Status, (self.status_id,))
+
+    def __eq__(self, other):
+        if isinstance(other, Status):
+            return other.id == self.id
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def id(self):
+        return self.status_id
+
+    @property
+    def text(self):
+        return self.values.get(int(self.id), 'Unknown status')
+
+    def __repr__(self):
+        return "<Status id: %s, msg: %s>" % (self.id, self.text)
+
+
+def parse_timestamp(string):
+    """
+    Parse a YYYYMMDDHHMMSS timestamp, same as strptime with
+    '%Y%m%d%H%M%S' but without the overhead for the common case.
+    """
+    if len(string) == 14 and string.isdigit():
+        return datetime(int(string[0:4]), int(string[4:6]),
+                        int(string[6:8]), int(string[8:10]),
+                        int(string[10:12]), int(string[12:14]))
+    return datetime.strptime(string, '%Y%m%d%H%M%S')
+
+
+# converters applied to a field with the given (lowercase) name regardless
+# of the type of response it is in
+converters = {
+    'datetime': parse_timestamp,
+    'time_submitted': parse_timestamp,
+    'time_processed': parse_timestamp,
+    'timereceived': parse_timestamp,
+    'status_id': Status,
+}
+
+class Field(object):
+    """
+    A field in a response record, `convert` turns the string value into
+    a Python value. Lazy fields are only converted when they're accessed.
+    """
+    def __init__(self, name, convert=None, lazy=False):
+        self.name = name
+        self.convert = convert
+        self.lazy = lazy
+
+new_message_fields = [
+    Field('sms_id'),
+    Field('msisdn'),
+    Field('message'),
+    Field('destination'),
+    Field('timereceived', parse_timestamp),
+    Field('parent_sms_id'),
+]
+
+sent_message_fields = [
+    Field('sms_id'),
+    Field('status_id', Status),
+    Field('status_text'),
+    Field('time_submitted', parse_timestamp),
+    Field('time_processed', parse_timestamp),
+    Field('rule'),
+    Field('short_message'),
+    Field('destination_addr'),
+]
+
+submit_result_fields = [
+    Field('msisdn'),
+    Field('message'),
+    Field('source_addr'),
+    Field('sentby'),
+    Field('smstype'),
+    Field('submit'),
+    Field('sms_id'),
+]
+
+
+class Record(object):
+    """
+    Compact record type with dictionary style access. Subclasses list
+    their fields in `__slots__`, keys outside of those are kept in the
+    `extra` dictionary.
+    """
+    __slots__ = ('extra',)
+
+    def __init__(self, values=None):
+        self.extra = None
+        if values:
+            for key, value in values.iteritems():
+                self[key] = value
+
+    def __setitem__(self, key, value):
+        if key in self.__slots__:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def keys(self):
+        keys = [key for key in self.__slots__ if hasattr(self, key)]
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [value for key, value in self.iteritems()]
+
+    def as_dict(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.as_dict() == dict(other.iteritems())
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (self.__class__, (self.as_dict(),))
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.as_dict())
+
+class InboundMessage(Record):
+    """A message received with newmessages"""
+    __slots__ = tuple(field.name for field in new_message_fields)
+
+class SentStatus(Record):
+    """A status update for a sent message, from sentmessages"""
+    __slots__ = tuple(field.name for field in sent_message_fields)
+
+class SubmitResult(Record):
+    """The result of submitting a message with sendmessages"""
+    __slots__ = tuple(field.name for field in submit_result_fields)
+
+
+class LazyRecord(object):
+    """
+    Dictionary of which some values are converted when first accessed.
+
+    It isn't a dict subclass, `dict(record)`, `**record` and `update` would
+    copy a subclass's raw values without going through `__getitem__`.
+    Copies & comparisons get the converted values.
+    """
+
+    def __init__(self, values, pending):
+        self.data = values
+        self.pending = pending
+
+    def resolve(self, key):
+        value = self.pending.pop(key)(self.data[key])
+        self.data[key] = value
+        return value
+
+    def resolve_all(self):
+        for key in self.pending.keys():
+            self.resolve(key)
+
+    def __getitem__(self, key):
+        if key in self.pending:
+            return self.resolve(key)
+        return self.data[key]
+
+    def get(self, key, default=None):
+        if key in self.data:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        self.pending.pop(key, None)
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        self.pending.pop(key, None)
+        del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    has_key = __contains__
+
+    def keys(self):
+        return self.data.keys()
+
+    def __iter__(self):
+        return iter(self.data)
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.data)
+
+    def as_dict(self):
+        self.resolve_all()
+        return dict(self.data)
+
+    copy = as_dict
+
+    def __eq__(self, other):
+        if isinstance(other, LazyRecord):
+            other = other.as_dict()
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def _resolved(method):
+        def wrapper(self, *args, **kwargs):
+            self.resolve_all()
+            return getattr(self.data, method)(*args, **kwargs)
+        wrapper.__name__ = method
+        return wrapper
+
+    items = _resolved('items')
+    iteritems = _resolved('iteritems')
+    values = _resolved('values')
+    itervalues = _resolved('itervalues')
+    pop = _resolved('pop')
+    popitem = _resolved('popitem')
+    setdefault = _resolved('setdefault')
+    clear = _resolved('clear')
+    del _resolved
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+
+class Decoder(object):
+    """
+    Converts response records to Python values.
+
+    Built once per type of response from its field schema, the converter
+    for every key is looked up in a table instead of being dispatched per
+    key. Keys not in the schema get the generic converters. The names in
+    `lazy` are converted on first access, in addition to lazy fields.
+    
+    If a `record_type` is given the records are returned as instances of
+    it instead of dictionaries, these are always converted eagerly.
+    """
+
+    def __init__(self, fields=(), lazy=(), record_type=None):
+        self.fields = fields
+        self.record_type = record_type
+        self.table = {}
+        self.lazy = set(lazy)
+        for field in fields:
+            self.table[field.name] = field.convert
+            if field.lazy and not record_type:
+                self.lazy.add(field.name)
+        if self.lazy and record_type:
+            raise ValueError("Lazy fields aren't supported for record types")
+
+    def resolve(self, key):
+        lookup = key.lower()
+        for field in self.fields:
+            if field.name == lookup:
+                convert = field.convert
+                break
+        else:
+            convert = converters.get(lookup)
+        self.table[key] = convert
+        return convert
+
+    def decode(self, record):
+        table = self.table
+        lazy = self.lazy
+        result = {}
+        pending = None
+        for key, value in record.iteritems():
+            try:
+                convert = table[key]
+            except KeyError:
+                convert = self.resolve(key)
+            if convert is not None:
+                if key in lazy:
+                    if pending is None:
+                        pending = {}
+                    pending[key] = convert
+                else:
+                    value = convert(value)
+            result[key] = value
+        if pending:
+            return LazyRecord(result, pending)
+        if self.record_type:
+            return self.record_type(result)
+        return result
+
+
+def response_decoders(record_types=False):
+    """
+    The Decoders per api_action used by the clients, None is the generic
+    decoder. With `record_types` set records are decoded to 
+    InboundMessage, SentStatus and SubmitResult instances.
+    """
+    return {
+        None: Decoder(),
+        'newmessages': Decoder(new_message_fields,
+            record_type=record_types and InboundMessage or None),
+        'sentmessages': Decoder(sent_message_fields,
+            record_type=record_types and SentStatus or None),
+        'sendmessages': Decoder(submit_result_fields,
+            record_type=record_types and SubmitResult or None),
+    }
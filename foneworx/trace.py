@@ -0,0 +1,131 @@
+"""
+Tracing of requests, responses & the raw data on the wire.
+
+Trace messages are only formatted when their level is enabled, so
+leaving the calls in hot paths costs a method call and a comparison.
+Tracing is off until it's configured::
+
+    from foneworx import trace
+    trace.configure(level=trace.DEBUG, sample_rate=0.01,
+                    capture_file='wire.log', max_capture_bytes=10 * 2 ** 20)
+
+Messages are logged through twisted.python.log with their level as the
+`logLevel`. With a `sample_rate` below 1 only that fraction of the
+messages is logged. The wire capture writes every chunk of data sent &
+received to a file until it reaches `max_capture_bytes`.
+"""
+import sys, random
+from time import time
+
+from twisted.python import log
+
+# the same values as the logging module, TRACE is for raw wire data
+TRACE = 5
+DEBUG = 10
+INFO = 20
+DISABLED = sys.maxint
+
+class Lazy(object):
+    """
+    Calls `function` with the arguments when formatted, for trace
+    arguments that are expensive to compute
+    """
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+    __repr__ = __str__
+
+
+class WireCapture(object):
+    """
+    Writes the data sent & received to a file, at most `max_bytes` of it
+    """
+
+    def __init__(self, filename, max_bytes=10 * 2 ** 20):
+        self.file = open(filename, 'ab')
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.full = False
+
+    def write(self, direction, data):
+        """`direction` is '>' for sent data and '<' for received data"""
+        if self.full:
+            return
+        header = '%s %.6f %s\n' % (direction, time(), len(data))
+        size = len(header) + len(data) + 1
+        if self.written + size > self.max_bytes:
+            self.full = True
+            self.file.write('! capture limit of %s bytes reached\n' %
+                            self.max_bytes)
+            self.file.flush()
+            return
+        self.file.write(header)
+        self.file.write(data)
+        self.file.write('\n')
+        self.written += size
+
+    def close(self):
+        self.file.close()
+
+
+class Tracer(object):
+    """
+    Arguments:
+
+    level --        the lowest level logged, DISABLED logs nothing
+    sample_rate --  the fraction of messages logged
+    capture --      a WireCapture or None
+    """
+
+    def __init__(self, level=DISABLED, sample_rate=1.0, capture=None,
+                    seed=None):
+        self.level = level
+        self.sample_rate = sample_rate
+        self.capture = capture
+        self.random = random.Random(seed)
+
+    def enabled(self, level):
+        if level < self.level:
+            return False
+        return self.sample_rate >= 1 or self.random.random() < self.sample_rate
+
+    def msg(self, level, format, *args):
+        if level >= self.level and self.enabled(level):
+            log.msg(format % args, logLevel=level)
+
+    def trace(self, format, *args):
+        if TRACE >= self.level:
+            self.msg(TRACE, format, *args)
+
+    def debug(self, format, *args):
+        if DEBUG >= self.level:
+            self.msg(DEBUG, format, *args)
+
+    def sent(self, data):
+        if self.capture is not None:
+            self.capture.write('>', data)
+
+    def received(self, data):
+        if self.capture is not None:
+            self.capture.write('<', data)
+
+
+tracer = Tracer()
+
+def configure(level=DEBUG, sample_rate=1.0, capture_file=None,
+                max_capture_bytes=10 * 2 ** 20):
+    """Enable tracing for the whole package"""
+    if tracer.capture is not None:
+        tracer.capture.close()
+    tracer.level = level
+    tracer.sample_rate = sample_rate
+    tracer.capture = capture_file and WireCapture(capture_file,
+                                                    max_capture_bytes) or None
+
+def disable():
+    configure(level=DISABLED)
@@ -0,0 +1,209 @@
+"""
+Tracks the delivery status of sent messages.
+
+Register the sms_ids returned by send_messages and poll, the updates from
+sent_messages are applied incrementally from the last time processed
+onwards. Messages are indexed by sms_id, status & rule and callbacks are
+run when the status of a message changes.
+
+::
+
+    tracker = DeliveryTracker(client)
+    tracker.add_callback(lambda message, previous: ...)
+    results = yield client.send_messages(messages)
+    tracker.track_results(results, rule='campaign')
+    yield tracker.poll()
+    tracker.with_status(3) # the ids of delivered messages
+"""
+from collections import OrderedDict
+
+from twisted.internet.task import LoopingCall
+from twisted.internet import reactor
+from twisted.python import log
+
+class TrackedMessage(object):
+    """
+    The state of a tracked message, `status` is None until the first
+    update for it is received.
+    """
+    __slots__ = ('sms_id', 'rule', 'status', 'time_processed')
+
+    def __init__(self, sms_id, rule=None):
+        self.sms_id = sms_id
+        self.rule = rule
+        self.status = None
+        self.time_processed = None
+
+    @property
+    def status_id(self):
+        if self.status is not None:
+            return str(self.status.id)
+
+    def __repr__(self):
+        return "<TrackedMessage %s rule: %s, status: %s>" % (self.sms_id,
+                                                    self.rule, self.status)
+
+
+class DeliveryTracker(object):
+    """
+    Arguments:
+
+    client --       the Client to poll sent_messages with
+    max_final --    the number of messages in a final state to keep, the
+                    ones that reached it first are forgotten first
+    since --        datetime to poll updates from
+    """
+
+    # Delivered, Rejected, Undelivered, Expired, Submit Failed, Cancelled,
+    # invalid length or destination & throttled
+    final_statuses = frozenset(['3', '4', '5', '6', '9', '10', '91', '911',
+                                '988'])
+
+    def __init__(self, client=None, max_final=10000, since=None,
+                    clock=reactor):
+        self.client = client
+        self.max_final = max_final
+        self.since = since
+        self.clock = clock
+        self.messages = {}
+        self.by_status = {}
+        self.by_rule = {}
+        self.final = OrderedDict()
+        self.callbacks = []
+        self.looping_call = None
+        self.unknown = 0
+
+    def add_callback(self, callback):
+        """
+        Call `callback(message, previous_status)` when a message changes
+        status
+        """
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def track(self, sms_id, rule=None):
+        if sms_id in self.messages:
+            return self.messages[sms_id]
+        message = self.messages[sms_id] = TrackedMessage(sms_id, rule)
+        self.index(self.by_status, None, sms_id)
+        if rule:
+            self.index(self.by_rule, rule, sms_id)
+        return message
+
+    def track_results(self, results, rule=None):
+        """
+        Track the messages that were submitted successfully, given the
+        results of send_messages. The gateway reports 'Success', the fake
+        gateway 'success'.
+        """
+        for result in results:
+            if result and result.get('sms_id') and \
+                    (result.get('submit') or '').lower() == 'success':
+                self.track(result['sms_id'], result.get('rule') or rule)
+
+    def get(self, sms_id):
+        return self.messages.get(sms_id)
+
+    def __contains__(self, sms_id):
+        return sms_id in self.messages
+
+    def __len__(self):
+        return len(self.messages)
+
+    def with_status(self, status_id):
+        """The ids of the messages with the given status, None for pending"""
+        if status_id is not None:
+            status_id = str(status_id)
+        return self.by_status.get(status_id, set())
+
+    def with_rule(self, rule):
+        return self.by_rule.get(rule, set())
+
+    def index(self, index, key, sms_id):
+        index.setdefault(key, set()).add(sms_id)
+
+    def unindex(self, index, key, sms_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(sms_id)
+            if not ids:
+                del index[key]
+
+    def update(self, record):
+        """
+        Apply a sent_messages record, returns the tracked message or None
+        if it isn't tracked
+        """
+        sms_id = record.get('sms_id')
+        message = self.messages.get(sms_id)
+        if message is None:
+            self.unknown += 1
+            return
+        rule = record.get('rule')
+        if rule and rule != message.rule:
+            if message.rule:
+                self.unindex(self.by_rule, message.rule, sms_id)
+            message.rule = rule
+            self.index(self.by_rule, rule, sms_id)
+        message.time_processed = record.get('time_processed')
+        status = record.get('status_id')
+        if status is None or status == message.status:
+            return message
+        previous = message.status
+        self.unindex(self.by_status, message.status_id, sms_id)
+        message.status = status
+        self.index(self.by_status, message.status_id, sms_id)
+        if message.status_id in self.final_statuses:
+            self.finalize(sms_id)
+        for callback in self.callbacks:
+            try:
+                callback(message, previous)
+            except Exception:
+                log.err(None, "Status callback failed for %s" % sms_id)
+        return message
+
+    def update_batch(self, records):
+        for record in records:
+            self.update(record)
+            time_processed = record.get('time_processed')
+            if time_processed and (not self.since or
+                                    time_processed > self.since):
+                self.since = time_processed
+
+    def finalize(self, sms_id):
+        self.final[sms_id] = True
+        while len(self.final) > self.max_final:
+            self.forget(self.final.popitem(last=False)[0])
+
+    def forget(self, sms_id):
+        """Stop tracking a message"""
+        message = self.messages.pop(sms_id, None)
+        if message is None:
+            return
+        self.final.pop(sms_id, None)
+        self.unindex(self.by_status, message.status_id, sms_id)
+        if message.rule:
+            self.unindex(self.by_rule, message.rule, sms_id)
+
+    def poll(self):
+        """
+        Fetch the updates since the last one processed and apply them,
+        returns a Deferred that fires with the number of updates
+        """
+        return self.client.stream_sent_messages(self.update_batch,
+                                                since=self.since)
+
+    def start(self, interval):
+        """Poll every `interval` seconds"""
+        self.looping_call = LoopingCall(self.poll_logged)
+        self.looping_call.clock = self.clock
+        return self.looping_call.start(interval)
+
+    def poll_logged(self):
+        return self.poll().addErrback(log.err, "Polling for updates failed")
+
+    def stop(self):
+        if self.looping_call and self.looping_call.running:
+            self.looping_call.stop()
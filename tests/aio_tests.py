@@ -0,0 +1,176 @@
+from datetime import datetime
+from twisted.trial.unittest import TestCase, SkipTest
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet import threads
+
+from foneworx.errors import ApiException
+from foneworx.fakegateway import FakeGateway, FakeGatewayFactory
+from tests.pool_tests import LoginServerFactory, IdleCloseServerProtocol
+from tests.utils import GatewayTestMixin
+
+try:
+    from foneworx.aio import asyncio, AsyncConnection, AsyncClient, then, \
+                                ConnectionClosed
+except ImportError:
+    asyncio = None
+
+class AsyncClientTestCase(GatewayTestMixin, TestCase):
+    """
+    The fake gateway runs on the reactor, the asyncio client on its own
+    event loop in a thread
+    """
+
+    def setUp(self):
+        if asyncio is None:
+            raise SkipTest("trollius is required")
+        self.gateway = FakeGateway()
+        self.factory = FakeGatewayFactory(self.gateway)
+        host, port = self.listen(self.factory)
+        self.loop = asyncio.new_event_loop()
+        self.connection = AsyncConnection(host, port, loop=self.loop)
+        self.client = AsyncClient('username', 'password', self.connection)
+
+    @inlineCallbacks
+    def tearDown(self):
+        if asyncio is None:
+            return
+        yield self.run_loop(lambda: self.connection.close())
+        self.loop.close()
+
+    def run_loop(self, function):
+        """
+        Run `function` on the event loop in a thread, it returns a Future,
+        returns a Deferred for its result
+        """
+        def run():
+            future = function()
+            if future is None:
+                # give the closed transports a chance to clean up
+                future = asyncio.sleep(0, loop=self.loop)
+            return self.loop.run_until_complete(future)
+        return threads.deferToThread(run)
+
+    @inlineCallbacks
+    def test_full_stack(self):
+        received = yield self.run_loop(self.client.new_messages)
+        self.assertEquals(received, [])
+        self.gateway.receive('+27123456789', 'hello world')
+        [sms] = yield self.run_loop(self.client.new_messages)
+        self.assertEquals(sms['message'], 'hello world')
+        self.assertTrue(isinstance(sms['timereceived'], datetime))
+        [result] = yield self.run_loop(lambda: self.client.send_messages([{
+            'msisdn': sms['msisdn'],
+            'message': 'Hi! you said: %s' % sms['message'],
+        }]))
+        self.assertEquals(result['submit'], 'success')
+        [status] = yield self.run_loop(
+            lambda: self.client.sent_messages(give_detail=True))
+        self.assertEquals(status['sms_id'], result['sms_id'])
+        self.assertEquals(status['status_text'], 'Delivered')
+        deleted = yield self.run_loop(
+            lambda: self.client.delete_message(sms['sms_id']))
+        self.assertEquals(deleted, 'Success')
+        deleted = yield self.run_loop(
+            lambda: self.client.delete_sent_message(status['sms_id']))
+        self.assertEquals(deleted, None)
+        self.assertEquals(self.gateway.inbox, [])
+        self.assertEquals(len(self.factory.connections), 1)
+
+    @inlineCallbacks
+    def test_send_nothing(self):
+        results = yield self.run_loop(lambda: self.client.send_messages([]))
+        self.assertEquals(results, [])
+        self.assertEquals(self.gateway.requests, 0)
+
+    @inlineCallbacks
+    def test_concurrent_requests(self):
+        for i in range(5):
+            self.gateway.receive('+27123456789', 'message %s' % i)
+        def concurrent():
+            since = datetime(2000, 1, 1)
+            futures = [self.client.new_messages(since) for i in range(8)]
+            return asyncio.gather(*futures, loop=self.loop)
+        results = yield self.run_loop(concurrent)
+        self.assertEquals([len(messages) for messages in results], [5] * 8)
+        # a single login shared by all requests, over the pooled connections
+        self.assertEquals(self.gateway.requests, 9)
+        self.assertEquals(self.connection.pool.connections_made, 4)
+
+    @inlineCallbacks
+    def test_chunked_send_and_bulk_delete(self):
+        self.client.chunk_size = 2
+        results = yield self.run_loop(lambda: self.client.send_messages([
+            {'msisdn': '+27123456789', 'message': 'message %s' % i}
+            for i in range(5)]))
+        self.assertEquals([result['submit'] for result in results],
+                            ['success'] * 5)
+        for i in range(5):
+            self.gateway.receive('+27123456789', 'message %s' % i)
+        def delete():
+            return then(self.client.new_messages(),
+                        lambda messages: self.client.delete_messages(
+                            [sms['sms_id'] for sms in messages]))
+        changes = yield self.run_loop(delete)
+        self.assertEquals(changes.values(), ['Success'] * 5)
+        self.assertEquals(self.gateway.inbox, [])
+
+    @inlineCallbacks
+    def test_session_expiry(self):
+        yield self.run_loop(self.client.new_messages)
+        self.gateway.expire_sessions()
+        yield self.run_loop(self.client.new_messages)
+        self.assertEquals(self.gateway.requests, 5)
+
+    @inlineCallbacks
+    def test_throttling(self):
+        self.gateway.max_rate = 1
+        try:
+            yield self.run_loop(self.client.new_messages)
+        except ApiException:
+            pass
+        else:
+            self.fail("Expected an ApiException")
+
+    @inlineCallbacks
+    def test_close_after_response(self):
+        self.factory.close_after_response = True
+        self.factory.drip_bytes = 7
+        self.factory.drip_interval = 0
+        session_id = yield self.run_loop(self.client.login)
+        self.assertTrue(session_id)
+        session_id = yield self.run_loop(self.client.login)
+        self.assertTrue(session_id)
+
+    @inlineCallbacks
+    def test_closed_while_idle(self):
+        factory = LoginServerFactory()
+        factory.protocol = IdleCloseServerProtocol
+        host, port = self.listen(factory)
+        connection = AsyncConnection(host, port, pool_size=1, loop=self.loop)
+        self.addCleanup(self.run_loop, lambda: connection.close())
+        yield self.run_loop(lambda: connection.login())
+        # sent again on a new connection
+        response = yield self.run_loop(lambda: connection.login())
+        self.assertEquals(response['session_id'], 'my_session_id')
+        self.assertEquals(len(factory.connections), 2)
+        # the gateway may have received the messages, they aren't resent
+        try:
+            yield self.run_loop(lambda: connection.sendmessages(
+                api_sessionid='my_session_id',
+                action_content={'sms': [{'msisdn': '+27123456789',
+                                            'message': 'hi'}]}))
+        except ConnectionClosed:
+            pass
+        else:
+            self.fail("Expected a ConnectionClosed")
+        self.assertEquals(len(factory.connections), 2)
+        # nor are reads without a smstime
+        yield self.run_loop(lambda: connection.login())
+        try:
+            yield self.run_loop(lambda: connection.newmessages(
+                api_sessionid='my_session_id'))
+        except ConnectionClosed:
+            pass
+        else:
+            self.fail("Expected a ConnectionClosed")
+        self.assertEquals(len(factory.connections), 3)
@@ -0,0 +1,65 @@
+from twisted.trial.unittest import TestCase
+
+from foneworx.batches import is_session_error, can_repeat, check_results, \
+                                merge_chunks, merge_deletes, SENT_DELETED
+from foneworx.errors import FoneworxException, PartialSendError, \
+                            PartialDeleteError
+
+class BatchesTestCase(TestCase):
+
+    def test_is_session_error(self):
+        self.assertTrue(is_session_error('Invalid Session'))
+        self.assertFalse(is_session_error('Throttling Error'))
+        self.assertFalse(is_session_error(None))
+
+    def test_can_repeat(self):
+        self.assertTrue(can_repeat({'api_action': 'login'}))
+        self.assertFalse(can_repeat({'api_action': 'sendmessages'}))
+        self.assertFalse(can_repeat({'api_action': 'newmessages'}))
+        self.assertFalse(can_repeat({'api_action': 'newmessages',
+                                        'action_content': {}}))
+        self.assertTrue(can_repeat({'api_action': 'sentmessages',
+                                    'action_content': {
+                                        'smstime': '20120101000000'}}))
+
+    def test_check_results(self):
+        self.assertEquals(check_results(['a'], ['x']), ['a'])
+        self.assertRaises(FoneworxException, check_results, ['a'], ['x', 'y'])
+
+    def test_merge_chunks(self):
+        chunks = [(0, ['x', 'y']), (2, ['z'])]
+        self.assertEquals(merge_chunks(chunks, [(True, ['a', 'b']),
+                                                (True, ['c'])]),
+                            ['a', 'b', 'c'])
+        error = ValueError()
+        try:
+            merge_chunks(chunks, [(False, error), (True, ['c'])])
+        except PartialSendError, e:
+            self.assertEquals(e.results, [None, None, 'c'])
+            self.assertEquals(e.failures, [(0, ['x', 'y'], error)])
+        else:
+            self.fail("Expected a PartialSendError")
+
+    def test_merge_deletes(self):
+        error = ValueError()
+        try:
+            merge_deletes(['1', '2', '3', '4'],
+                            [(True, 'Success'), (True, 'Success'),
+                                (True, 'fail'), (False, error)])
+        except PartialDeleteError, e:
+            self.assertEquals(e.changes, {'1': 'Success', '2': 'Success',
+                                            '3': 'fail', '4': None})
+            self.assertEquals(sorted(e.failures), ['3', '4'])
+            self.assertTrue(isinstance(e.failures['3'], FoneworxException))
+            self.assertTrue(e.failures['4'] is error)
+        else:
+            self.fail("Expected a PartialDeleteError")
+
+    def test_merge_sent_deletes(self):
+        # the gateway reports no change for a deleted sent message
+        self.assertEquals(merge_deletes(['1', '2'],
+                                        [(True, None), (True, 'Success')],
+                                        SENT_DELETED),
+                            {'1': None, '2': 'Success'})
+        self.assertRaises(PartialDeleteError, merge_deletes, ['1'],
+                            [(True, None)])
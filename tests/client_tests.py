@@ -1,9 +1,12 @@
 # coding=utf-8
-from foneworx.client import Client, Status
-from foneworx.errors import ApiException
+from foneworx.client import Client, Status, Batcher
+from foneworx.errors import FoneworxException, ApiException, \
+                            PartialSendError, PartialDeleteError
+from foneworx.utils import chunk_messages, serialize_request, XML_DECLARATION
 from twisted.trial.unittest import TestCase
 from twisted.python import log
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet import reactor
 from datetime import datetime, timedelta
 from tests.utils import *
 
@@ -50,6 +53,57 @@ class FoneworxClientTestCase(TestCase):
             }]
         })
     
+    def test_serialize_request(self):
+        """serializing should match dict_to_xml and tostring exactly"""
+        requests = [{
+            "api_action": "sendmessages",
+            "api_sessionid": "my_session_id",
+            "action_content": {
+                "sms": [{
+                    "msisdn": "+27123456789",
+                    "message": u"fish & chips <for> w\xf8rl\u2202",
+                    "rule": "",
+                    "send_at": None,
+                }, {
+                    "msisdn": "+27123456789~+27987654321",
+                    "message": "hello world",
+                }]
+            }
+        }, {
+            "api_action": "newmessages",
+            "action_content": {},
+        }, {
+            "api_action": "sendmessages",
+            "action_content": {"sms": []},
+        }, {
+            "api_action": "deletenewmessages",
+            "action_content": {"sms_id": ["1", "2 & 3"]},
+        }]
+        for request in requests:
+            self.assertEquals(serialize_request(request),
+                XML_DECLARATION + tostring(dict_to_xml(request, 
+                                                        Element("sms_api"))))
+        self.assertRaises(TypeError, serialize_request, {"sms_id": 1})
+    
+    def test_response_parser(self):
+        """parsing a response in chunks should match xml_to_dict"""
+        response = TestDispatcher().do_newmessages(fromstring('<sms_api/>'))
+        parser = ResponseParser()
+        for character in response:
+            parser.feed(character)
+        testing, dictionary = xml_to_dict(fromstring(response))
+        self.assertEquals(parser.close(), dictionary)
+    
+    def test_response_parser_records(self):
+        """records should be handed out as soon as they're parsed"""
+        records = []
+        parser = ResponseParser(on_record=records.append)
+        parser.feed("<sms_api><error_type /><sms><sms_id>1</sms_id></sms>")
+        self.assertEquals(records, [{'sms_id': '1'}])
+        parser.feed("<sms><sms_id>2</sms_id></sms></sms_api>")
+        self.assertEquals(parser.close(), {'error_type': None})
+        self.assertEquals(records, [{'sms_id': '1'}, {'sms_id': '2'}])
+    
     def test_dict_to_xml_unicode(self):
         """shouldn't trip on unicode characters"""
         d = {
@@ -106,10 +160,67 @@ class FoneworxClientTestCase(TestCase):
             'sms_id': 'sms id 1'
         }])
     
+    @inlineCallbacks
+    def test_stream_new_messages(self):
+        batches = []
+        count = yield self.client.stream_new_messages(batches.append, 
+                                                        batch_size=1)
+        self.assertEquals(count, 2)
+        self.assertEquals([[sms['sms_id'] for sms in batch] for batch in batches],
+                            [['sms id 1'], ['sms id 2']])
+    
+    @inlineCallbacks
+    def test_stream_sent_messages_deferred_callback(self):
+        received = []
+        def callback(batch):
+            d = Deferred()
+            reactor.callLater(0, d.callback, received.extend(batch))
+            return d
+        count = yield self.client.stream_sent_messages(callback)
+        self.assertEquals(count, 1)
+        self.assertEquals(received[0]['status_id'], Status('3'))
+    
+    def test_stream_callback_failure(self):
+        def callback(batch):
+            raise ValueError("consumer failed")
+        return self.assertFailure(self.client.stream_new_messages(callback),
+                                    ValueError)
+    
+    def test_batcher_backpressure(self):
+        pending = []
+        def callback(batch):
+            pending.append(Deferred())
+            return pending[-1]
+        batcher = Batcher(callback, 1, lambda record: record, max_pending=2)
+        self.assertEquals(batcher({'sms_id': '1'}), None)
+        ready = batcher({'sms_id': '2'})
+        self.assertFalse(ready.called)
+        pending[0].callback(None)
+        self.assertTrue(ready.called)
+    
+    def test_batcher_chained_deferred(self):
+        inner = Deferred()
+        # fired, but waiting on the Deferred returned by its callback
+        outer = Deferred()
+        outer.addCallback(lambda _: inner)
+        outer.callback(None)
+        batcher = Batcher(lambda batch: outer, 1, lambda record: record)
+        batcher({'sms_id': '1'})
+        closed = batcher.close()
+        self.assertTrue(outer.called)
+        self.assertFalse(closed.called)
+        inner.callback(None)
+        self.assertEquals(self.successResultOf(closed), 1)
+    
     @inlineCallbacks
     def test_delete_messages(self):
         response = yield self.client.delete_message('sms id 1')
         self.assertEquals(response, "Success")
+        changes = yield self.client.delete_messages(['sms id 1', 'sms id 2',
+                                                        'sms id 3'])
+        self.assertEquals(changes, {'sms id 1': 'Success', 
+                                    'sms id 2': 'Success',
+                                    'sms id 3': 'Success'})
     
     @inlineCallbacks
     def test_send_messages(self):
@@ -128,6 +239,60 @@ class FoneworxClientTestCase(TestCase):
         self.assertEquals([d['submit'] for d in response], ['fail', 'success'])
         self.assertEquals([d['sms_id'] for d in response], ['sms 1', 'sms 2'])
     
+    @inlineCallbacks
+    def test_send_messages_in_chunks(self):
+        connection = EchoConnection()
+        client = Client('username', 'password', connection=connection,
+                        chunk_size=2, concurrency=2)
+        messages = [{"msisdn": "+27123456789", "message": str(i)} 
+                    for i in range(5)]
+        response = yield client.send_messages(messages)
+        self.assertEquals([d['sms_id'] for d in response], 
+                            ['0', '1', '2', '3', '4'])
+        self.assertEquals([len(request['action_content']['sms'])
+                            for request in connection.requests[1:]],
+                            [2, 2, 1])
+    
+    @inlineCallbacks
+    def test_send_messages_partial_failure(self):
+        client = Client('username', 'password', connection=EchoConnection(),
+                        chunk_size=2)
+        messages = [{"msisdn": "+27123456789", "message": message} 
+                    for message in ['0', '1', 'fail', '3', '4']]
+        try:
+            yield client.send_messages(messages)
+            self.fail("PartialSendError not raised")
+        except PartialSendError, e:
+            self.assertEquals([d and d['sms_id'] for d in e.results],
+                                ['0', '1', None, None, '4'])
+            [(offset, chunk, failure)] = e.failures
+            self.assertEquals(offset, 2)
+            self.assertEquals(chunk, messages[2:4])
+            self.assertTrue(failure.check(ApiException))
+    
+    @inlineCallbacks
+    def test_send_messages_result_count(self):
+        # the test gateway always returns two submit results
+        client = Client('username', 'password', connection=TestConnection(),
+                        chunk_size=3)
+        messages = [{"msisdn": "+27123456789", "message": str(i)}
+                    for i in range(5)]
+        try:
+            yield client.send_messages(messages)
+            self.fail("PartialSendError not raised")
+        except PartialSendError, e:
+            self.assertEquals([d and d['sms_id'] for d in e.results],
+                                [None, None, None, 'sms 1', 'sms 2'])
+            [(offset, chunk, failure)] = e.failures
+            self.assertEquals(offset, 0)
+            self.assertTrue(failure.check(FoneworxException))
+    
+    def test_chunk_messages_by_size(self):
+        messages = [{"message": "x" * 100}] * 3
+        self.assertEquals([(offset, len(chunk)) for offset, chunk in 
+                            chunk_messages(messages, 10, 250)],
+                            [(0, 2), (2, 1)])
+    
     @inlineCallbacks
     def test_sent_messages(self):
         response = yield self.client.sent_messages()
@@ -156,3 +321,24 @@ class FoneworxClientTestCase(TestCase):
             self.client.delete_sent_message('an obviously wrong id'), # a deferred
             ApiException
         )
+    
+    @inlineCallbacks
+    def test_delete_sent_messages(self):
+        changes = yield self.client.delete_sent_messages(['sms id 1'])
+        self.assertEquals(changes, {'sms id 1': 'Success'})
+        try:
+            yield self.client.delete_sent_messages(['sms id 1', 'sms id 2'])
+            self.fail("PartialDeleteError not raised")
+        except PartialDeleteError, e:
+            self.assertEquals(e.changes, {'sms id 1': 'Success',
+                                            'sms id 2': 'fail'})
+            self.assertEquals(e.failures.keys(), ['sms id 2'])
+            e.failures['sms id 2'].trap(FoneworxException)
+        try:
+            yield self.client.delete_sent_messages(['sms id 1', 'wrong id'])
+            self.fail("PartialDeleteError not raised")
+        except PartialDeleteError, e:
+            self.assertEquals(e.changes, {'sms id 1': 'Success', 
+                                            'wrong id': None})
+            self.assertEquals(e.failures.keys(), ['wrong id'])
+            e.failures['wrong id'].trap(ApiException)
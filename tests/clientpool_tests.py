@@ -0,0 +1,226 @@
+import itertools
+from datetime import datetime
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from foneworx.client import Client
+from foneworx.clientpool import ClientPool, Account
+from foneworx.errors import ApiException, PartialSendError, \
+                            PartialDeleteError, PartialFetchError
+from foneworx.fakegateway import FakeGateway, FakeGatewayFactory
+from foneworx.poller import Poller
+from tests.utils import GatewayTestMixin
+
+class StubClient(object):
+    """Holds on to the sends until they're answered"""
+
+    def __init__(self, username, concurrency=4):
+        self.username = username
+        self.concurrency = concurrency
+        self.sends = []
+
+    def send_messages(self, messages):
+        d = Deferred()
+        self.sends.append((messages, d))
+        return d
+
+    def answer(self, index=0):
+        messages, d = self.sends.pop(index)
+        d.callback([{'submit': 'success', 'sms_id': message['message']}
+                    for message in messages])
+
+    def throttle(self, index=0):
+        messages, d = self.sends.pop(index)
+        d.errback(ApiException('Throttling Error'))
+
+    def fail_first(self, index=0, error_type='Throttling Error'):
+        """Answer all but the first message, whose chunk fails"""
+        messages, d = self.sends.pop(index)
+        results = [None] + [{'submit': 'success', 'sms_id': message['message']}
+                            for message in messages[1:]]
+        d.errback(PartialSendError(results, [(0, messages[:1],
+                                    Failure(ApiException(error_type)))]))
+
+
+def message(text):
+    return {'msisdn': '+27123456789', 'message': text}
+
+
+class RoutingTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.first = StubClient('first')
+        self.second = StubClient('second')
+
+    def test_least_outstanding(self):
+        pool = ClientPool([self.first, self.second], batch_size=1,
+                            clock=self.clock)
+        d = pool.send_messages([message(str(i)) for i in range(3)])
+        self.assertEquals(len(self.first.sends), 2)
+        self.assertEquals(len(self.second.sends), 1)
+        self.first.answer()
+        d2 = pool.send_messages([message('3')])
+        # both have one outstanding, the first in order is chosen
+        self.assertEquals(len(self.first.sends), 2)
+        self.second.answer()
+        self.first.answer()
+        self.first.answer()
+        results = self.successResultOf(d)
+        self.assertEquals([result['sms_id'] for result in results],
+                            ['0', '1', '2'])
+        self.assertEquals(self.successResultOf(d2)[0]['sms_id'], '3')
+
+    def test_weighted(self):
+        pool = ClientPool([Account(self.first, weight=2), self.second],
+                            policy='weighted', batch_size=1, clock=self.clock)
+        pool.send_messages([message(str(i)) for i in range(6)])
+        self.assertEquals(len(self.first.sends), 4)
+        self.assertEquals(len(self.second.sends), 2)
+
+    def test_defaults(self):
+        pool = ClientPool([Account(self.first, defaults={'sentby': 'bind'})],
+                            clock=self.clock)
+        original = message('hi')
+        pool.send_messages([original, dict(message('hi'), sentby='other')])
+        [(messages, d)] = self.first.sends
+        self.assertEquals([sms['sentby'] for sms in messages],
+                            ['bind', 'other'])
+        self.assertFalse('sentby' in original)
+
+    def test_throttled_account_ejected(self):
+        pool = ClientPool([self.first, self.second], eject_interval=30,
+                            clock=self.clock)
+        d = pool.send_messages([message('0')])
+        self.first.throttle()
+        # sent again through the second account
+        self.second.answer()
+        self.assertEquals(self.successResultOf(d)[0]['sms_id'], '0')
+        [first, second] = pool.accounts
+        self.assertEquals(first.throttled, 1)
+        pool.send_messages([message('1')])
+        self.assertEquals(len(self.second.sends), 1)
+        self.clock.advance(30)
+        pool.send_messages([message('2')])
+        self.assertEquals(len(self.first.sends), 1)
+
+    def test_partial_failure(self):
+        pool = ClientPool([self.first, self.second], batch_size=2,
+                            clock=self.clock)
+        d = pool.send_messages([message(str(i)) for i in range(4)])
+        self.first.answer()
+        self.second.fail_first(error_type='Invalid batch')
+        failure = self.failureResultOf(d)
+        failure.trap(PartialSendError)
+        error = failure.value
+        self.assertEquals([result and result['sms_id']
+                            for result in error.results],
+                            ['0', '1', None, '3'])
+        [(offset, chunk, failure)] = error.failures
+        self.assertEquals(offset, 2)
+        self.assertEquals(chunk, [message('2')])
+
+    def test_partially_throttled(self):
+        pool = ClientPool([self.first, self.second], clock=self.clock)
+        d = pool.send_messages([message(str(i)) for i in range(3)])
+        self.first.fail_first()
+        # only the throttled chunk is sent again, through the second account
+        [(messages, _)] = self.second.sends
+        self.assertEquals(messages, [message('0')])
+        self.second.answer()
+        self.assertEquals([result['sms_id'] for result in
+                            self.successResultOf(d)], ['0', '1', '2'])
+        [first, second] = pool.accounts
+        self.assertEquals(first.throttled, 1)
+        self.assertEquals((first.sent, second.sent), (2, 1))
+
+    def test_all_throttled(self):
+        pool = ClientPool([self.first], eject_interval=30, throttle_retries=1,
+                            clock=self.clock)
+        d = pool.send_messages([message('0')])
+        self.first.throttle()
+        # waits for the account to be back in rotation
+        self.assertEquals(self.first.sends, [])
+        self.clock.advance(30)
+        self.first.throttle()
+        self.failureResultOf(d).trap(ApiException)
+
+
+class MergedPollingTestCase(GatewayTestMixin, TestCase):
+
+    def setUp(self):
+        self.gateways, accounts = [], []
+        for i in range(2):
+            gateway = FakeGateway()
+            # accounts on one gateway never share ids
+            gateway.ids = itertools.count(i * 1000)
+            connection = self.connect(self.listen(FakeGatewayFactory(gateway)))
+            accounts.append(Client('user%s' % i, 'password', connection))
+            self.gateways.append(gateway)
+        self.pool = ClientPool(accounts)
+
+    @inlineCallbacks
+    def test_poller(self):
+        for gateway in self.gateways:
+            gateway.receive('+27123456789', 'hello')
+        consumed = []
+        poller = Poller(self.pool, consumed.append)
+        handled = yield poller.poll_once()
+        self.assertEquals(handled, 2)
+        self.assertEquals(sorted(sms['sms_id'] for sms in consumed),
+                            ['in0', 'in1000'])
+        self.assertEquals([gateway.inbox for gateway in self.gateways],
+                            [[], []])
+        self.assertEquals(self.pool.inbound, {})
+
+    @inlineCallbacks
+    def test_account_failed(self):
+        for gateway in self.gateways:
+            gateway.receive('+27123456789', 'hello')
+        self.gateways[1].max_rate = 1
+        try:
+            yield self.pool.new_messages()
+        except PartialFetchError, e:
+            self.assertEquals([sms['sms_id'] for sms in e.results], ['in0'])
+            self.assertEquals(e.failures.keys(), ['user1'])
+            e.failures['user1'].trap(ApiException)
+        else:
+            self.fail("Expected a PartialFetchError")
+
+    @inlineCallbacks
+    def test_poller_account_failed(self):
+        for gateway in self.gateways:
+            gateway.receive('+27123456789', 'hello')
+        self.gateways[1].max_rate = 1
+        since = datetime(2000, 1, 1)
+        consumed = []
+        poller = Poller(self.pool, consumed.append, since=since)
+        handled = yield poller.poll_once()
+        self.assertEquals(handled, 1)
+        # the failed account's messages are fetched on the next poll
+        self.assertEquals(poller.since, since)
+        self.gateways[1].max_rate = None
+        handled = yield poller.poll_once()
+        self.assertEquals(handled, 1)
+        self.assertEquals(sorted(sms['sms_id'] for sms in consumed),
+                            ['in0', 'in1000'])
+        self.assertTrue(poller.since > since)
+
+    @inlineCallbacks
+    def test_sent_messages(self):
+        results = yield self.pool.send_messages([message('hi')])
+        updates = yield self.pool.sent_messages()
+        self.assertEquals([update['sms_id'] for update in updates],
+                            [results[0]['sms_id']])
+
+    @inlineCallbacks
+    def test_delete_unknown(self):
+        try:
+            yield self.pool.delete_messages(['in5'])
+        except PartialDeleteError, e:
+            self.assertEquals(e.changes, {'in5': None})
+        else:
+            self.fail("Expected a PartialDeleteError")
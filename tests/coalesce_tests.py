@@ -0,0 +1,61 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import succeed
+from twisted.internet import task
+
+from foneworx.client import Client
+from foneworx.coalesce import SendCoalescer
+from foneworx.errors import FoneworxException, ApiException
+from tests.utils import EchoConnection
+
+class SendCoalescerTestCase(TestCase):
+
+    def setUp(self):
+        self.connection = EchoConnection()
+        self.client = Client('username', 'password', 
+                                connection=self.connection, chunk_size=2)
+        self.clock = task.Clock()
+        self.coalescer = SendCoalescer(self.client, window=0.1, max_batch=3,
+                                        clock=self.clock)
+
+    def send(self, message):
+        results = []
+        self.coalescer.send_message({
+            'msisdn': '+27123456789',
+            'message': message
+        }).addBoth(results.append)
+        return results
+
+    def sent_batches(self):
+        return [[sms['message'] for sms in request['action_content']['sms']]
+                for request in self.connection.requests
+                if request['api_action'] == 'sendmessages']
+
+    def test_window(self):
+        first, second = self.send('1'), self.send('2')
+        self.assertEquals(self.sent_batches(), [])
+        self.clock.advance(0.1)
+        self.assertEquals(self.sent_batches(), [['1', '2']])
+        self.assertEquals(first[0]['sms_id'], '1')
+        self.assertEquals(second[0]['sms_id'], '2')
+
+    def test_max_batch(self):
+        results = [self.send(str(i)) for i in range(4)]
+        self.assertEquals(self.sent_batches(), [['0', '1'], ['2']])
+        self.assertEquals([r[0]['sms_id'] for r in results[:3]], 
+                            ['0', '1', '2'])
+        self.assertEquals(results[3], [])
+        self.clock.advance(0.1)
+        self.assertEquals(results[3][0]['sms_id'], '3')
+
+    def test_partial_failure(self):
+        results = [self.send(message) for message in ['0', '1', 'fail']]
+        self.assertEquals(results[0][0]['sms_id'], '0')
+        self.assertEquals(results[1][0]['sms_id'], '1')
+        self.assertTrue(results[2][0].check(ApiException))
+
+    def test_result_count(self):
+        self.client.send_messages = lambda messages: succeed([{'sms_id': '1'}])
+        results = [self.send(message) for message in ['1', '2']]
+        self.clock.advance(0.1)
+        for result in results:
+            self.assertTrue(result[0].check(FoneworxException))
@@ -0,0 +1,128 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import MemoryReactor, StringTransport
+
+from foneworx.client import TwistedConnection
+from foneworx.errors import RequestTimeout, ConnectTimeout, PoolTimeout
+from tests.pool_tests import LOGIN_RESPONSE
+
+SMSTIME = {'smstime': '20120101000000'}
+
+class FakeReactor(MemoryReactor, Clock):
+    """Records connection attempts and keeps time, nothing goes over TCP"""
+
+    def __init__(self):
+        MemoryReactor.__init__(self)
+        Clock.__init__(self)
+
+class DeadlineTestCase(TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.protocols = []
+
+    def get_connection(self, **options):
+        return TwistedConnection('127.0.0.1', 5000, clock=self.reactor,
+                                    **options)
+
+    def connect(self):
+        """
+        Complete the pending connection attempts, their protocols are
+        added to `protocols`
+        """
+        for host, port, factory, timeout, bind in \
+                self.reactor.tcpClients[len(self.protocols):]:
+            protocol = factory.buildProtocol(None)
+            protocol.makeConnection(StringTransport())
+            self.protocols.append(protocol)
+        self.reactor.advance(0)
+
+    def respond(self, index):
+        self.protocols[index].dataReceived(LOGIN_RESPONSE + chr(0))
+
+    def test_deadline(self):
+        connection = self.get_connection(timeout={None: 5, 'login': 2})
+        self.assertEquals(connection.deadline(connection.timeout, 'login'), 2)
+        self.assertEquals(connection.deadline(connection.timeout, 'logout'), 5)
+        self.assertEquals(connection.deadline(3, 'logout'), 3)
+
+    def test_response_timeout(self):
+        connection = self.get_connection(timeout=5)
+        d = connection.login()
+        self.connect()
+        self.reactor.advance(5)
+        self.failureResultOf(d).trap(RequestTimeout)
+        # the stalled connection was aborted and isn't reused
+        self.assertTrue(self.protocols[0].transport.disconnecting)
+        self.assertEquals(connection.pool.active, 0)
+        self.assertEquals(connection.pool.idle, [])
+        d = connection.login()
+        self.connect()
+        self.respond(1)
+        self.assertEquals(self.successResultOf(d)['session_id'],
+                            'my_session_id')
+        self.assertEquals(len(self.reactor.tcpClients), 2)
+
+    def test_connect_timeout(self):
+        connection = self.get_connection(pool_size=1, connect_timeout=5,
+                                            timeout={None: 20})
+        stalled = connection.login()
+        self.connect()
+        d = connection.login()
+        self.reactor.advance(5)
+        # the only connection was busy, that's not the endpoint's fault
+        self.failureResultOf(d).trap(PoolTimeout)
+        self.assertEquals(connection.pool.waiting, [])
+        breaker = connection.endpoints[0].breaker
+        self.assertEquals(breaker.failures, 0)
+        self.reactor.advance(15)
+        self.failureResultOf(stalled).trap(RequestTimeout)
+        self.assertEquals(breaker.failures, 1)
+        # connecting takes too long
+        d = connection.login()
+        self.reactor.advance(5)
+        failure = self.failureResultOf(d)
+        self.assertFalse(failure.check(PoolTimeout))
+        failure.trap(ConnectTimeout)
+        self.assertEquals(breaker.failures, 2)
+
+    def test_hedge_delay(self):
+        connection = self.get_connection(hedge_percentile=50, hedge_samples=2)
+        request = {'api_action': 'newmessages', 'action_content': SMSTIME}
+        self.assertEquals(connection.hedge_delay(request), None)
+        connection.record_latency('newmessages', 0.1)
+        connection.record_latency('newmessages', 0.3)
+        self.assertEquals(connection.hedge_delay(request), 0.1)
+        connection.record_latency('newmessages', 0.2)
+        self.assertEquals(connection.hedge_delay(request), 0.2)
+        # without a smstime the gateway advances its read pointer
+        self.assertEquals(connection.hedge_delay({
+            'api_action': 'newmessages', 'action_content': {}}), None)
+        self.assertEquals(connection.hedge_delay({
+            'api_action': 'sendmessages', 'action_content': SMSTIME}), None)
+
+    def test_hedged_request(self):
+        connection = self.get_connection(hedge_percentile=50, hedge_samples=1)
+        connection.record_latency('newmessages', 1)
+        d = connection.newmessages(action_content=SMSTIME)
+        self.connect()
+        self.reactor.advance(1)
+        self.connect()
+        self.assertEquals(len(self.protocols), 2)
+        self.respond(1)
+        self.assertEquals(self.successResultOf(d)['session_id'],
+                            'my_session_id')
+        self.assertEquals(connection.hedged, 1)
+        # the losing request was cancelled
+        self.assertTrue(self.protocols[0].transport.disconnecting)
+        self.assertEquals(len(connection.pool.idle), 1)
+
+    def test_failure_latency(self):
+        connection = self.get_connection(timeout=5, hedge_percentile=50,
+                                            hedge_samples=1)
+        d = connection.login()
+        self.connect()
+        self.reactor.advance(5)
+        self.failureResultOf(d).trap(RequestTimeout)
+        # a request that times out took at least that long
+        self.assertEquals(connection.latencies['login'].percentile(50), 5)
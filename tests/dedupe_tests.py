@@ -0,0 +1,85 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from foneworx.dedupe import Deduplicator
+
+def message(sms_id, parent_sms_id=None):
+    return {'sms_id': sms_id, 'parent_sms_id': parent_sms_id}
+
+class DeduplicatorTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_filter(self):
+        dedupe = Deduplicator(clock=self.clock)
+        messages = [message('1'), message('2'), message('1', '7')]
+        self.assertEquals(dedupe.filter(messages), messages)
+        self.assertEquals(dedupe.filter([message('1'), message('3'),
+                                            message('1', '7')]),
+                            [message('3')])
+        self.assertEquals(dedupe.duplicates, 2)
+
+    def test_max_size(self):
+        dedupe = Deduplicator(max_size=2, clock=self.clock)
+        dedupe.filter([message('1'), message('2')])
+        # seeing 1 again makes 2 the least recently seen
+        dedupe.filter([message('1'), message('3')])
+        self.assertEquals(len(dedupe), 2)
+        self.assertTrue(dedupe.seen(message('1')))
+        self.assertFalse(dedupe.seen(message('2')))
+
+    def test_window(self):
+        dedupe = Deduplicator(window=10, clock=self.clock)
+        dedupe.add(message('1'))
+        self.clock.advance(5)
+        dedupe.add(message('2'))
+        self.clock.advance(6)
+        self.assertFalse(dedupe.seen(message('1')))
+        self.assertTrue(dedupe.seen(message('2')))
+        dedupe.expire()
+        self.assertEquals(len(dedupe), 1)
+
+    def test_persistence(self):
+        state_file = self.mktemp()
+        dedupe = Deduplicator(state_file=state_file, clock=self.clock)
+        dedupe.filter([message('1'), message('2', '1')])
+        dedupe.save()
+        restored = Deduplicator(state_file=state_file, clock=self.clock)
+        self.assertEquals(restored.filter([message('1'), message('2', '1'),
+                                            message('2')]),
+                            [message('2')])
+
+    def test_handle(self):
+        dedupe = Deduplicator(clock=self.clock)
+        handling = []
+        def handler(message):
+            handling.append(Deferred())
+            return handling[-1]
+        first = dedupe.handle(message('1'), handler)
+        # the same message while the first is still being handled
+        second = dedupe.handle(message('1'), handler)
+        self.assertEquals(len(handling), 1)
+        self.assertFalse(second.called)
+        handling[0].callback(None)
+        self.assertEquals(self.successResultOf(first), True)
+        self.assertEquals(self.successResultOf(second), False)
+        self.assertEquals(self.successResultOf(
+                            dedupe.handle(message('1'), handler)), False)
+        self.assertEquals(dedupe.duplicates, 2)
+
+    def test_handle_failure(self):
+        dedupe = Deduplicator(clock=self.clock)
+        handling = []
+        def handler(message):
+            handling.append(Deferred())
+            return handling[-1]
+        first = dedupe.handle(message('1'), handler)
+        second = dedupe.handle(message('1'), handler)
+        handling[0].errback(ValueError("failed"))
+        self.failureResultOf(first).trap(ValueError)
+        self.failureResultOf(second).trap(ValueError)
+        # not remembered, handled again
+        dedupe.handle(message('1'), handler)
+        self.assertEquals(len(handling), 2)
@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from foneworx.errors import ApiException, PartialDeleteError
+from foneworx.fakegateway import FakeGateway
+from tests.utils import GatewayTestMixin
+
+class FakeGatewayTestCase(GatewayTestMixin, TestCase):
+
+    def setUp(self):
+        self.start_gateway()
+
+    @inlineCallbacks
+    def test_full_stack(self):
+        received = yield self.client.new_messages()
+        self.assertEquals(received, [])
+        self.gateway.receive('+27123456789', 'hello world')
+        [sms] = yield self.client.new_messages()
+        self.assertEquals(sms['message'], 'hello world')
+        self.assertTrue(isinstance(sms['timereceived'], datetime))
+        [result] = yield self.client.send_messages([{
+            'msisdn': sms['msisdn'],
+            'message': 'Hi! you said: %s' % sms['message'],
+        }])
+        self.assertEquals(result['submit'], 'success')
+        [status] = yield self.client.sent_messages(give_detail=True)
+        self.assertEquals(status['sms_id'], result['sms_id'])
+        self.assertEquals(status['status_text'], 'Delivered')
+        deleted = yield self.client.delete_message(sms['sms_id'])
+        self.assertEquals(deleted, 'Success')
+        deleted = yield self.client.delete_sent_message(status['sms_id'])
+        # like the gateway, no change for a deleted sent message
+        self.assertEquals(deleted, None)
+        self.assertEquals(self.gateway.inbox, [])
+        self.assertEquals(len(self.factory.connections), 1)
+
+    @inlineCallbacks
+    def test_bulk_delete(self):
+        for i in range(5):
+            self.gateway.receive('+27123456789', 'message %s' % i)
+        messages = yield self.client.new_messages()
+        changes = yield self.client.delete_messages(
+            [sms['sms_id'] for sms in messages])
+        self.assertEquals(changes.values(), ['Success'] * 5)
+        self.assertEquals(self.gateway.inbox, [])
+        # a deletenewmessages request per id after login & newmessages
+        self.assertEquals(self.gateway.requests, 7)
+
+    @inlineCallbacks
+    def test_bulk_delete_sent(self):
+        results = yield self.client.send_messages([
+            {'msisdn': '+27123456789', 'message': 'message %s' % i}
+            for i in range(3)])
+        sms_ids = [result['sms_id'] for result in results]
+        changes = yield self.client.delete_sent_messages(sms_ids)
+        self.assertEquals(changes, dict((sms_id, None) for sms_id in sms_ids))
+        self.assertEquals(self.gateway.sent, {})
+
+    @inlineCallbacks
+    def test_bulk_delete_unknown_id(self):
+        sms = self.gateway.receive('+27123456789', 'hello')
+        try:
+            yield self.client.delete_messages([sms['sms_id'], 'in999'])
+            self.fail("PartialDeleteError not raised")
+        except PartialDeleteError, e:
+            self.assertEquals(e.changes, {sms['sms_id']: 'Success',
+                                            'in999': 'fail'})
+            self.assertEquals(e.failures.keys(), ['in999'])
+
+    @inlineCallbacks
+    def test_session_expiry(self):
+        yield self.client.new_messages()
+        self.gateway.expire_sessions()
+        yield self.client.new_messages()
+        self.assertEquals(self.gateway.requests, 5)
+
+    def test_throttling(self):
+        self.gateway.max_rate = 1
+        return self.assertFailure(self.client.new_messages(), ApiException)
+
+    @inlineCallbacks
+    def test_close_after_response_and_drip(self):
+        self.factory.close_after_response = True
+        self.factory.drip_bytes = 7
+        self.factory.drip_interval = 0
+        session_id = yield self.client.login()
+        self.assertTrue(session_id)
+        session_id = yield self.client.login()
+        self.assertTrue(session_id)
+
+
+class FakeGatewayClockTestCase(TestCase):
+
+    def test_timestamps_follow_clock(self):
+        clock = Clock()
+        clock.advance(1279109711)
+        gateway = FakeGateway(clock=clock)
+        sms = gateway.receive('+27123456789', 'hello')
+        self.assertEquals(sms['timereceived'],
+                            datetime.fromtimestamp(1279109711).strftime(
+                                '%Y%m%d%H%M%S'))
+        clock.advance(3600)
+        later = gateway.receive('+27123456789', 'hello')
+        self.assertEquals(datetime.strptime(later['timereceived'],
+                                            '%Y%m%d%H%M%S') -
+                            datetime.strptime(sms['timereceived'],
+                                            '%Y%m%d%H%M%S'),
+                            timedelta(hours=1))
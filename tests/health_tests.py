@@ -0,0 +1,208 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.internet.protocol import ServerFactory
+from twisted.internet import reactor, error
+from twisted.test.proto_helpers import StringTransport
+
+from foneworx.errors import RequestTimeout, EndpointUnavailable
+from foneworx.client import TwistedConnection
+from foneworx.health import CircuitBreaker, Endpoint, CLOSED, OPEN, HALF_OPEN
+from foneworx.pool import ConnectionPool
+from tests.pool_tests import LoginServerProtocol, LoginServerFactory, \
+                                LOGIN_RESPONSE
+from tests.deadline_tests import FakeReactor
+from tests.utils import GatewayTestMixin
+
+class StallingServerProtocol(LoginServerProtocol):
+    """Never answers on the connections the factory says to stall"""
+
+    def dataReceived(self, data):
+        index = self.factory.connections.index(self)
+        if index not in self.factory.stall:
+            LoginServerProtocol.dataReceived(self, data)
+
+class StallingServerFactory(LoginServerFactory):
+    protocol = StallingServerProtocol
+
+    def __init__(self, stall=()):
+        LoginServerFactory.__init__(self)
+        self.stall = set(stall)
+
+class CircuitBreakerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_consecutive_failures(self):
+        breaker = CircuitBreaker(max_consecutive=3, clock=self.clock)
+        breaker.failure()
+        breaker.success(0.1)
+        breaker.failure()
+        breaker.failure()
+        self.assertEquals(breaker.state, CLOSED)
+        breaker.failure()
+        self.assertEquals(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_error_rate(self):
+        breaker = CircuitBreaker(window=10, min_requests=4,
+                                    max_error_rate=0.5, clock=self.clock)
+        for failed in [True, False, True, False, True]:
+            if failed:
+                breaker.failure()
+            else:
+                breaker.success(0.1)
+        self.assertEquals(breaker.state, OPEN)
+
+    def test_window(self):
+        breaker = CircuitBreaker(window=4, min_requests=4, max_error_rate=0.5,
+                                    clock=self.clock)
+        breaker.failure()
+        breaker.failure()
+        for i in range(4):
+            breaker.success(0.1)
+        self.assertEquals(breaker.failures, 0)
+        breaker.failure()
+        self.assertEquals(breaker.state, CLOSED)
+
+    def test_latency(self):
+        breaker = CircuitBreaker(min_requests=3, max_latency=1,
+                                    clock=self.clock)
+        breaker.success(0.5)
+        breaker.success(5)
+        self.assertEquals(breaker.state, CLOSED)
+        breaker.success(5)
+        self.assertEquals(breaker.state, OPEN)
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(max_consecutive=1, reset_timeout=5,
+                                    max_reset_timeout=8, clock=self.clock)
+        breaker.failure()
+        self.clock.advance(5)
+        self.assertTrue(breaker.allow())
+        self.assertEquals(breaker.state, HALF_OPEN)
+        # a single probe at a time
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEquals(breaker.state, OPEN)
+        self.clock.advance(5)
+        self.assertFalse(breaker.allow())
+        self.clock.advance(3)
+        self.assertTrue(breaker.allow())
+        breaker.success(0.1)
+        self.assertEquals(breaker.state, CLOSED)
+        self.assertEquals(breaker.open_timeout, 5)
+
+    def test_cancelled_probe(self):
+        breaker = CircuitBreaker(max_consecutive=1, clock=self.clock)
+        breaker.failure()
+        self.clock.advance(breaker.reset_timeout)
+        self.assertTrue(breaker.allow())
+        breaker.cancelled()
+        self.assertTrue(breaker.allow())
+
+
+class EndpointTestCase(TestCase):
+
+    def endpoint(self):
+        clock = Clock()
+        return Endpoint('127.0.0.1', 5000,
+                        ConnectionPool('127.0.0.1', 5000, clock=clock),
+                        CircuitBreaker(clock=clock))
+
+    def test_score(self):
+        unknown, known, failing = [self.endpoint() for i in range(3)]
+        known.breaker.success(0.1)
+        failing.breaker.success(0.1)
+        failing.breaker.failure()
+        self.assertTrue(known.score() < unknown.score())
+        self.assertTrue(known.score() < failing.score())
+        known.pool.active = 2
+        self.assertAlmostEquals(known.score(), 3 * 0.101)
+
+    def test_latency_after_acquire(self):
+        reactor = FakeReactor()
+        connection = TwistedConnection('127.0.0.1', 5000, pool_size=1,
+                                        clock=reactor)
+        first, second = connection.login(), connection.login()
+        [(host, port, factory, timeout, bind)] = reactor.tcpClients
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        reactor.advance(0)
+        reactor.advance(10)
+        protocol.dataReceived(LOGIN_RESPONSE + chr(0))
+        self.successResultOf(first)
+        # the second request waited 10s for the connection, that's not
+        # the endpoint's latency
+        reactor.advance(1)
+        protocol.dataReceived(LOGIN_RESPONSE + chr(0))
+        self.successResultOf(second)
+        self.assertAlmostEquals(connection.endpoints[0].breaker.latency,
+                                10 + 0.2 * (1 - 10))
+
+
+class FailoverTestCase(GatewayTestMixin, TestCase):
+
+    @inlineCallbacks
+    def refused(self):
+        """Sets `refused_address` to a port nothing listens on"""
+        port = reactor.listenTCP(0, ServerFactory(), interface='127.0.0.1')
+        address = ('127.0.0.1', port.getHost().port)
+        yield port.stopListening()
+        self.refused_address = address
+
+    @inlineCallbacks
+    def test_failover(self):
+        yield self.refused()
+        factory = LoginServerFactory()
+        self.connection = self.connect(self.refused_address,
+                                        self.listen(factory))
+        for i in range(4):
+            response = yield self.connection.login()
+            self.assertEquals(response['session_id'], 'my_session_id')
+        down, up = self.connection.endpoints
+        # the failed endpoint scores worse & isn't tried again
+        self.assertEquals(down.breaker.failures, 1)
+        self.assertTrue(down.score() > up.score())
+        self.assertEquals(up.breaker.state, CLOSED)
+        self.assertEquals(len(factory.connections), 1)
+
+    @inlineCallbacks
+    def test_slow_endpoint(self):
+        slow = self.listen(StallingServerFactory(stall=range(10)))
+        fast = self.listen(LoginServerFactory())
+        self.connection = self.connect(slow, fast, timeout=0.05)
+        slow, fast = self.connection.endpoints
+        # both endpoints are idle, the first is preferred
+        try:
+            yield self.connection.login()
+        except RequestTimeout:
+            pass
+        else:
+            self.fail("Expected a RequestTimeout")
+        # the slow endpoint is avoided before its circuit opens
+        for i in range(2):
+            yield self.connection.login()
+        self.assertEquals(slow.breaker.state, CLOSED)
+        self.assertEquals(slow.breaker.failures, 1)
+        self.assertEquals(fast.breaker.failures, 0)
+
+    @inlineCallbacks
+    def test_all_open(self):
+        yield self.refused()
+        self.connection = self.connect(self.refused_address,
+                                        breaker_options={
+                                            'max_consecutive': 1})
+        try:
+            yield self.connection.login()
+        except error.ConnectionRefusedError:
+            pass
+        else:
+            self.fail("Expected a ConnectionRefusedError")
+        try:
+            yield self.connection.login()
+        except EndpointUnavailable:
+            pass
+        else:
+            self.fail("Expected an EndpointUnavailable")
@@ -0,0 +1,101 @@
+import os
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from foneworx.client import Client, Connection
+from foneworx.codec import ResponseParser
+from foneworx.errors import ApiException
+from foneworx.fakegateway import FakeGateway, FakeGatewayFactory
+from foneworx.loadgen import Histogram, LoadGenerator, parse_mix
+
+class HistogramTestCase(TestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for value in range(1, 101):
+            histogram.add(value)
+        summary = histogram.summary()
+        self.assertEquals((summary['p50'], summary['p95'], summary['p99'],
+                            summary['max']), (50, 95, 99, 100))
+        self.assertEquals(Histogram().summary(), {'count': 0})
+
+    def test_parse_mix(self):
+        self.assertEquals(parse_mix('send:8,new,sent:1'),
+                            {'send': 8, 'new': 1, 'sent': 1})
+
+class ClockedGatewayConnection(Connection):
+    """
+    Hands requests straight to a FakeGatewayFactory and answers them after
+    `latency` seconds of the factory's clock
+    """
+
+    def __init__(self, factory, latency=0.01):
+        self.factory = factory
+        self.latency = latency
+
+    def send(self, dictionary, on_record=None):
+        response = self.factory.respond(
+                        self.factory.serializer.serialize(dictionary))
+        d = Deferred()
+        self.factory.clock.callLater(self.latency, self.respond, d, response,
+                                        on_record)
+        return d
+
+    def respond(self, d, response, on_record):
+        parser = ResponseParser(on_record)
+        parser.feed(response)
+        dictionary = parser.close()
+        if dictionary.get('error_type'):
+            d.errback(ApiException(dictionary['error_type'], response))
+        else:
+            d.callback(dictionary)
+
+
+class LoadGeneratorTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.gateway = FakeGateway(max_rate=50, clock=self.clock)
+        self.factory = FakeGatewayFactory(self.gateway, clock=self.clock)
+        self.client = Client('username', 'password',
+                                connection=ClockedGatewayConnection(
+                                    self.factory))
+
+    def run_for(self, d, seconds, step=0.01):
+        self.clock.pump([0] + [step] * int(round(seconds / step)))
+        return self.successResultOf(d)
+
+    def test_concurrency(self):
+        generator = LoadGenerator(self.client, {'send': 2, 'new': 1},
+                                    concurrency=2, duration=1, seed=1,
+                                    clock=self.clock)
+        self.run_for(generator.run(), 1.1)
+        self.assertTrue(generator.latencies['send'])
+        self.assertEquals(generator.outstanding, 0)
+        self.assertAlmostEquals(generator.finished - generator.started, 1)
+        report = generator.report()
+        self.assertTrue('throughput:' in report)
+        # two requests in flight answered after 10ms are 200 requests per
+        # second, the gateway throttles at 50
+        self.assertTrue(('send', 'Throttling Error') in generator.errors)
+
+    def test_rate(self):
+        generator = LoadGenerator(self.client, {'sent': 1}, rate=20,
+                                    duration=1, clock=self.clock)
+        self.run_for(generator.run(), 1.1)
+        self.assertEquals(generator.issued, 20)
+
+    def test_record_and_replay(self):
+        generator = LoadGenerator(self.client, {'sent': 1}, rate=20,
+                                    duration=0.1, clock=self.clock)
+        self.run_for(generator.run(), 0.2)
+        filename = self.mktemp()
+        generator.save(filename)
+        self.assertTrue(os.path.exists(filename))
+        replay = LoadGenerator(self.client, {'sent': 1}, clock=self.clock)
+        self.run_for(replay.replay(generator.schedule), 0.2)
+        self.assertEquals([(round(offset, 6), action)
+                            for offset, action in replay.schedule],
+                            [(round(offset, 6), action)
+                            for offset, action in generator.schedule])
@@ -0,0 +1,81 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.error import ConnectionRefusedError
+
+from foneworx.metrics import Histogram, Samples, MetricsAggregator, \
+                                export_text
+from tests.utils import GatewayTestMixin
+
+class HistogramTestCase(TestCase):
+
+    def test_buckets(self):
+        histogram = Histogram([1, 10, 100])
+        for value in [0.5, 1, 5, 50, 500]:
+            histogram.add(value)
+        self.assertEquals(list(histogram.cumulative()),
+                            [(1, 2), (10, 3), (100, 4), (float('inf'), 5)])
+        self.assertEquals(histogram.percentile(50), 10)
+        self.assertEquals(histogram.percentile(100), float('inf'))
+        self.assertEquals(histogram.sum, 556.5)
+
+    def test_samples(self):
+        samples = Samples(size=4)
+        self.assertEquals(samples.percentile(50), None)
+        for value in [9, 1, 2, 3, 4]:
+            samples.add(value)
+        # the oldest value was dropped
+        self.assertEquals(len(samples), 4)
+        self.assertEquals(samples.percentile(50), 2)
+        self.assertEquals(samples.percentile(100), 4)
+        # the same ranks as the buckets
+        histogram = Histogram([1, 2, 3, 4])
+        for value in [1, 2, 3, 4]:
+            histogram.add(value)
+        self.assertEquals(histogram.percentile(50), 2)
+
+
+class MetricsTestCase(GatewayTestMixin, TestCase):
+
+    def setUp(self):
+        self.metrics = MetricsAggregator()
+        self.start_gateway(observer=self.metrics)
+        self.client.observer = self.metrics
+
+    @inlineCallbacks
+    def test_requests(self):
+        yield self.client.new_messages()
+        for i in range(3):
+            self.gateway.receive('+27123456789', 'message %s' % i)
+        yield self.client.new_messages()
+        yield self.client.send_messages([{'msisdn': '+27123456789',
+                                            'message': 'hello'}])
+        self.assertEquals(self.metrics.logins, 1)
+        login = self.metrics.actions['login']
+        self.assertEquals(login.count, 1)
+        self.assertEquals(sorted(login.phases),
+                            ['connect', 'parse', 'send', 'total', 'wait'])
+        new = self.metrics.actions['newmessages']
+        self.assertEquals(new.count, 2)
+        self.assertEquals(new.errors, {'No New Messages': 1})
+        self.assertEquals(new.records.count, 2)
+        self.assertEquals(new.records.sum, 3)
+        self.assertEquals(new.converted, 3)
+        self.assertEquals(new.phase('convert').count, 2)
+        self.assertTrue(new.bytes_in > new.bytes_out > 0)
+        self.assertEquals(self.metrics.actions['sendmessages'].converted, 1)
+        text = export_text(self.metrics)
+        self.assertTrue('foneworx_logins_total 1\n' in text)
+        self.assertTrue('foneworx_errors_total{action="newmessages",'
+                        'error_type="No New Messages"} 1\n' in text)
+        self.assertTrue('foneworx_request_seconds_count{action="newmessages",'
+                        'phase="wait"} 2\n' in text)
+        self.assertTrue('foneworx_records_bucket{action="newmessages",'
+                        'le="+Inf"} 2\n' in text)
+
+    @inlineCallbacks
+    def test_connection_failure(self):
+        self.connection.pool.port = 1
+        yield self.assertFailure(self.client.login(), ConnectionRefusedError)
+        self.assertEquals(self.metrics.actions['login'].errors,
+                            {'ConnectionRefusedError': 1})
+        self.assertEquals(self.metrics.logins, 0)
@@ -0,0 +1,124 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+
+from foneworx.client import Client, Connection
+from foneworx.errors import ApiException, PartialSendError
+from foneworx.outbox import Outbox, DONE, FAILED
+from tests.utils import EchoConnection
+
+class HangingConnection(Connection):
+    """Never answers sendmessages, like a process that died"""
+
+    def send(self, dictionary, on_record=None):
+        if dictionary['api_action'] == 'login':
+            return succeed({'session_id': 'my_session_id'})
+        return Deferred()
+
+
+class OutboxTestCase(TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.clock = Clock()
+        self.connection = EchoConnection()
+        self.client = Client('username', 'password',
+                                connection=self.connection, chunk_size=2)
+
+    def outbox(self, client, **kwargs):
+        outbox = Outbox(client, self.path, clock=self.clock, **kwargs)
+        outbox.open()
+        self.addCleanup(lambda: outbox.db and outbox.close())
+        return outbox
+
+    def message(self, text):
+        return {'msisdn': '+27123456789', 'message': text}
+
+    def test_group_commit(self):
+        results = []
+        outbox = self.outbox(self.client,
+            on_result=lambda id, message, result: results.append(
+                (id, result['sms_id'])))
+        committed = []
+        outbox.enqueue([self.message('a')]).addCallback(committed.append)
+        outbox.enqueue([self.message('b')]).addCallback(committed.append)
+        self.assertEquals(committed, [])
+        self.clock.advance(outbox.commit_interval)
+        self.assertEquals(committed, [[1], [2]])
+        self.assertEquals(results, [(1, 'a'), (2, 'b')])
+        self.assertEquals(outbox.pending(), 0)
+        # a single request for both messages
+        self.assertEquals(len(self.connection.requests), 2)
+
+    def test_batch_size_commits(self):
+        outbox = self.outbox(self.client, batch_size=2)
+        committed = []
+        outbox.enqueue(map(self.message, 'ab')).addCallback(committed.append)
+        self.assertEquals(committed, [[1, 2]])
+
+    def test_recovery(self):
+        hanging = Client('username', 'password',
+                            connection=HangingConnection())
+        outbox = self.outbox(self.client)
+        outbox.enqueue(map(self.message, 'ab'))
+        self.clock.advance(outbox.commit_interval)
+        outbox.close()
+        outbox = self.outbox(hanging)
+        outbox.enqueue(map(self.message, 'cd'))
+        self.clock.advance(outbox.commit_interval)
+        self.assertEquals(outbox.pending(), 2)
+        # the process dies without closing the database
+        outbox.db = None
+        recovered = Outbox(self.client, self.path, clock=self.clock)
+        self.assertEquals(recovered.open(), 2)
+        self.addCleanup(recovered.close)
+        self.assertEquals(recovered.pending(), 0)
+        sent = [message['message'] for request in self.connection.requests
+                if request['api_action'] == 'sendmessages'
+                for message in request['action_content']['sms']]
+        self.assertEquals(sent, ['a', 'b', 'c', 'd'])
+        self.assertEquals(recovered.db.execute(
+            "SELECT sms_id FROM messages WHERE state = ? ORDER BY id",
+            (DONE,)).fetchall(), [('a',), ('b',), ('c',), ('d',)])
+
+    def test_retry(self):
+        outbox = self.outbox(self.client, retry_interval=5)
+        outbox.enqueue(map(self.message, ['a', 'b', 'fail', 'c']))
+        self.clock.advance(outbox.commit_interval)
+        self.assertEquals(len(self.flushLoggedErrors(PartialSendError)), 1)
+        self.assertEquals(outbox.pending(), 2)
+        self.connection.requests = []
+        self.clock.advance(5)
+        # the remaining messages fit a single chunk
+        self.assertEquals(len(self.flushLoggedErrors(ApiException)), 1)
+        self.assertEquals(outbox.pending(), 2)
+        self.assertEquals(len(self.connection.requests), 1)
+
+    def test_max_attempts(self):
+        failed = []
+        outbox = self.outbox(self.client, retry_interval=5, max_attempts=2,
+                                on_failed=lambda id, message, failure:
+                                    failed.append((id, message['message'])))
+        outbox.enqueue(map(self.message, ['fail', 'a']))
+        self.clock.advance(outbox.commit_interval)
+        self.clock.advance(5)
+        self.assertEquals(len(self.flushLoggedErrors(ApiException)), 2)
+        self.assertEquals(failed, [(1, 'fail'), (2, 'a')])
+        self.assertEquals(outbox.pending(), 0)
+        self.assertEquals(outbox.failed(), 2)
+        self.assertEquals(outbox.db.execute(
+            "SELECT state, attempts FROM messages").fetchall(),
+            [(FAILED, 2), (FAILED, 2)])
+        # set aside, not retried
+        self.connection.requests = []
+        self.clock.advance(5)
+        self.assertEquals(self.connection.requests, [])
+        outbox.db.execute("UPDATE messages SET message = ? WHERE id = 1",
+                            ('{"msisdn": "+27123456789", "message": "b"}',))
+        self.assertEquals(outbox.requeue_failed(), 2)
+        self.assertEquals(outbox.pending(), 0)
+        self.assertEquals(outbox.failed(), 0)
+
+    def test_synchronous(self):
+        self.assertRaises(ValueError, Outbox, self.client, self.path,
+                            synchronous='OFF')
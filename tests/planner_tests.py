@@ -0,0 +1,199 @@
+# coding=utf-8
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from foneworx.client import Client
+from foneworx.errors import PartialSendError
+from foneworx.planner import Planner, segments, hex_segments, GSM7, UCS2
+from foneworx.schema import Status
+from tests.utils import EchoConnection
+
+class SegmentsTestCase(TestCase):
+
+    def test_gsm7(self):
+        self.assertEquals(segments(u'x' * 160), (GSM7, 1))
+        self.assertEquals(segments(u'x' * 161), (GSM7, 2))
+        self.assertEquals(segments(u'x' * 306), (GSM7, 2))
+        self.assertEquals(segments(u'x' * 307), (GSM7, 3))
+        self.assertEquals(segments(u'é@£ü'), (GSM7, 1))
+
+    def test_extension(self):
+        # the gateway doesn't document escapes, these are sent as UCS-2
+        self.assertEquals(segments(u'€' * 70), (UCS2, 1))
+        self.assertEquals(segments(u'x' * 70 + u'{'), (UCS2, 2))
+        self.assertEquals(segments(u'[x]'), (UCS2, 1))
+
+    def test_ucs2(self):
+        self.assertEquals(segments(u'ā' * 70), (UCS2, 1))
+        self.assertEquals(segments(u'ā' * 71), (UCS2, 2))
+        self.assertEquals(segments(u'x' * 134 + u'`'), (UCS2, 3))
+
+    def test_hex(self):
+        self.assertEquals(hex_segments('0041' * 70), 1)
+        self.assertEquals(hex_segments('0041' * 71), 2)
+        self.assertRaises(ValueError, hex_segments, '004100')
+
+
+class PlannerTestCase(TestCase):
+
+    def setUp(self):
+        self.planner = Planner()
+
+    def test_normalise_msisdn(self):
+        normalise = self.planner.normalise_msisdn
+        self.assertEquals(normalise('+27821234567'), '+27821234567')
+        self.assertEquals(normalise('082 123 4567'), '+27821234567')
+        self.assertEquals(normalise('0027-82-123-4567'), '+27821234567')
+        self.assertEquals(normalise('27821234567'), '+27821234567')
+        self.assertEquals(normalise('+44 (20) 7946 0958'), '+442079460958')
+        self.assertEquals(normalise('+2782123456'), None)
+        self.assertEquals(normalise('821234567'), None)
+        self.assertEquals(normalise('+27 82 CALL ME'), None)
+        self.assertEquals(normalise(''), None)
+
+    def test_multiple_msisdns(self):
+        self.assertEquals(self.planner.normalise_msisdns(
+                            '0821234567~+27831234567'),
+                            '+27821234567~+27831234567')
+        self.assertEquals(self.planner.normalise_msisdns(
+                            '0821234567~123'), None)
+
+    def test_check(self):
+        message = {'msisdn': '0821234567', 'message': 'hi'}
+        checked, count = self.planner.check(message)
+        self.assertEquals(checked, {'msisdn': '+27821234567',
+                                    'message': 'hi'})
+        self.assertEquals(count, 1)
+        self.assertEquals(message['msisdn'], '0821234567')
+        # unchanged messages aren't copied
+        message = {'msisdn': '+27821234567', 'message': 'hi'}
+        self.assertTrue(self.planner.check(message)[0] is message)
+
+    def test_auto_encode(self):
+        checked, count = self.planner.check({'msisdn': '+27821234567',
+                                            'message': u'Привет'})
+        self.assertEquals(checked['smstype'], '64')
+        self.assertEquals(checked['message'], '041F04400438043204350442')
+        checked, count = self.planner.check({'msisdn': '+27821234567',
+                                            'message': 'hi',
+                                            'smstype': 64})
+        self.assertEquals(checked['message'], '00680069')
+        # already hex encoded
+        message = {'msisdn': '+27821234567', 'message': '00680069',
+                    'smstype': '64'}
+        self.assertTrue(self.planner.check(message)[0] is message)
+        planner = Planner(auto_encode=False)
+        checked, count = planner.check({'msisdn': '+27821234567',
+                                        'message': u'Привет'})
+        self.assertFalse('smstype' in checked)
+
+    def test_reject(self):
+        result, count = self.planner.check({'msisdn': '123',
+                                            'message': 'hi'})
+        self.assertEquals(count, None)
+        self.assertEquals(result['submit'], 'fail')
+        self.assertEquals(result['status_id'], '911')
+        result, count = self.planner.check({'msisdn': '+27821234567',
+                                            'message': 'x' * 481})
+        self.assertEquals(result['status_id'], '91')
+        result, count = self.planner.check({'msisdn': '+27821234567',
+                                            'message': ''})
+        self.assertEquals(result['status_id'], '91')
+        planner = Planner(max_segments=1)
+        result, count = planner.check({'msisdn': '+27821234567',
+                                        'message': 'x' * 161})
+        self.assertEquals(result['status_id'], '91')
+        # hex digits that aren't whole UCS-2 characters
+        result, count = self.planner.check({'msisdn': '+27821234567',
+                                            'message': '004100',
+                                            'smstype': '64'})
+        self.assertEquals(result['status_id'], '91')
+
+    def test_plan(self):
+        plan = self.planner.plan([
+            {'msisdn': '0821234567', 'message': 'x' * 200},
+            {'msisdn': '123', 'message': 'hi'},
+            {'msisdn': '0821234567', 'message': 'hi'},
+        ])
+        self.assertEquals(plan.indices, [0, 2])
+        self.assertEquals([index for index, result in plan.rejected], [1])
+        self.assertEquals(plan.segments, 3)
+
+
+class PlannedSendTestCase(TestCase):
+
+    def setUp(self):
+        self.connection = EchoConnection()
+        self.client = Client('username', 'password',
+                                connection=self.connection, chunk_size=2,
+                                planner=Planner())
+
+    @inlineCallbacks
+    def test_send_messages(self):
+        results = yield self.client.send_messages([
+            {'msisdn': '0821234567', 'message': '0'},
+            {'msisdn': '123', 'message': '1'},
+            {'msisdn': '0821234567', 'message': '2'},
+            {'msisdn': '0821234567', 'message': '3'},
+        ])
+        self.assertEquals([result['sms_id'] for result in results],
+                            ['0', '', '2', '3'])
+        self.assertEquals(results[1]['status_id'], Status('911'))
+        sent = [sms for request in self.connection.requests[1:]
+                    for sms in request['action_content']['sms']]
+        self.assertEquals([sms['msisdn'] for sms in sent],
+                            ['+27821234567'] * 3)
+
+    @inlineCallbacks
+    def test_send_extension(self):
+        yield self.client.send_messages([
+            {'msisdn': '0821234567', 'message': u'R10 {promo}'}])
+        [sms] = self.connection.requests[1]['action_content']['sms']
+        self.assertEquals(sms['smstype'], '64')
+        self.assertEquals(sms['message'].decode('hex').decode('utf-16-be'),
+                            u'R10 {promo}')
+
+    @inlineCallbacks
+    def test_all_rejected(self):
+        results = yield self.client.send_messages([
+            {'msisdn': '123', 'message': 'hi'}])
+        self.assertEquals(results[0]['submit'], 'fail')
+        self.assertEquals(self.connection.requests, [])
+
+    @inlineCallbacks
+    def test_partial_failure(self):
+        try:
+            yield self.client.send_messages([
+                {'msisdn': '123', 'message': 'hi'},
+                {'msisdn': '0821234567', 'message': '1'},
+                {'msisdn': '0821234567', 'message': '2'},
+                {'msisdn': '0821234567', 'message': 'fail'},
+            ])
+        except PartialSendError, e:
+            self.assertEquals([result and result['sms_id']
+                                for result in e.results],
+                                ['', '1', '2', None])
+            [(offset, chunk, failure)] = e.failures
+            self.assertEquals(offset, 3)
+        else:
+            self.fail("Expected a PartialSendError")
+
+    @inlineCallbacks
+    def test_failed_chunk_around_rejected(self):
+        try:
+            yield self.client.send_messages([
+                {'msisdn': '0821234567', 'message': '0'},
+                {'msisdn': '123', 'message': '1'},
+                {'msisdn': '0821234567', 'message': 'fail'},
+                {'msisdn': '0821234567', 'message': '3'},
+            ])
+        except PartialSendError, e:
+            self.assertEquals([result and result['sms_id']
+                                for result in e.results],
+                                [None, '', None, '3'])
+            # the failed chunk is split around the rejected message
+            self.assertEquals([(offset, [sms['message'] for sms in chunk])
+                                for offset, chunk, failure in e.failures],
+                                [(0, ['0']), (2, ['fail'])])
+        else:
+            self.fail("Expected a PartialSendError")
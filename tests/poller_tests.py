@@ -0,0 +1,136 @@
+import os
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, succeed, fail
+from twisted.internet.task import Clock, deferLater
+from twisted.internet import reactor
+
+from foneworx.dedupe import Deduplicator
+from foneworx.poller import Poller
+from tests.utils import GatewayTestMixin
+
+class PollerTestCase(GatewayTestMixin, TestCase):
+
+    def setUp(self):
+        self.start_gateway()
+
+    @inlineCallbacks
+    def test_consume_and_acknowledge(self):
+        consumed = []
+        state_file = self.mktemp()
+        poller = Poller(self.client, consumed.append, state_file=state_file)
+        self.gateway.receive('+27123456789', 'hello')
+        self.gateway.receive('+27123456789', 'world')
+        handled = yield poller.poll_once()
+        self.assertEquals(handled, 2)
+        self.assertEquals([sms['message'] for sms in consumed],
+                            ['hello', 'world'])
+        self.assertEquals(self.gateway.inbox, [])
+        self.assertEquals(poller.since, consumed[-1]['timereceived'])
+        # the watermark survives a restart
+        restarted = Poller(self.client, consumed.append, state_file=state_file)
+        self.assertEquals(restarted.since, poller.since)
+
+    @inlineCallbacks
+    def test_redeliver_failures(self):
+        attempts = []
+        def consumer(message):
+            attempts.append(message['message'])
+            if len(attempts) == 1:
+                return fail(ValueError("try again"))
+        poller = Poller(self.client, consumer)
+        self.gateway.receive('+27123456789', 'hello')
+        handled = yield poller.poll_once()
+        self.assertEquals(handled, 0)
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEquals(len(self.gateway.inbox), 1)
+        # the watermark makes the gateway return the message again
+        handled = yield poller.poll_once()
+        self.assertEquals(handled, 1)
+        self.assertEquals(attempts, ['hello', 'hello'])
+        self.assertEquals(self.gateway.inbox, [])
+
+    @inlineCallbacks
+    def test_dedupe(self):
+        consumed = []
+        poller = Poller(self.client, consumed.append, dedupe=Deduplicator())
+        sms = self.gateway.receive('+27123456789', 'hello')
+        yield poller.poll_once()
+        # as if deleting the message had failed
+        self.gateway.inbox.append(sms)
+        handled = yield poller.poll_once()
+        self.assertEquals(handled, 1)
+        self.assertEquals(len(consumed), 1)
+        self.assertEquals(poller.duplicates, 1)
+        self.assertEquals(self.gateway.inbox, [])
+
+    @inlineCallbacks
+    def test_dedupe_batch(self):
+        consumed = []
+        def consumer(message):
+            consumed.append(message)
+            return deferLater(reactor, 0, lambda: None)
+        poller = Poller(self.client, consumer, dedupe=Deduplicator())
+        sms = self.gateway.receive('+27123456789', 'hello')
+        # returned twice in a single batch
+        self.gateway.inbox.append(sms)
+        handled = yield poller.poll_once()
+        self.assertEquals(handled, 2)
+        self.assertEquals(len(consumed), 1)
+        self.assertEquals(poller.duplicates, 1)
+
+
+class StubClient(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def stream_new_messages(self, callback, since=None):
+        if self.batches:
+            batch = self.batches.pop(0)
+            return callback(batch).addCallback(lambda _: len(batch))
+        return succeed(0)
+
+    def delete_messages(self, sms_ids):
+        return succeed(dict((sms_id, 'Success') for sms_id in sms_ids))
+
+
+class AdaptiveIntervalTestCase(TestCase):
+
+    def test_backoff(self):
+        clock = Clock()
+        client = StubClient()
+        poller = Poller(client, lambda message: None, min_interval=1,
+                        max_interval=8, clock=clock)
+        poller.startService()
+        clock.advance(0)
+        self.assertEquals(poller.polls, 1)
+        self.assertEquals(poller.interval, 2)
+        clock.pump([2, 4, 8, 8])
+        self.assertEquals(poller.polls, 5)
+        self.assertEquals(poller.interval, 8)
+        client.batches.append([{'sms_id': '1', 'timereceived': 1}])
+        clock.advance(8)
+        self.assertEquals(poller.consumed, 1)
+        self.assertEquals(poller.interval, 1)
+        poller.stopService()
+        clock.advance(60)
+        self.assertEquals(poller.polls, 6)
+
+    def test_save_interval(self):
+        clock = Clock()
+        state_file = self.mktemp()
+        poller = Poller(StubClient(), lambda message: None,
+                        dedupe=Deduplicator(state_file=state_file, clock=clock),
+                        save_interval=10, clock=clock)
+        poller.poll_once()
+        self.assertFalse(os.path.exists(state_file))
+        clock.advance(10)
+        poller.poll_once()
+        self.assertTrue(os.path.exists(state_file))
+        os.remove(state_file)
+        poller.poll_once()
+        self.assertFalse(os.path.exists(state_file))
+        # saved when stopping, whatever the interval
+        poller.startService()
+        poller.stopService()
+        self.assertTrue(os.path.exists(state_file))
@@ -0,0 +1,151 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred, inlineCallbacks, DeferredList
+from twisted.internet.protocol import Protocol, ServerFactory
+from twisted.internet import task, error
+
+from foneworx.client import Client
+from tests.utils import GatewayTestMixin
+
+LOGIN_RESPONSE = """<?xml version="1.0"?>
+<sms_api>
+    <error_type></error_type>
+    <session_id>my_session_id</session_id>
+</sms_api>"""
+
+class LoginServerProtocol(Protocol):
+    """Answers every null terminated request with a login response"""
+
+    def connectionMade(self):
+        self.factory.connections.append(self)
+        self.onConnectionLost = Deferred()
+        self.buffer = ''
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while chr(0) in self.buffer:
+            request, self.buffer = self.buffer.split(chr(0), 1)
+            if self.factory.close_after_response:
+                self.transport.write(LOGIN_RESPONSE)
+                self.transport.loseConnection()
+            else:
+                self.transport.write(LOGIN_RESPONSE + chr(0))
+
+    def connectionLost(self, reason):
+        self.onConnectionLost.callback(None)
+
+class LoginServerFactory(ServerFactory):
+    protocol = LoginServerProtocol
+
+    def __init__(self, close_after_response=False):
+        self.close_after_response = close_after_response
+        self.connections = []
+
+    def close(self):
+        """
+        Close all connections, returns a Deferred that fires when they're
+        all closed
+        """
+        closed = [protocol.onConnectionLost for protocol in self.connections]
+        for protocol in list(self.connections):
+            protocol.transport.loseConnection()
+        return DeferredList(closed)
+
+class IdleCloseServerProtocol(LoginServerProtocol):
+    """
+    Answers the first request on a connection and closes it on the next,
+    like a server closing a connection that has been idle
+    """
+
+    answered = False
+
+    def dataReceived(self, data):
+        if self.answered:
+            self.transport.loseConnection()
+        else:
+            self.answered = True
+            LoginServerProtocol.dataReceived(self, data)
+
+class ConnectionPoolTestCase(GatewayTestMixin, TestCase):
+
+    def setUp(self):
+        self.factory = LoginServerFactory()
+        self.address = self.listen(self.factory)
+
+    def get_client(self, **options):
+        self.connection = self.connect(self.address, **options)
+        return Client('username', 'password', connection=self.connection)
+
+    @inlineCallbacks
+    def test_connection_reuse(self):
+        client = self.get_client()
+        for i in range(3):
+            session_id = yield client.login()
+            self.assertEquals(session_id, 'my_session_id')
+        self.assertEquals(len(self.factory.connections), 1)
+
+    @inlineCallbacks
+    def test_pool_size(self):
+        client = self.get_client(pool_size=2)
+        session_ids = yield DeferredList([client.login() for i in range(5)])
+        self.assertEquals([session_id for success, session_id in session_ids],
+                            ['my_session_id'] * 5)
+        self.assertEquals(len(self.factory.connections), 2)
+
+    @inlineCallbacks
+    def test_connection_closed_by_server(self):
+        self.factory.close_after_response = True
+        client = self.get_client()
+        for i in range(3):
+            session_id = yield client.login()
+            self.assertEquals(session_id, 'my_session_id')
+        self.assertEquals(len(self.factory.connections), 3)
+
+    @inlineCallbacks
+    def test_idle_timeout(self):
+        client = self.get_client(idle_timeout=0.01)
+        yield client.login()
+        yield self.factory.connections[0].onConnectionLost
+        yield client.login()
+        self.assertEquals(len(self.factory.connections), 2)
+
+    @inlineCallbacks
+    def test_closed_while_idle(self):
+        self.factory.protocol = IdleCloseServerProtocol
+        client = self.get_client()
+        yield client.login()
+        # sent again on a new connection
+        session_id = yield client.login()
+        self.assertEquals(session_id, 'my_session_id')
+        self.assertEquals(len(self.factory.connections), 2)
+        # the gateway may have received the messages, they aren't resent
+        try:
+            yield self.connection.sendmessages(api_sessionid='my_session_id',
+                                                action_content={'sms': [
+                                                    {'msisdn': '+27123456789',
+                                                        'message': 'hi'}]})
+        except error.ConnectionDone:
+            pass
+        else:
+            self.fail("Expected a ConnectionDone")
+        self.assertEquals(len(self.factory.connections), 2)
+
+    @inlineCallbacks
+    def test_read_closed_while_idle(self):
+        self.factory.protocol = IdleCloseServerProtocol
+        self.get_client()
+        yield self.connection.login()
+        # without a smstime the first request may have returned the
+        # messages & advanced the read pointer, it isn't resent
+        try:
+            yield self.connection.newmessages(api_sessionid='my_session_id')
+        except error.ConnectionDone:
+            pass
+        else:
+            self.fail("Expected a ConnectionDone")
+        self.assertEquals(len(self.factory.connections), 1)
+        yield self.connection.login()
+        response = yield self.connection.newmessages(
+            api_sessionid='my_session_id',
+            action_content={'smstime': '20120101000000'})
+        self.assertEquals(response['session_id'], 'my_session_id')
+        self.assertEquals(len(self.factory.connections), 3)
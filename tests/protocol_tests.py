@@ -0,0 +1,88 @@
+from twisted.trial.unittest import TestCase
+from twisted.test.proto_helpers import StringTransport
+from twisted.internet import error
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.python.failure import Failure
+
+from foneworx.protocol import FoneworxProtocol
+from foneworx.utils import Element
+
+class FoneworxProtocolTestCase(TestCase):
+
+    def setUp(self):
+        self.protocol = FoneworxProtocol()
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, on_record=None):
+        results = []
+        deferred = self.protocol.send_xml(Element("sms_api"), on_record)
+        deferred.addBoth(results.append)
+        return results
+
+    def test_null_terminated_responses(self):
+        """one connection should carry several exchanges"""
+        results = self.send()
+        self.assertTrue(self.transport.value().endswith(chr(0)))
+        self.protocol.dataReceived("<sms_api><status>Suc")
+        self.assertEquals(results, [])
+        self.protocol.dataReceived("cess</status></sms_api>" + chr(0))
+        self.assertEquals(results, [{'status': 'Success'}])
+        results = self.send()
+        self.protocol.dataReceived("<sms_api><status>Again</status></sms_api>"
+                                    + chr(0))
+        self.assertEquals(results, [{'status': 'Again'}])
+        self.assertEquals(self.protocol.responses, 2)
+
+    def test_response_terminated_by_connection_close(self):
+        results = self.send()
+        self.protocol.dataReceived("<sms_api><status>Success</status></sms_api>")
+        self.protocol.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals(results, [{'status': 'Success'}])
+
+    def test_streamed_records(self):
+        records = []
+        results = self.send(on_record=records.append)
+        self.protocol.dataReceived("<sms_api><sms><sms_id>1</sms_id></sms>")
+        self.assertEquals(records, [{'sms_id': '1'}])
+        self.protocol.dataReceived("</sms_api>" + chr(0))
+        self.assertEquals(results, [{}])
+
+    def test_connection_lost_without_response(self):
+        results = self.send()
+        self.protocol.connectionLost(Failure(error.ConnectionLost()))
+        self.assertTrue(results[0].check(error.ConnectionLost))
+
+    def test_malformed_response(self):
+        results = self.send()
+        self.protocol.dataReceived("<sms_api><status></sms_api>" + chr(0))
+        self.assertTrue(isinstance(results[0], Failure))
+        self.assertTrue(self.transport.disconnecting)
+        self.flushLoggedErrors()
+
+    def test_cancel(self):
+        deferred = self.protocol.send_xml(Element("sms_api"))
+        deferred.cancel()
+        self.failureResultOf(deferred).trap(CancelledError)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertFalse(self.protocol.connected)
+        self.assertEquals(self.protocol.onXMLReceived, None)
+
+    def test_paused_by_record_callback(self):
+        waiting = Deferred()
+        records = []
+        def on_record(record):
+            records.append(record)
+            return waiting
+        results = self.send(on_record)
+        self.protocol.dataReceived("<sms_api><sms><sms_id>1</sms_id></sms>")
+        self.assertEquals(self.transport.producerState, 'paused')
+        waiting.callback(None)
+        self.assertEquals(self.transport.producerState, 'producing')
+        # reading isn't left paused once the response is complete
+        waiting = Deferred()
+        self.protocol.dataReceived("<sms><sms_id>2</sms_id></sms></sms_api>"
+                                    + chr(0))
+        self.assertEquals(self.transport.producerState, 'producing')
+        self.assertEquals(len(records), 2)
+        self.assertEquals(results, [{}])
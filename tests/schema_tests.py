@@ -0,0 +1,100 @@
+import pickle
+from datetime import datetime
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from foneworx.client import Client, Convertor
+from foneworx.schema import Decoder, Field, LazyRecord, Status, \
+                            parse_timestamp, sent_message_fields, \
+                            SentStatus, SubmitResult
+from tests.utils import TestConnection
+
+class DecoderTestCase(TestCase):
+
+    record = {
+        'sms_id': 'sms id 1',
+        'status_id': '3',
+        'status_text': 'Delivered',
+        'time_submitted': '20100720110000',
+        'time_processed': '20100720120000',
+        'rule': None,
+        'TimeReceived': '20100714121511',
+    }
+
+    def convert(self, record):
+        convertor = Convertor()
+        return dict(convertor.convert(*kv) for kv in record.items())
+
+    def test_matches_convertor(self):
+        for decoder in [Decoder(), Decoder(sent_message_fields)]:
+            self.assertEquals(decoder.decode(self.record), 
+                                self.convert(self.record))
+
+    def test_parse_timestamp(self):
+        for string in ['20100714121511', '2010714121511']:
+            self.assertEquals(parse_timestamp(string),
+                                datetime.strptime(string, '%Y%m%d%H%M%S'))
+        self.assertRaises(ValueError, parse_timestamp, '20101314121511')
+
+    def test_lazy_fields(self):
+        decoder = Decoder([Field('time_processed', parse_timestamp, lazy=True)],
+                            lazy=['status_id'])
+        record = decoder.decode(self.record)
+        self.assertTrue(isinstance(record, LazyRecord))
+        self.assertEquals(record.data['status_id'], '3')
+        self.assertEquals(record['status_id'], Status('3'))
+        self.assertEquals(record.get('time_processed'), 
+                            datetime(2010, 7, 20, 12, 0, 0))
+        self.assertEquals(record, self.convert(self.record))
+        self.assertEquals(self.convert(self.record), record)
+
+    def test_lazy_record_copies(self):
+        decoder = Decoder(sent_message_fields, lazy=['status_id'])
+        expected = self.convert(self.record)
+        # copies made without __getitem__ still get converted values
+        self.assertEquals(dict(decoder.decode(self.record)), expected)
+        self.assertEquals((lambda **record: record)(
+                            **decoder.decode(self.record)), expected)
+        copy = {}
+        copy.update(decoder.decode(self.record))
+        self.assertEquals(copy['status_id'], Status('3'))
+
+class RecordTestCase(TestCase):
+
+    def test_status_interned(self):
+        self.assertTrue(Status('3') is Status('3'))
+        self.assertFalse(Status('3') != Status('3'))
+        self.assertEquals(pickle.loads(pickle.dumps(Status('4'))), Status('4'))
+
+    def test_record_access(self):
+        values = {'sms_id': '1', 'status_id': Status('3'), 'unknown': 'x'}
+        record = SentStatus(values)
+        self.assertEquals(record.sms_id, '1')
+        self.assertEquals(record['status_id'], Status('3'))
+        self.assertEquals(record['unknown'], 'x')
+        self.assertEquals(record.get('rule', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: record['rule'])
+        self.assertFalse('rule' in record)
+        self.assertEquals(record, values)
+        self.assertEquals(values, record)
+        self.assertEquals(sorted(record), ['sms_id', 'status_id', 'unknown'])
+        self.assertEquals(pickle.loads(pickle.dumps(record, 2)), record)
+
+    def test_decoders_kept_across_sessions(self):
+        client = Client('username', 'password', connection=TestConnection())
+        decoder = Decoder(sent_message_fields, lazy=['status_id'])
+        client.decoders['sentmessages'] = decoder
+        client.reset_session_id()
+        self.assertTrue(client.decoders['sentmessages'] is decoder)
+
+    @inlineCallbacks
+    def test_client_record_types(self):
+        client = Client('username', 'password', connection=TestConnection(),
+                        record_types=True)
+        [sms] = yield client.sent_messages()
+        self.assertTrue(isinstance(sms, SentStatus))
+        self.assertEquals(sms.time_submitted, datetime(2010, 7, 20, 11, 0, 0))
+        self.assertTrue(sms.status_id is Status('3'))
+        [first, second] = yield client.send_messages([{}, {}])
+        self.assertTrue(isinstance(first, SubmitResult))
+        self.assertEquals(first['submit'], 'fail')
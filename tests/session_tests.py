@@ -0,0 +1,139 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred, succeed, fail, inlineCallbacks
+from twisted.internet import task
+
+from foneworx.client import Client, Connection
+from foneworx.errors import ApiException
+
+class LoginConnection(Connection):
+    """Hands out session ids one login at a time"""
+    
+    def __init__(self):
+        self.logins = []
+    
+    def send(self, dictionary):
+        if dictionary['api_action'] == 'login':
+            deferred = Deferred()
+            self.logins.append(deferred)
+            return deferred
+        return succeed({'status': 'Success'})
+    
+    def complete_login(self):
+        session_id = 'session %s' % len(self.logins)
+        self.logins[-1].callback({'session_id': session_id})
+
+class SessionTestCase(TestCase):
+    
+    def setUp(self):
+        self.connection = LoginConnection()
+        self.clock = task.Clock()
+        self.client = Client('username', 'password', 
+                                connection=self.connection, 
+                                session_timeout=600, clock=self.clock)
+    
+    def get_session_ids(self, count):
+        session_ids = []
+        for i in range(count):
+            self.client.get_session_id().addCallback(session_ids.append)
+        return session_ids
+    
+    def test_single_flight_login(self):
+        session_ids = self.get_session_ids(5)
+        self.assertEquals(len(self.connection.logins), 1)
+        self.connection.complete_login()
+        self.assertEquals(session_ids, ['session 1'] * 5)
+    
+    def test_failed_login(self):
+        failures = []
+        for i in range(2):
+            self.client.get_session_id().addErrback(failures.append)
+        self.connection.logins[0].errback(ValueError("login failed"))
+        self.assertEquals(len(failures), 2)
+        self.get_session_ids(1)
+        self.assertEquals(len(self.connection.logins), 2)
+    
+    def test_idle_session_expires(self):
+        self.get_session_ids(1)
+        self.connection.complete_login()
+        self.clock.advance(599)
+        self.assertEquals(self.get_session_ids(1), ['session 1'])
+        self.clock.advance(600)
+        self.get_session_ids(1)
+        self.assertEquals(len(self.connection.logins), 2)
+    
+    def test_keepalive(self):
+        self.client.keepalive = 60
+        self.get_session_ids(1)
+        self.connection.complete_login()
+        self.clock.advance(300)
+        self.get_session_ids(1)
+        self.clock.advance(240)
+        # used 240 seconds ago, not close enough to expiring yet
+        self.assertEquals(len(self.connection.logins), 1)
+        self.clock.advance(300)
+        self.assertEquals(len(self.connection.logins), 2)
+        self.connection.complete_login()
+        self.assertEquals(self.get_session_ids(1), ['session 2'])
+        self.client.reset_session_id()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+    
+    def test_keepalive_idle(self):
+        self.client.keepalive = 60
+        self.client.keepalive_idle = 1000
+        self.get_session_ids(1)
+        self.connection.complete_login()
+        self.clock.advance(540)
+        self.connection.complete_login()
+        self.assertEquals(len(self.connection.logins), 2)
+        # no calls for 1080 seconds, the session isn't refreshed again
+        self.clock.advance(540)
+        self.assertEquals(len(self.connection.logins), 2)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+    
+    def test_keepalive_needs_session_timeout(self):
+        self.assertRaises(ValueError, Client, 'username', 'password',
+                            session_timeout=None, keepalive=60)
+        self.assertRaises(ValueError, Client, 'username', 'password',
+                            session_timeout=60, keepalive=60)
+
+class ExpiringConnection(Connection):
+    """Rejects every session but the most recent one"""
+    
+    def __init__(self):
+        self.requests = []
+        self.logins = 0
+    
+    def send(self, dictionary):
+        self.requests.append(dictionary)
+        if dictionary['api_action'] == 'login':
+            self.logins += 1
+            return succeed({'session_id': 'session %s' % self.logins})
+        if dictionary['api_sessionid'] != 'session %s' % self.logins:
+            return fail(ApiException('Session Expired'))
+        return succeed({'change': 'Success'})
+
+class SessionRetryTestCase(TestCase):
+    
+    def setUp(self):
+        self.connection = ExpiringConnection()
+        self.client = Client('username', 'password', 
+                                connection=self.connection)
+    
+    @inlineCallbacks
+    def test_replay_after_session_reset(self):
+        yield self.client.delete_message('sms id 1')
+        # the gateway resets its sessions
+        self.connection.logins += 1
+        change = yield self.client.delete_message('sms id 1')
+        self.assertEquals(change, 'Success')
+        self.assertEquals([request['api_action'] 
+                            for request in self.connection.requests],
+                            ['login', 'deletenewmessages', 'deletenewmessages',
+                                'login', 'deletenewmessages'])
+    
+    def test_retry_budget(self):
+        self.client.session_retries = 0
+        self.client.get_session_id()
+        self.connection.logins += 1
+        return self.assertFailure(self.client.delete_message('sms id 1'),
+                                    ApiException)
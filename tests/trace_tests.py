@@ -0,0 +1,75 @@
+from twisted.trial.unittest import TestCase
+from twisted.python import log
+from twisted.test.proto_helpers import StringTransport
+
+from foneworx import trace
+from foneworx.protocol import FoneworxProtocol
+from foneworx.trace import Tracer, WireCapture, Lazy, DEBUG, TRACE
+
+class Expensive(object):
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return 'expensive'
+
+
+class TracerTestCase(TestCase):
+
+    def setUp(self):
+        self.messages = []
+        log.addObserver(self.messages.append)
+        self.addCleanup(log.removeObserver, self.messages.append)
+
+    def logged(self):
+        return [event['message'][0] for event in self.messages
+                    if event.get('logLevel') in (DEBUG, TRACE)]
+
+    def test_disabled(self):
+        value = Expensive()
+        tracer = Tracer()
+        tracer.debug("value: %s", value)
+        tracer.trace("value: %s", Lazy(str, value))
+        self.assertEquals(value.formatted, 0)
+        self.assertEquals(self.logged(), [])
+
+    def test_levels(self):
+        tracer = Tracer(level=DEBUG)
+        tracer.debug("debug %s", 1)
+        tracer.trace("trace %s", 2)
+        self.assertEquals(self.logged(), ['debug 1'])
+
+    def test_sampling(self):
+        tracer = Tracer(level=DEBUG, sample_rate=0.1, seed=1)
+        for i in range(1000):
+            tracer.debug("message %s", i)
+        self.assertTrue(50 < len(self.logged()) < 150)
+
+    def test_wire_capture(self):
+        filename = self.mktemp()
+        trace.configure(level=trace.DISABLED, capture_file=filename,
+                        max_capture_bytes=100)
+        self.addCleanup(trace.disable)
+        protocol = FoneworxProtocol()
+        protocol.makeConnection(StringTransport())
+        protocol.sendLine('<sms_api />')
+        protocol.dataReceived('<sms_api><error_type /></sms_api>\0')
+        protocol.sendLine('x' * 100)
+        trace.tracer.capture.close()
+        lines = open(filename).read().splitlines()
+        self.assertEquals(len(lines), 5)
+        self.assertTrue(lines[0].startswith('> '))
+        self.assertEquals(lines[1], '<sms_api />')
+        self.assertTrue(lines[2].startswith('< '))
+        self.assertEquals(lines[4], '! capture limit of 100 bytes reached')
+        self.assertEquals(self.logged(), [])
+
+    def test_capture_limit(self):
+        capture = WireCapture(self.mktemp(), max_bytes=50)
+        capture.write('>', 'a' * 10)
+        capture.write('>', 'b' * 100)
+        capture.write('>', 'c')
+        self.assertTrue(capture.full)
+        self.assertTrue(capture.written < 50)
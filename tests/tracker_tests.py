@@ -0,0 +1,100 @@
+from datetime import datetime
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from foneworx.schema import Status
+from foneworx.tracker import DeliveryTracker
+from tests.utils import GatewayTestMixin
+
+def update(sms_id, status_id, rule=''):
+    return {
+        'sms_id': sms_id,
+        'status_id': Status(status_id),
+        'rule': rule,
+        'time_processed': datetime(2010, 7, 20, 12, 0, int(status_id) % 60),
+    }
+
+class DeliveryTrackerTestCase(TestCase):
+
+    def test_indexes(self):
+        tracker = DeliveryTracker()
+        tracker.track('1', rule='a')
+        tracker.track('2', rule='b')
+        self.assertEquals(tracker.with_status(None), set(['1', '2']))
+        tracker.update_batch([update('1', '1'), update('2', '2', 'c'),
+                                update('unknown', '3')])
+        self.assertEquals(tracker.get('1').status, Status('1'))
+        self.assertEquals(tracker.with_status(1), set(['1']))
+        self.assertEquals(tracker.with_status('2'), set(['2']))
+        self.assertEquals(tracker.with_status(None), set())
+        self.assertEquals(tracker.with_rule('a'), set(['1']))
+        self.assertEquals(tracker.with_rule('b'), set())
+        self.assertEquals(tracker.with_rule('c'), set(['2']))
+        self.assertEquals(tracker.unknown, 1)
+        self.assertEquals(tracker.since, datetime(2010, 7, 20, 12, 0, 3))
+
+    def test_callbacks(self):
+        tracker = DeliveryTracker()
+        changes = []
+        tracker.add_callback(lambda message, previous: changes.append(
+                                (message.sms_id, previous, message.status)))
+        tracker.track('1')
+        tracker.update(update('1', '1'))
+        tracker.update(update('1', '1'))
+        tracker.update(update('1', '3'))
+        self.assertEquals(changes, [('1', None, Status('1')),
+                                    ('1', Status('1'), Status('3'))])
+
+    def test_track_results(self):
+        tracker = DeliveryTracker()
+        tracker.track_results([
+            {'sms_id': '1', 'submit': 'Success'},
+            {'sms_id': '2', 'submit': 'success', 'rule': 'a'},
+            {'sms_id': '', 'submit': 'fail'},
+            {'sms_id': '3', 'submit': 'fail'},
+            None,
+        ], rule='b')
+        self.assertEquals(tracker.with_status(None), set(['1', '2']))
+        self.assertEquals(tracker.with_rule('b'), set(['1']))
+
+    def test_eviction(self):
+        tracker = DeliveryTracker(max_final=2)
+        for sms_id in '1234':
+            tracker.track(sms_id, rule='rule')
+        tracker.update(update('1', '3'))
+        tracker.update(update('2', '1'))
+        tracker.update(update('3', '4'))
+        tracker.update(update('4', '6'))
+        self.assertEquals(len(tracker), 3)
+        self.assertFalse('1' in tracker)
+        self.assertEquals(tracker.with_status(3), set())
+        self.assertEquals(tracker.with_rule('rule'), set(['2', '3', '4']))
+
+
+class TrackerPollingTestCase(GatewayTestMixin, TestCase):
+
+    def setUp(self):
+        self.start_gateway()
+
+    @inlineCallbacks
+    def test_poll(self):
+        tracker = DeliveryTracker(self.client)
+        results = yield self.client.send_messages([{
+            'msisdn': '+27123456789',
+            'message': 'hello',
+        }, {
+            'msisdn': '',
+            'message': 'no destination',
+        }])
+        tracker.track_results(results, rule='test')
+        self.assertEquals(len(tracker), 1)
+        count = yield tracker.poll()
+        self.assertEquals(count, 1)
+        sms_id = results[0]['sms_id']
+        self.assertEquals(tracker.with_status(3), set([sms_id]))
+        self.assertEquals(tracker.with_rule('test'), set([sms_id]))
+        self.assertTrue(tracker.since)
+        # updates since the watermark are applied again without changes
+        count = yield tracker.poll()
+        self.assertEquals(count, 1)
+        self.assertEquals(tracker.with_status(3), set([sms_id]))
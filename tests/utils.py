@@ -1,10 +1,12 @@
 # coding=utf-8
 from xml.etree.ElementTree import Element, tostring, fromstring
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.python import log
-from foneworx.utils import xml_to_dict, dict_to_xml, Dispatcher
-from foneworx.client import Connection
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed, fail
+from twisted.internet import reactor
+from foneworx.utils import xml_to_dict, dict_to_xml, Dispatcher, ResponseParser
+from foneworx.client import Client, Connection, TwistedConnection
+from foneworx.fakegateway import FakeGateway, FakeGatewayFactory
 from foneworx.errors import ApiException
+from foneworx.trace import tracer, Lazy
 
 class TestDispatcher(Dispatcher):
     """
@@ -149,20 +151,82 @@ class TestConnection(Connection):
         self.dispatcher = TestDispatcher()
     
     @inlineCallbacks
-    def send(self, dictionary):
+    def send(self, dictionary, on_record=None):
         # reroute the remote calls to local calls for testing
         api_action = dictionary['api_action']
         sent_xml = dict_to_xml(dictionary, Element("sms_api"))
-        log.msg("Sending XML: %s" % tostring(sent_xml))
+        tracer.debug("Sending XML: %s", Lazy(tostring, sent_xml))
         received_xml = yield self.dispatcher.dispatch(api_action, sent_xml)
-        xml = fromstring(received_xml)
-        log.msg("Received XML: %s" % tostring(xml))
-        sms_api, response = xml_to_dict(xml)
-        log.msg("Received Dict: %s" % response)
+        tracer.debug("Received XML: %s", received_xml)
+        parser = ResponseParser(on_record)
+        parser.feed(received_xml)
+        response = parser.close()
+        tracer.debug("Received Dict: %s", response)
         # if at any point, we get this error something went wrong
         if response.get('error_type'):
-            raise ApiException(response['error_type'], tostring(xml))
-        log.msg('Returning: %s' % response)
+            raise ApiException(response['error_type'], received_xml)
+        tracer.debug('Returning: %s', response)
         returnValue(response)
     
 
+
+class EchoConnection(Connection):
+    """
+    Answers sendmessages with a successful submit result per message,
+    using the message as the sms_id. Batches containing a message 'fail'
+    fail with an ApiException.
+    """
+    
+    def __init__(self):
+        self.requests = []
+    
+    def send(self, dictionary, on_record=None):
+        api_action = dictionary['api_action']
+        self.requests.append(dictionary)
+        if api_action == 'login':
+            return succeed({'session_id': 'my_session_id'})
+        messages = dictionary['action_content']['sms']
+        if any(message['message'] == 'fail' for message in messages):
+            return fail(ApiException('Invalid batch'))
+        results = [{
+            'submit': 'success',
+            'sms_id': message['message']
+        } for message in messages]
+        if on_record:
+            map(on_record, results)
+            return succeed({})
+        return succeed({'sms': results})
+
+
+class GatewayTestMixin(object):
+    """
+    For TestCases talking to a gateway over TCP. Servers & connections are
+    closed when the test ends, connections before the servers.
+    """
+    
+    def listen(self, factory):
+        """
+        Serve `factory` on a local port, returns its (host, port) address.
+        The factory's close() is called at the end of the test.
+        """
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.addCleanup(factory.close)
+        return ('127.0.0.1', port.getHost().port)
+    
+    def connect(self, *addresses, **options):
+        """A TwistedConnection to `addresses`, closed at the end of the test"""
+        connection = TwistedConnection(list(addresses), **options)
+        self.addCleanup(connection.close)
+        return connection
+    
+    def start_gateway(self, gateway=None, **options):
+        """
+        Serve a FakeGateway and set `gateway`, `factory`, `connection` &
+        `client` for it, `options` are passed on to the TwistedConnection
+        """
+        self.gateway = gateway or FakeGateway()
+        self.factory = FakeGatewayFactory(self.gateway)
+        self.connection = self.connect(self.listen(self.factory), **options)
+        self.client = Client('username', 'password',
+                                connection=self.connection)